@@ -0,0 +1,283 @@
+"""
+An asyncio transport for Stream.
+
+StreamProtocol is an asyncio Protocol that feeds received data straight
+into a Stream and writes the stream's output, any number of them can
+share one event loop.
+
+    protocol = yield From(connect(stream, 'orvant.com'))    # trollius
+    protocol = await connect(stream, 'orvant.com')          # asyncio
+    features = await protocol.recv_stanza()
+    await protocol.starttls()
+
+The API returns futures rather than being written as coroutines so the
+module runs on asyncio as well as on trollius, the asyncio backport for
+Python 2.
+"""
+import ssl
+from collections import deque
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from agent.xmpp.ns import NS_TLS
+from agent.xmpp.xmlutil import Node
+from agent.xmpp.transport import TransportError
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+STREAM_END = b'</stream:stream>'
+
+def encode(data):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+def chain(future, callback, loop):
+    """
+    Return a future for callback(result) once future is done, when
+    callback returns a future the returned one follows it. Errors and
+    cancellation are passed on without calling callback.
+    """
+    out = asyncio.Future(loop=loop)
+    def done(f):
+        if out.done():
+            return
+        if f.cancelled():
+            out.cancel()
+            return
+        if f.exception() is not None:
+            out.set_exception(f.exception())
+            return
+        try:
+            result = callback(f.result())
+        except Exception as e:
+            out.set_exception(e)
+            return
+        if isinstance(result, asyncio.Future):
+            result.add_done_callback(lambda r: follow(r, out))
+        else:
+            out.set_result(result)
+    future.add_done_callback(done)
+    return out
+
+def follow(source, target):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+class StreamProtocol(asyncio.Protocol):
+    """
+    Drive a Stream over an asyncio connection. Received stanzas are handed
+    to recv_stanza callers in order, the stream's input watermarks pause
+    reading on the asyncio transport and the transport's write buffer
+    limits pause send_stanza callers.
+    """
+
+    def __init__(self, stream, loop=None):
+        self.stream = stream
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+        self.reading = True
+        self.writing = True
+        self.waiters = deque()
+        self.drain_waiters = deque()
+        self.connected = asyncio.Future(loop=self.loop)
+        self.closed = asyncio.Future(loop=self.loop)
+        self._upgrading = False
+        stream.transport = self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.reading:
+            transport.pause_reading()
+        if not self.connected.done():
+            self.connected.set_result(self)
+
+    def data_received(self, data):
+        self.stream.parse(data)
+        self._wake()
+
+    def connection_lost(self, exc):
+        if self._upgrading:
+            # The plain connection handed its socket over to TLS
+            self._upgrading = False
+            return
+        log.debug(M("Connection lost: {0}", exc))
+        self.transport = None
+        error = exc or TransportError('connection closed')
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(error)
+        self._release_writers()
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def pause_writing(self):
+        self.writing = False
+
+    def resume_writing(self):
+        self.writing = True
+        self._release_writers()
+
+    def pause_reading(self):
+        """
+        Stop reading from the connection, called by the stream when its
+        input buffer is full.
+        """
+        self.reading = False
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume_reading(self):
+        self.reading = True
+        if self.transport is not None:
+            self.transport.resume_reading()
+
+    def start(self):
+        self.stream.start()
+        self.flush()
+
+    def flush(self):
+        """
+        Hand everything in the stream's output buffer to the transport in
+        one call.
+        """
+        output = self.stream.getoutput_all()
+        if output and self.transport is not None:
+            self.transport.writelines([encode(i) for i in output])
+
+    def drain(self):
+        """
+        Return a future done once the transport accepts more data.
+        """
+        waiter = asyncio.Future(loop=self.loop)
+        if self.writing or self.transport is None:
+            waiter.set_result(None)
+        else:
+            self.drain_waiters.append(waiter)
+        return waiter
+
+    def send_stanza(self, node):
+        """
+        Send node and return a future for its message id, done once the
+        transport accepts more data.
+        """
+        msgid = self.stream.sendnode(node)
+        self.flush()
+        return chain(self.drain(), lambda result: msgid, self.loop)
+
+    def recv_stanza(self):
+        """
+        Return a future for the next received stanza.
+        """
+        waiter = asyncio.Future(loop=self.loop)
+        if self.transport is None and self.connected.done() \
+                and not self.stream.input_buffer:
+            waiter.set_exception(TransportError('connection closed'))
+            return waiter
+        self.waiters.append(waiter)
+        self._wake()
+        return waiter
+
+    def _wake(self):
+        waiters = self.waiters
+        while waiters and self.stream.input_buffer:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(self.stream.recvnode())
+
+    def _release_writers(self):
+        while self.drain_waiters:
+            waiter = self.drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def starttls(self, ssl_context=None, server_hostname=None):
+        """
+        Negotiate STARTTLS: ask for it, wait for the server to proceed,
+        wrap the connection in TLS and restart the stream. Return a future
+        for this protocol, done once the new stream header is sent.
+        """
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        if server_hostname is None:
+            server_hostname = self.stream.to
+        def proceed(node):
+            if node.tag != 'proceed':
+                raise TransportError(
+                    'STARTTLS refused: {0}'.format(node.to_string())
+                )
+            return self._upgrade(ssl_context, server_hostname)
+        def restart(result):
+            self.stream.restart()
+            self.flush()
+            return self
+        self.send_stanza(Node('starttls', attrs={'xmlns': NS_TLS}))
+        return chain(
+            chain(self.recv_stanza(), proceed, self.loop), restart, self.loop
+        )
+
+    def _upgrade(self, ssl_context, server_hostname):
+        start_tls = getattr(self.loop, 'start_tls', None)
+        if start_tls is not None:
+            def upgraded(transport):
+                self.transport = transport
+                return self
+            return chain(
+                asyncio.ensure_future(start_tls(
+                    self.transport, self, ssl_context,
+                    server_hostname=server_hostname,
+                ), loop=self.loop),
+                upgraded, self.loop,
+            )
+        # Loops without start_tls: give a duplicate of the socket to a new
+        # TLS connection for this protocol and drop the plain one.
+        sock = self.transport.get_extra_info('socket').dup()
+        self._upgrading = True
+        self.transport.abort()
+        return chain(
+            asyncio.ensure_future(self.loop.create_connection(
+                lambda: self, sock=sock, ssl=ssl_context,
+                server_hostname=server_hostname,
+            ), loop=self.loop),
+            lambda result: self, self.loop,
+        )
+
+    def close(self):
+        """
+        End the stream and close the connection, return a future done once
+        it is closed.
+        """
+        if self.transport is not None:
+            self.flush()
+            self.transport.write(STREAM_END)
+            self.transport.close()
+        return self.closed
+
+def connect(stream, host, port=5222, loop=None, ssl_context=None, **kwargs):
+    """
+    Open a connection to host and start stream over it. Return a future
+    for the StreamProtocol.
+    """
+    loop = loop or asyncio.get_event_loop()
+    protocol = StreamProtocol(stream, loop)
+    def started(result):
+        protocol.start()
+        return protocol
+    return chain(
+        asyncio.ensure_future(loop.create_connection(
+            lambda: protocol, host, port, ssl=ssl_context, **kwargs
+        ), loop=loop),
+        started, loop,
+    )
@@ -0,0 +1,82 @@
+"""
+Load test for the asyncio transport against a local stand-in server.
+
+    python -m agent.xmpp.bench_aio
+
+"""
+import time
+
+from agent.xmpp.aio import asyncio, connect
+from agent.xmpp.stream import Stream
+from agent.xmpp.bench_stream import message
+from agent.xmpp.testutil import serve_stream
+
+
+def client(loop, port, count, latencies):
+    """
+    Return a future done once the client has connected, sent count
+    messages and received all of them back.
+    """
+    result = asyncio.Future(loop=loop)
+    stream = Stream(to='orvant.com', frm='agent@orvant.com')
+    state = {'sent': {}, 'received': 0}
+
+    def connected(future):
+        protocol = future.result()
+        protocol.recv_stanza().add_done_callback(
+            lambda f: send(protocol))
+
+    def send(protocol):
+        for i in range(count):
+            state['sent'][str(i)] = time.time()
+            protocol.send_stanza(message(i))
+        protocol.recv_stanza().add_done_callback(
+            lambda f: received(protocol, f))
+
+    def received(protocol, future):
+        if future.exception() is not None:
+            result.set_exception(future.exception())
+            return
+        node = future.result()
+        latencies.append(time.time() - state['sent'][node.get_attr('id')])
+        state['received'] += 1
+        if state['received'] == count:
+            protocol.close().add_done_callback(
+                lambda f: result.set_result(None))
+        else:
+            protocol.recv_stanza().add_done_callback(
+                lambda f: received(protocol, f))
+
+    connect(stream, '127.0.0.1', port, loop=loop).add_done_callback(connected)
+    return result
+
+
+def run(connections, count):
+    loop = asyncio.new_event_loop()
+    server, port = serve_stream(loop)
+    latencies = []
+    start = time.time()
+    clients = [client(loop, port, count, latencies) for i in range(connections)]
+    loop.run_until_complete(asyncio.gather(*clients))
+    elapsed = time.time() - start
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+    latencies.sort()
+    return (
+        connections * count / elapsed,
+        latencies[len(latencies) // 2],
+        latencies[len(latencies) * 99 // 100],
+    )
+
+
+def main(count=100):
+    for connections in (10, 100, 500):
+        rate, median, p99 = run(connections, count)
+        print('{0:4} connections: {1:8.0f} stanzas/sec, '
+              'echo latency median {2:6.1f} ms p99 {3:6.1f} ms'.format(
+                  connections, rate, median * 1e3, p99 * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+"""
+Benchmarks decoding gzip encoded BOSH responses, a large roster and a
+long MUC history served by a local HTTP stand-in. The buffered decoder
+is the previous one: join the chunks, copy them into a StringIO, gunzip
+and parse the result.
+
+Then the cost of wrapping a stanza in a body for each request and of
+unwrapping the stanzas of each response, built and parsed as Nodes as
+before and with the string envelope and raw children.
+
+Then a burst of messages sent one request each as before and batched
+into bodies, against a stand-in that answers after a round trip delay
+and two requests at a time.
+
+Last, the latency of stanzas pushed by a stand-in that holds requests,
+polling as without a parked request and long-polling with hold 1.
+
+    python -m agent.xmpp.bench_bosh
+
+"""
+import gzip
+import random
+import re
+import select
+import threading
+import time
+from StringIO import StringIO
+
+from agent.util import HTTPConnection
+from agent.xmpp.ns import NS_HTTP_BIND
+from agent.xmpp.testutil import (
+    MESSAGE, body, roster, history, gzipped, serve, serve_pushes, receive,
+    send_batched,
+)
+from agent.xmpp.transport import Bosh, BodyDecoder
+from agent.xmpp.xmlutil import Node
+
+
+def buffered(res, size):
+    raw_data = []
+    while True:
+        a = res.read(size)
+        if a:
+            raw_data.append(a)
+        if not a or len(a) < size:
+            break
+    a = StringIO()
+    a.write(''.join(raw_data))
+    a.seek(0)
+    return Node.from_string(gzip.GzipFile(fileobj=a).read())
+
+
+def streaming(res, size):
+    decoder = BodyDecoder(res.getheader('content-encoding'))
+    while True:
+        a = res.read(size)
+        if a:
+            decoder.feed(a)
+        if not a or len(a) < size:
+            break
+    return decoder.close()
+
+
+def run(server, decode, count, size=1024):
+    conn = HTTPConnection('127.0.0.1', server.server_port)
+    start = time.time()
+    for i in range(count):
+        conn.request('POST', '/http-bind', body(''))
+        node = decode(conn.getresponse(), size)
+        assert node.tag == 'body'
+    elapsed = time.time() - start
+    conn.close()
+    return elapsed / count
+
+
+def node_envelope(t, stanza):
+    body = Node('body', payload=[Node.from_string(stanza)])
+    body.namespace = NS_HTTP_BIND
+    body.set_attr('content', 'text/xml; charset=utf-8')
+    body.set_attr('xml:lang', t.xml_lang)
+    body.set_attr('rid', t.next_rid())
+    body.set_attr('sid', t._sid)
+    return body.to_string()
+
+
+def node_unwrap(t, data):
+    return t.bosh_to_xmlstream(Node.from_string(data))
+
+
+def raw_unwrap(t, data):
+    decoder = BodyDecoder()
+    decoder.feed(data)
+    return t.bosh_to_xmlstream(decoder.close())
+
+
+def per_request(func, t, data, count):
+    start = time.time()
+    for i in range(count):
+        func(t, data)
+    return (time.time() - start) / count
+
+
+def envelopes(count=20000):
+    t = Bosh('http://127.0.0.1/http-bind')
+    t._sid = '0209ce4ea1047184a8d1fe83e000e02d22f3f40c'
+    stanza = MESSAGE.format(1)
+    before = per_request(node_envelope, t, stanza, count)
+    after = per_request(Bosh.xmlstream_to_bosh, t, stanza, count)
+    print('{0:>12}: nodes {1:6.1f} usec, string {2:6.1f} usec'.format(
+        'wrap', before * 1e6, after * 1e6))
+    for name, data in (('unwrap 1', history(1)), ('unwrap 20', history(20))):
+        before = per_request(node_unwrap, t, data, count // 10)
+        after = per_request(raw_unwrap, t, data, count // 10)
+        print('{0:>12}: nodes {1:6.1f} usec, raw {2:6.1f} usec'.format(
+            name, before * 1e6, after * 1e6))
+
+
+def bosh_client(server, **kwargs):
+    t = Bosh('http://127.0.0.1:{0}/http-bind'.format(server.server_port),
+        **kwargs)
+    t.connection_cls = {'http': HTTPConnection}
+    t._sid = '0209ce4ea1047184a8d1fe83e000e02d22f3f40c'
+    return t
+
+
+def send_each(t, messages):
+    for data in messages:
+        while t.in_flight >= t.requests:
+            receive(t)
+        t.send(data)
+    while t.in_flight:
+        receive(t)
+
+
+def burst(count=50, latency=0.02):
+    messages = [MESSAGE.format(i) for i in range(count)]
+    for name, send in (('send each', send_each), ('batched', send_batched)):
+        server = serve(body("<presence xmlns='jabber:client'/>"), None, latency)
+        t = bosh_client(server, requests=2)
+        start = time.time()
+        send(t, messages)
+        elapsed = time.time() - start
+        server.shutdown()
+        print('{0:>12}: {1} messages in {2} requests, {3:6.1f} msec'.format(
+            name, count, len(server.bodies), elapsed * 1000))
+
+
+def pusher(server, count, interval, rng):
+    for i in range(count):
+        time.sleep(rng.uniform(0, 2 * interval))
+        server.push("<message xmlns='jabber:client' id='{0!r}'/>".format(
+            time.time()))
+
+
+def pushes(count=50, interval=0.02, polling=0.2):
+    for name, hold in (('polling', 0), ('hold 1', 1)):
+        server = serve_pushes(hold)
+        t = bosh_client(server, hold=hold, requests=hold + 1, polling=polling)
+        t.bound = True
+        thread = threading.Thread(
+            target=pusher, args=(server, count, interval, random.Random(1)))
+        thread.start()
+        latencies = []
+        while len(latencies) < count:
+            t.schedule()
+            fds = [fd for fd in t._respobjs if t._respobjs[fd]]
+            if not fds:
+                time.sleep(t.schedule_timeout())
+                continue
+            for fd in select.select(fds, [], [], t.schedule_timeout())[0]:
+                for i in t.rawrecv(sock=fd):
+                    pass
+            now = time.time()
+            for stamp in re.findall("id='([0-9.]+)'", t.buffer):
+                latencies.append(now - float(stamp))
+            t.buffer = ''
+        thread.join()
+        server.shutdown()
+        stats = t.stats
+        print('{0:>12}: push latency mean {1:5.1f} max {2:5.1f} msec, '
+              'push wait mean {3:5.1f} max {4:5.1f} msec, '
+              '{5} requests, {6:.0%} empty, uncovered {7:5.1f} msec'.format(
+                  name, sum(latencies) / len(latencies) * 1000,
+                  max(latencies) * 1000, stats.push_wait_mean * 1000,
+                  stats.push_wait_max * 1000, stats.requests,
+                  stats.empty_rate, stats.uncovered * 1000))
+
+
+def main(count=50):
+    for name, data in (('roster 5000', roster(5000)),
+                       ('history 2000', history(2000))):
+        server = serve(gzipped(data))
+        before = run(server, buffered, count)
+        after = run(server, streaming, count)
+        server.shutdown()
+        print('{0:>12}: {1} bytes, {2} gzipped, buffered {3:6.2f} msec, '
+              'streaming {4:6.2f} msec'.format(
+                  name, len(data), len(server.response),
+                  before * 1000, after * 1000))
+    envelopes()
+    burst()
+    pushes()
+
+
+if __name__ == '__main__':
+    main()
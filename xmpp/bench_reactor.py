@@ -0,0 +1,82 @@
+"""
+Benchmarks tick latency against the number of connections, with one
+active connection among idle ones.
+
+    python -m agent.xmpp.bench_reactor
+
+"""
+import select
+import socket
+import time
+
+from agent.xmpp.reactor import Reactor
+from agent.xmpp.transport import Tcp
+
+STANZA = "<message to='bob@orvant.com'><body>hi</body></message>"
+
+
+def connections(count):
+    pairs = []
+    for i in range(count):
+        a, b = socket.socketpair()
+        t = Tcp('orvant.com')
+        t._sock = b
+        pairs.append((a, t))
+    return pairs
+
+
+def close(pairs):
+    for a, t in pairs:
+        a.close()
+        t._sock.close()
+
+
+def poll_each(transports, ticks, peer):
+    """
+    The previous model, every transport polls its own socket each tick.
+    """
+    start = time.time()
+    for i in range(ticks):
+        peer.send(STANZA)
+        for t in transports:
+            if select.select([t.fileno()], [], [], 0)[0]:
+                for j in t.rawrecv():
+                    pass
+                t.recv()
+    return (time.time() - start) / ticks
+
+
+def reactor_tick(transports, ticks, peer):
+    reactor = Reactor()
+    for t in transports:
+        reactor.register(t)
+    reactor.register_read_handler(lambda t: t.recv())
+    start = time.time()
+    for i in range(ticks):
+        peer.send(STANZA)
+        reactor.tick()
+    elapsed = time.time() - start
+    reactor.close()
+    return elapsed / ticks
+
+
+def main(counts=(10, 100, 500, 1000, 8000), ticks=2000):
+    for count in counts:
+        pairs = connections(count)
+        transports = [t for a, t in pairs]
+        peer = pairs[count // 2][0]
+        n = max(ticks * 10 // count, 20)
+        try:
+            before = '{0:10.1f} usec/tick'.format(
+                poll_each(transports, n, peer) * 1e6)
+        except ValueError:
+            # select can not watch file descriptors above 1023
+            before = '{0:>15}'.format('fails')
+        after = reactor_tick(transports, ticks, peer)
+        close(pairs)
+        print('{0:6} connections: poll each {1}, '
+              'reactor {2:6.1f} usec/tick'.format(count, before, after * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmarks for the Stream send pipeline.
+
+    python -m agent.xmpp.bench_stream
+
+"""
+import time
+
+from agent.xmpp.stream import Stream, node_builder
+from agent.xmpp.xmlutil import Node, XmlParser
+
+
+def message(i):
+    return Node('message',
+        attrs={'to': 'bob@orvant.com/home', 'type': 'chat', 'id': str(i)},
+        payload=[
+            Node('body', payload=['hello number {0}'.format(i)]),
+            Node('active', attrs={
+                'xmlns': 'http://jabber.org/protocol/chatstates'}),
+        ],
+    )
+
+
+def reparse_pipeline(stream, nodes):
+    """
+    The pre-existing send path: serialize, parse it back with expat and
+    serialize a second time from the output parser's end handler.
+    """
+    parser = XmlParser()
+    parser.set_node_builder(node_builder)
+    def end(name, level, node):
+        if level == 2:
+            stream.output_buffer.append(node.to_string())
+    parser.register_end_handler(end)
+    parser.parse(stream.header())
+    for node in nodes:
+        parser.parse(node.to_string())
+        stream.getoutput()
+
+
+def direct_pipeline(stream, nodes):
+    stream.start()
+    stream.getoutput()
+    for node in nodes:
+        stream.sendnode(node)
+        stream.getoutput()
+
+
+def run(pipeline, count):
+    stream = Stream(to='orvant.com', frm='agent@orvant.com')
+    nodes = [message(i) for i in range(count)]
+    start = time.time()
+    pipeline(stream, nodes)
+    return count / (time.time() - start)
+
+
+HEADER_IN = (
+    "<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+    "xmlns:stream='http://etherx.jabber.org/streams' to='agent@orvant.com' "
+    "from='orvant.com' id='s1' version='1.0' xml:lang='en'>"
+)
+
+
+def route(lazy, count, chunk=4096):
+    """
+    Receive count messages and forward each one after looking at its
+    top level attributes only.
+    """
+    data = ''.join(message(i).to_string() for i in range(count))
+    inbound = Stream(to='orvant.com', frm='agent@orvant.com', lazy=lazy)
+    outbound = Stream(to='orvant.com', frm='agent@orvant.com')
+    outbound.start()
+    outbound.getoutput()
+    start = time.time()
+    inbound.parse(HEADER_IN)
+    for i in range(0, len(data), chunk):
+        inbound.parse(data[i:i + chunk])
+        node = inbound.recvnode()
+        while node is not None:
+            if node.get_attr('type') == 'chat':
+                outbound.sendnode(node)
+                outbound.getoutput()
+            node = inbound.recvnode()
+    return count / (time.time() - start)
+
+
+def main(count=20000):
+    before = run(reparse_pipeline, count)
+    after = run(direct_pipeline, count)
+    print('reparse: {0:10.0f} stanzas/sec'.format(before))
+    print('direct:  {0:10.0f} stanzas/sec'.format(after))
+    print('speedup: {0:10.2f}x'.format(after / before))
+    before = route(False, count)
+    after = route(True, count)
+    print('route full: {0:10.0f} stanzas/sec'.format(before))
+    print('route lazy: {0:10.0f} stanzas/sec'.format(after))
+    print('speedup:    {0:10.2f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Benchmarks for the Tcp transport over a local socketpair.
+
+    python -m agent.xmpp.bench_transport
+
+"""
+import select
+import socket
+import threading
+import time
+
+from agent.xmpp.stream import Stream
+from agent.xmpp.transport import Tcp, TransportError
+from agent.xmpp.bench_stream import message, HEADER_IN
+
+
+def drain(sock, total):
+    received = 0
+    while received < total:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received += len(data)
+
+
+def run(send, count, burst):
+    """
+    Push count messages through a socketpair in bursts of burst stanzas
+    and return the stanzas per second seen by the reader.
+    """
+    a, b = socket.socketpair()
+    tcp = Tcp('localhost')
+    tcp._sock = a
+    stream = Stream(to='orvant.com', frm='agent@orvant.com')
+    stream.start()
+    stream.getoutput()
+    nodes = [message(i) for i in range(count)]
+    total = sum(len(i.to_string()) for i in nodes)
+    reader = threading.Thread(target=drain, args=(b, total))
+    reader.start()
+    start = time.time()
+    for i in range(0, count, burst):
+        for node in nodes[i:i + burst]:
+            stream.sendnode(node)
+        send(tcp, stream)
+    reader.join()
+    elapsed = time.time() - start
+    a.close()
+    b.close()
+    return count / elapsed
+
+
+def send_each(tcp, stream):
+    """
+    The previous send path, one unchecked send call per stanza.
+    """
+    data = stream.getoutput()
+    while data is not None:
+        tcp._sock.send(data)
+        data = stream.getoutput()
+
+
+def send_coalesced(tcp, stream):
+    tcp.send_output(stream)
+    while tcp.writing:
+        tcp.flush()
+
+
+class StringTcp(Tcp):
+    """
+    The previous receive path, fixed 1024 byte reads joined onto a string
+    buffer that recv slices from the front.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Tcp.__init__(self, *args, **kwargs)
+        self.buffer = ''
+
+    def recv(self, size=1024):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def rawrecv(self, size=1024):
+        data = []
+        while True:
+            try:
+                a = self._sock.recv(size)
+            except socket.error:
+                # The benchmark socket is non-blocking
+                a = ''
+            if a:
+                data.append(a)
+            if not a or len(a) < size:
+                break
+            yield
+        if not data:
+            raise TransportError('dead socket')
+        self.buffer += ''.join(data)
+
+    @property
+    def readyread(self):
+        return self.buffer != ''
+
+
+def write(sock, data, bursts):
+    for i in range(bursts):
+        sock.sendall(data)
+
+
+def receive(cls, bursts, burst):
+    """
+    Write bursts of burst bytes into a socketpair from a thread, read them
+    with rawrecv whenever select reports data and consume the buffer with
+    recv(1024), return megabytes per second.
+    """
+    a, b = socket.socketpair()
+    b.setblocking(0)
+    tcp = cls('localhost')
+    tcp._sock = b
+    total = bursts * burst
+    writer = threading.Thread(target=write, args=(a, 'x' * burst, bursts))
+    start = time.time()
+    writer.start()
+    received = 0
+    while received < total:
+        select.select([b], [], [])
+        for i in tcp.rawrecv():
+            pass
+        while tcp.readyread:
+            received += len(tcp.recv(1024))
+    elapsed = time.time() - start
+    writer.join()
+    a.close()
+    b.close()
+    return total / elapsed / 1e6
+
+
+def feed(bind, count):
+    """
+    Stream count messages through a socketpair into a Stream, either by
+    parsing recv(1024) slices of the receive buffer or with the transport
+    bound to the stream. Return stanzas per second.
+    """
+    a, b = socket.socketpair()
+    b.setblocking(0)
+    tcp = Tcp('localhost')
+    tcp._sock = b
+    stream = Stream(to='orvant.com', frm='agent@orvant.com')
+    if bind:
+        tcp.bind(stream)
+    data = HEADER_IN + ''.join(message(i).to_string() for i in range(count))
+    writer = threading.Thread(target=write, args=(a, data, 1))
+    start = time.time()
+    writer.start()
+    received = 0
+    while received < count:
+        select.select([b], [], [])
+        for i in tcp.rawrecv():
+            pass
+        while tcp.readyread:
+            stream.parse(tcp.recv(1024))
+        received += len(stream.recvnodes())
+    elapsed = time.time() - start
+    writer.join()
+    a.close()
+    b.close()
+    return count / elapsed
+
+
+def main(count=50000):
+    before = feed(False, count)
+    after = feed(True, count)
+    print('feed')
+    print('  recv slices: {0:10.0f} stanzas/sec'.format(before))
+    print('  bound:       {0:10.0f} stanzas/sec'.format(after))
+    print('  speedup:     {0:10.2f}x'.format(after / before))
+    for burst in (4096, 65536, 1048576):
+        bursts = 16 * 1048576 // burst
+        before = receive(StringTcp, bursts, burst)
+        after = receive(Tcp, bursts, burst)
+        print('receive burst {0:8}'.format(burst))
+        print('  string buffer: {0:8.1f} MB/s'.format(before))
+        print('  ring buffer:   {0:8.1f} MB/s'.format(after))
+        print('  speedup:       {0:8.2f}x'.format(after / before))
+    for burst in (1, 10, 100):
+        before = run(send_each, count, burst)
+        after = run(send_coalesced, count, burst)
+        print('burst {0:4}'.format(burst))
+        print('  per stanza: {0:10.0f} stanzas/sec'.format(before))
+        print('  coalesced:  {0:10.0f} stanzas/sec'.format(after))
+        print('  speedup:    {0:10.2f}x'.format(after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+Benchmarks for xmlutil.
+
+    python -m agent.xmpp.bench_xmlutil
+
+"""
+import sys
+import timeit
+
+from agent.xmpp.xmlutil import (
+    Node, XmlParser, xmlescape, xmlescape_cached, SKIP, RAW,
+)
+
+
+def replace_escape(s):
+    """
+    The previous escape, five replace passes behind a regex compiled on
+    every call.
+    """
+    import re
+    r = re.compile('(&amp;|&quote|&#39;|&gt;|&lt;|&#60;|&#62;|&#34;|&#38;|&apos;)')
+    if r.search(s) is not None:
+        return s
+    for a, b in (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'),
+            ('"', '&quote;'), ("'", '&#39;')):
+        s = s.replace(a, b)
+    return s
+
+
+ESCAPE_VALUES = [
+    'romeo@montague.lit/orchard',
+    'http://jabber.org/protocol/disco#info',
+    'Wherefore art thou, Romeo? <3 & "more"',
+    'x' * 4096,
+]
+
+
+ESCAPES = [
+    ('replace', replace_escape),
+    ('xmlescape', xmlescape),
+    ('cached', xmlescape_cached),
+]
+
+
+def bench_escape(number=100000):
+    for value in ESCAPE_VALUES:
+        print('escape {0!r:.40}'.format(value))
+        for name, escape in ESCAPES:
+            t = timeit.timeit(lambda: escape(value), number=number)
+            print('  {0:16} {1:8.3f} usec'.format(name, t / number * 1e6))
+
+
+class DictNode(object):
+    """
+    The previous dict backed Node layout, every instance carries its own
+    __dict__ plus an nsmap, attrs and payload container.
+    """
+
+    def __init__(self, tag, attrs):
+        self._nsmap = {}
+        self._attrs = {}
+        attrs = dict(attrs)
+        for x in attrs.copy():
+            if x.startswith('xmlns'):
+                self._nsmap[x] = attrs.pop(x)
+        self._attrs = attrs
+        self.tag = tag
+        self.prefix = None
+        self.parent = None
+        self.payload = []
+
+    def add_child(self, a):
+        if isinstance(a, DictNode):
+            a.parent = self
+        else:
+            a = a.strip()
+        self.payload.append(a)
+
+
+def dict_node_builder(parser, tag, attrs, level):
+    return DictNode(tag, attrs)
+
+
+STANZAS = {
+    'message': (
+        "<message from='juliet@capulet.lit/balcony' to='romeo@montague.lit' "
+        "type='chat' id='ktx72v49'><body>Art thou not Romeo, and a "
+        "Montague?</body><thread>e0ffe42b28561960c6b12b944a092794b9683a38"
+        "</thread><active xmlns='http://jabber.org/protocol/chatstates'/>"
+        "</message>"
+    ),
+    'presence': (
+        "<presence from='romeo@montague.lit/orchard' to='juliet@capulet.lit'>"
+        "<show>away</show><status>be right back</status><priority>5"
+        "</priority><c xmlns='http://jabber.org/protocol/caps' "
+        "hash='sha-1' node='http://code.google.com/p/exodus' "
+        "ver='QgayPKawpkPSDYmwT/WM94uAlu0='/></presence>"
+    ),
+    'iq': (
+        "<iq to='juliet@example.com/balcony' type='result' id='roster_1'>"
+        "<query xmlns='jabber:iq:roster' ver='ver11'>"
+        "<item jid='romeo@example.net' name='Romeo' subscription='both'>"
+        "<group>Friends</group></item>"
+        "<item jid='mercutio@example.com' name='Mercutio' subscription='from'/>"
+        "<item jid='benvolio@example.net' name='Benvolio' subscription='both'/>"
+        "</query></iq>"
+    ),
+}
+
+
+def sizeof(node):
+    """
+    Bytes owned by node and its subtree and the number of nodes in it, the
+    tag, attribute and text strings are not counted.
+    """
+    if isinstance(node, DictNode):
+        containers = [node.__dict__, node._nsmap, node._attrs, node.payload]
+        payload = node.payload
+    else:
+        containers = [node._nsmap, node._attrs, node._payload]
+        payload = node._payload or ()
+    size = sys.getsizeof(node)
+    size += sum(sys.getsizeof(c) for c in containers if c is not None)
+    count = 1
+    for i in payload:
+        if not isinstance(i, basestring):
+            s, c = sizeof(i)
+            size += s
+            count += c
+    return size, count
+
+
+def parse(data, builder=None):
+    parser = XmlParser()
+    if builder:
+        parser.set_node_builder(builder)
+    return parser.parse(data).getroot()
+
+
+def bench_memory():
+    for name in sorted(STANZAS):
+        print('memory {0}'.format(name))
+        for label, builder in (('dict', dict_node_builder), ('slots', None)):
+            size, count = sizeof(parse(STANZAS[name], builder))
+            print('  {0:16} {1:5d} bytes/stanza {2:5d} bytes/node'.format(
+                label, size, size // count))
+
+
+def bench_namespace(number=200):
+    """
+    Namespace filtered get_tags on a disco#items result nested a few
+    levels below the stream root.
+    """
+    items = ''.join(
+        "<item jid='node{0}@pubsub.orvant.com' node='n{0}'/>".format(i)
+        for i in range(500)
+    )
+    data = (
+        "<stream:stream xmlns='jabber:client' "
+        "xmlns:stream='http://etherx.jabber.org/streams'><iq type='result'>"
+        "<query xmlns='http://jabber.org/protocol/disco#items'>{0}</query>"
+        "</iq></stream:stream>"
+    ).format(items)
+    query = parse(data).get_children()[0].get_children()[0]
+    t = timeit.timeit(
+        lambda: query.get_tags(
+            'item', namespace='http://jabber.org/protocol/disco#items'),
+        number=number,
+    )
+    print('namespace get_tags over 500 items {0:8.1f} usec'.format(
+        t / number * 1e6))
+
+
+def scan_get_tags(node, name, namespace):
+    """
+    get_tags as it was, a scan over every child resolving namespaces.
+    """
+    nodes = []
+    for child in node.get_children():
+        if namespace and namespace != child.namespace:
+            continue
+        if child.tag == name:
+            nodes.append(child)
+    return nodes
+
+
+def bench_index(sizes=(100, 1000, 5000), number=200):
+    """
+    Repeated lookups on a roster result: all items and the one x child
+    that follows them.
+    """
+    for size in sizes:
+        items = ''.join(
+            "<item jid='contact{0}@orvant.com' subscription='both'>"
+            "<group>Friends</group></item>".format(i)
+            for i in range(size)
+        )
+        data = (
+            "<iq type='result'><query xmlns='jabber:iq:roster'>{0}"
+            "<x xmlns='jabber:x:data'/></query></iq>"
+        ).format(items)
+        query = parse(data).get_children()[0]
+        print('index roster of {0} items'.format(size))
+        for label, lookup in (
+                ('scan items', lambda: scan_get_tags(
+                    query, 'item', 'jabber:iq:roster')),
+                ('findall items', lambda: query.findall(
+                    'item', 'jabber:iq:roster')),
+                ('scan x', lambda: scan_get_tags(
+                    query, 'x', 'jabber:x:data')),
+                ('find x', lambda: query.find('x', 'jabber:x:data')),
+                ):
+            t = timeit.timeit(lookup, number=number)
+            print('  {0:16} {1:10.2f} usec'.format(label, t / number * 1e6))
+
+
+HEAVY = (
+    "<message from='juliet@capulet.lit/balcony' to='romeo@montague.lit' "
+    "type='chat' id='h{0}'><body>hi</body>"
+    "<html xmlns='http://jabber.org/protocol/xhtml-im'>"
+    "<body xmlns='http://www.w3.org/1999/xhtml'>{1}</body></html>"
+    "<data xmlns='http://jabber.org/protocol/ibb' seq='{0}' sid='s1'>{2}"
+    "</data></message>"
+)
+
+FILTERS = [
+    ('html', 'http://jabber.org/protocol/xhtml-im'),
+    ('data', 'http://jabber.org/protocol/ibb'),
+]
+
+
+def bench_filters(count=2000, chunk=4096):
+    """
+    Parse messages carrying XHTML-IM bodies and IBB data with and without
+    filters for those payloads.
+    """
+    xhtml = ''.join(
+        "<p style='font-weight:bold'>line <em>{0}</em> of <a href='"
+        "http://orvant.com/{0}'>text</a></p>".format(i) for i in range(20)
+    )
+    ibb = 'QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVo=' * 100
+    data = '<stream>' + ''.join(
+        HEAVY.format(i, xhtml, ibb) for i in range(count)) + '</stream>'
+    print('filters {0} payload heavy messages, {1} bytes'.format(
+        count, len(data)))
+    for label, action in (('none', None), ('raw', RAW), ('skip', SKIP)):
+        parser = XmlParser()
+        if action:
+            for tag, namespace in FILTERS:
+                parser.register_filter(tag, namespace, action)
+        start = timeit.default_timer()
+        for i in range(0, len(data), chunk):
+            parser.parse(data[i:i + chunk])
+        t = timeit.default_timer() - start
+        print('  {0:16} {1:10.0f} stanzas/sec {2:8.1f} MB/sec'.format(
+            label, count / t, len(data) / t / 1e6))
+
+
+def main():
+    bench_escape()
+    bench_memory()
+    bench_namespace()
+    bench_index()
+    bench_filters()
+
+
+if __name__ == '__main__':
+    main()
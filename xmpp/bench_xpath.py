@@ -0,0 +1,78 @@
+"""
+Benchmarks for compiled paths against the equivalent get_tags chains.
+
+    python -m agent.xmpp.bench_xpath
+
+"""
+import timeit
+
+from agent.xmpp.xmlutil import Node
+from agent.xmpp.xpath import compile_path, select_one
+
+MESSAGE = Node.from_string(
+    "<message from='room@muc.orvant.com/juliet' to='romeo@orvant.com' "
+    "type='groupchat' id='m1'><body>hi</body>"
+    "<delay xmlns='urn:xmpp:delay' from='room@muc.orvant.com' "
+    "stamp='2002-09-10T23:08:25Z'/>"
+    "<x xmlns='http://jabber.org/protocol/muc#user'>"
+    "<item affiliation='member' role='participant' jid='juliet@orvant.com'/>"
+    "</x></message>"
+)
+
+ROSTER = Node.from_string(
+    "<iq type='result' id='r1'><query xmlns='jabber:iq:roster'>{0}</query>"
+    "</iq>".format(''.join(
+        "<item jid='contact{0}@orvant.com' subscription='both'/>".format(i)
+        for i in range(200)
+    ))
+)
+
+def chain_delay(node):
+    delay = node.get_tags('delay', namespace='urn:xmpp:delay', one=1)
+    if delay:
+        return delay.get_attr('stamp')
+
+def chain_muc_jid(node):
+    x = node.get_tags(
+        'x', namespace='http://jabber.org/protocol/muc#user', one=1)
+    if x:
+        item = x.get_tags('item', one=1)
+        if item:
+            return item.get_attr('jid')
+
+def chain_roster_jids(node):
+    jids = []
+    for query in node.get_tags('query', namespace='jabber:iq:roster'):
+        for item in query.get_tags('item'):
+            jids.append(item.get_attr('jid'))
+    return jids
+
+DELAY = compile_path('message/delay[@xmlns=urn:xmpp:delay]/@stamp')
+MUC_JID = compile_path(
+    'message/x[@xmlns=http://jabber.org/protocol/muc#user]/item/@jid')
+ROSTER_JIDS = compile_path('iq/query[@xmlns=jabber:iq:roster]/item/@jid')
+
+CASES = [
+    ('delay stamp', MESSAGE,
+        chain_delay, DELAY.first,
+        lambda n: select_one(n, 'message/delay[@xmlns=urn:xmpp:delay]/@stamp')),
+    ('muc item jid', MESSAGE,
+        chain_muc_jid, MUC_JID.first, None),
+    ('roster jids', ROSTER,
+        chain_roster_jids, ROSTER_JIDS.all, None),
+]
+
+def main(number=20000):
+    for name, node, chain, path, lookup in CASES:
+        assert chain(node) == path(node), name
+        print(name)
+        runs = [('get_tags', chain), ('compiled', path)]
+        if lookup:
+            runs.append(('select_one', lookup))
+        n = number if node is MESSAGE else number // 100
+        for label, f in runs:
+            t = timeit.timeit(lambda: f(node), number=n)
+            print('  {0:12} {1:10.2f} usec'.format(label, t / n * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+XEP-0138 stream compression.
+
+The server lists the methods it supports in its stream features. The
+client asks for zlib, and once the server answers with compressed both
+sides compress everything that follows, starting with a new stream
+header.
+
+    if 'zlib' in methods(features):
+        stream.sendnode(compress_request())
+        transport.send_output(stream)
+        # ... wait for <compressed/>
+        transport.compress()
+        stream.restart()
+        transport.send_output(stream)
+
+Each batch of writes is finished with a sync flush so the peer can
+decompress every stanza as soon as it arrives, while the dictionary is
+kept for the whole stream.
+"""
+import zlib
+
+from agent.xmpp.xmlutil import Node
+from agent.xmpp.ns import NS_COMPRESS, NS_FEATURE_COMPRESS
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+ZLIB = 'zlib'
+LEVEL = 6
+
+class CompressionError(Exception):
+    """
+    Raise when compression can not be negotiated or the peer sends data
+    that does not decompress
+    """
+
+def methods(features):
+    """
+    Return the compression methods listed in a stream features node.
+    """
+    compression = features.find('compression', NS_FEATURE_COMPRESS)
+    if compression is None:
+        return []
+    return [
+        ''.join(i for i in method.payload if not isinstance(i, Node)).strip()
+        for method in compression.findall('method')
+    ]
+
+def compress_request(method=ZLIB):
+    return Node('compress', attrs={'xmlns': NS_COMPRESS}, payload=[
+        Node('method', payload=[method]),
+    ])
+
+def compressed(node):
+    """
+    Return True when node is the server's go ahead to start compressing,
+    raise CompressionError when it is a failure.
+    """
+    if node.namespace != NS_COMPRESS:
+        return False
+    if node.tag == 'compressed':
+        return True
+    if node.tag == 'failure':
+        reasons = [i.tag for i in node.get_children()]
+        raise CompressionError('Compression failed: {0}'.format(
+            ', '.join(reasons) or 'unknown'))
+    return False
+
+class Compressor(object):
+    """
+    Compresses outgoing and decompresses incoming bytes of one stream with
+    zlib, and counts them both ways.
+    """
+
+    def __init__(self, level=LEVEL):
+        self.level = level
+        self._compress = zlib.compressobj(level)
+        self._decompress = zlib.decompressobj()
+        self._pending = False
+        # Bytes before compression and on the wire, each way.
+        self.sent = 0
+        self.sent_wire = 0
+        self.received = 0
+        self.received_wire = 0
+
+    def compress(self, data):
+        """
+        Compress data, the output may be held back until flush.
+        """
+        self._pending = True
+        self.sent += len(data)
+        out = self._compress.compress(data)
+        self.sent_wire += len(out)
+        return out
+
+    def flush(self):
+        """
+        Return the rest of the data given to compress since the last flush,
+        ending on a byte boundary the peer can decompress up to.
+        """
+        if not self._pending:
+            return b''
+        self._pending = False
+        out = self._compress.flush(zlib.Z_SYNC_FLUSH)
+        self.sent_wire += len(out)
+        return out
+
+    def decompress(self, data):
+        self.received_wire += len(data)
+        try:
+            out = self._decompress.decompress(data)
+        except zlib.error as e:
+            raise CompressionError('Could not decompress: {0}'.format(e))
+        self.received += len(out)
+        return out
+
+    @property
+    def saved(self):
+        """
+        Bytes that did not cross the wire thanks to compression, both ways.
+        """
+        return (self.sent - self.sent_wire) + (self.received - self.received_wire)
+
+    def stats(self):
+        return {
+            'level': self.level,
+            'sent': self.sent,
+            'sent_wire': self.sent_wire,
+            'received': self.received,
+            'received_wire': self.received_wire,
+            'saved': self.saved,
+        }
@@ -0,0 +1,291 @@
+"""
+Happy eyeballs connection racing, after RFC 8305.
+
+Every address of every SRV target is a candidate. Attempts start one
+after another, attempt_delay seconds apart or as soon as the previous one
+fails, with at most concurrency of them in flight. The first socket to
+connect wins and the others are closed, so a blackholed address costs
+attempt_delay instead of a full connect timeout.
+
+    result = race(candidates([('xmpp.orvant.com', 5222)]))
+    result.sock, result.winner.address, result.elapsed
+
+Race runs the same from a caller's own loop, without blocking in it.
+
+    r = Race(candidates([('xmpp.orvant.com', 5222)]))
+    for connecting in r.steps():
+        yield connecting
+    r.result.sock
+"""
+import errno
+import os
+import select
+import socket
+import time
+
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+ATTEMPT_DELAY = 0.25
+CONCURRENCY = 4
+CONNECT_TIMEOUT = 30
+IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY)
+
+class RaceError(Exception):
+    """
+    Raise when no candidate address could be connected to
+    """
+
+    def __init__(self, message, attempts):
+        Exception.__init__(self, message)
+        self.attempts = attempts
+
+class Attempt(object):
+    """
+    A connection attempt to one address and how it went.
+    """
+
+    def __init__(self, host, port, family, address):
+        self.host = host
+        self.port = port
+        self.family = family
+        self.address = address
+        self.sock = None
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Attempt {0}:{1} {2} {3}>'.format(
+            self.host, self.port, self.address[0], self.state)
+
+    @property
+    def state(self):
+        if self.started is None:
+            return 'pending'
+        if self.finished is None:
+            return 'connecting'
+        if self.cancelled:
+            return 'cancelled'
+        if self.error is not None:
+            return 'failed'
+        return 'connected'
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+class RaceResult(object):
+    """
+    The winning socket and attempt, and all attempts made.
+    """
+
+    def __init__(self, sock, winner, attempts, elapsed):
+        self.sock = sock
+        self.winner = winner
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    def summary(self):
+        return ', '.join(
+            '{0} {1} {2}'.format(
+                i.address[0], i.state,
+                '' if i.elapsed is None else '{0:.3f}s'.format(i.elapsed)
+            ).strip()
+            for i in self.attempts
+        )
+
+def interleave(infos):
+    """
+    Alternate address families, starting with the family of the first
+    address, as RFC 8305 section 4 suggests.
+    """
+    families = []
+    byfamily = {}
+    for info in infos:
+        if info[0] not in byfamily:
+            families.append(info[0])
+        byfamily.setdefault(info[0], []).append(info)
+    ordered = []
+    while any(byfamily.values()):
+        for family in families:
+            if byfamily[family]:
+                ordered.append(byfamily[family].pop(0))
+    return ordered
+
+def candidates(targets, getaddrinfo=socket.getaddrinfo):
+    """
+    Return an Attempt for each address of each (host, port) target, in
+    target order with address families interleaved. Targets that do not
+    resolve are skipped.
+    """
+    attempts = []
+    seen = set()
+    for host, port in targets:
+        try:
+            infos = getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except (socket.gaierror, socket.herror) as e:
+            log.debug(M("Could not resolve {0}: {1}", host, e))
+            continue
+        for family, type, proto, name, address in interleave(infos):
+            if (family, address) in seen:
+                continue
+            seen.add((family, address))
+            attempts.append(Attempt(host, port, family, address))
+    return attempts
+
+def _start(attempt, socket_maker, clock):
+    attempt.started = clock()
+    try:
+        sock = attempt.sock = socket_maker(attempt.family, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex(attempt.address)
+    except socket.error as e:
+        # A family the host does not support, EAFNOSUPPORT for IPv6
+        _fail(attempt, e, clock)
+        return
+    if err and err not in IN_PROGRESS:
+        _fail(attempt, socket.error(err, os.strerror(err)), clock)
+
+def _fail(attempt, error, clock):
+    attempt.finished = clock()
+    attempt.error = error
+    if attempt.sock is not None:
+        attempt.sock.close()
+        attempt.sock = None
+
+def _wait(attempts, timeout):
+    """
+    Return the attempts whose sockets finished connecting, successfully
+    or not, within timeout seconds.
+    """
+    socks = dict((i.sock.fileno(), i) for i in attempts)
+    if hasattr(select, 'poll'):
+        poll = select.poll()
+        for fd in socks:
+            poll.register(fd, select.POLLOUT | select.POLLERR | select.POLLHUP)
+        return [socks[fd] for fd, event in poll.poll(timeout * 1000)]
+    w, x = select.select([], list(socks), list(socks), timeout)[1:]
+    return [socks[fd] for fd in set(w + x)]
+
+class Connecting(object):
+    """
+    The attempts of a race that are in flight, yielded by Race.steps. wait
+    blocks until one of them finishes connecting or until the race starts
+    its next attempt, whichever comes first.
+    """
+
+    def __init__(self, attempts, timeout):
+        self.attempts = attempts
+        self.timeout = timeout
+
+    def __repr__(self):
+        return '<Connecting {0}>'.format(
+            ', '.join(i.address[0] for i in self.attempts))
+
+    def filenos(self):
+        return [i.sock.fileno() for i in self.attempts]
+
+    def wait(self, timeout=None):
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        _wait(self.attempts, max(timeout, 0))
+
+class Race(object):
+    """
+    A race run step by step from the caller's loop. steps is a generator
+    that yields a Connecting while it waits on attempts, the caller
+    resumes it once their sockets are writable or on its next pass. When
+    it is exhausted result holds the RaceResult, it raises RaceError like
+    race does. Closing it closes the sockets of the running attempts.
+    """
+
+    def __init__(self, attempts, attempt_delay=ATTEMPT_DELAY,
+            concurrency=CONCURRENCY, timeout=CONNECT_TIMEOUT,
+            socket_maker=socket.socket, clock=time.time):
+        self.attempts = attempts
+        self.attempt_delay = attempt_delay
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.socket_maker = socket_maker
+        self.clock = clock
+        self.running = []
+        self.result = None
+
+    def steps(self):
+        try:
+            for i in self._steps():
+                yield i
+        finally:
+            for attempt in self.running:
+                if attempt.sock is not None:
+                    attempt.cancelled = True
+                    _fail(attempt, None, self.clock)
+
+    def _steps(self):
+        attempts, running, clock = self.attempts, self.running, self.clock
+        start = clock()
+        pending = list(attempts)
+        next_start = start
+        while pending or running:
+            now = clock()
+            if now - start >= self.timeout:
+                break
+            if pending and len(running) < self.concurrency and now >= next_start:
+                attempt = pending.pop(0)
+                # Running from the start, steps closes its socket on errors
+                running.append(attempt)
+                _start(attempt, self.socket_maker, clock)
+                if attempt.error is None:
+                    next_start = now + self.attempt_delay
+                else:
+                    running.remove(attempt)
+                    next_start = now
+                continue
+            if not running:
+                next_start = now
+                continue
+            wait = self.timeout - (now - start)
+            if pending and len(running) < self.concurrency:
+                wait = min(wait, next_start - now)
+            yield Connecting(list(running), wait)
+            for attempt in _wait(running, 0):
+                running.remove(attempt)
+                err = attempt.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    _fail(attempt, socket.error(err, os.strerror(err)), clock)
+                    # Start the next attempt right away
+                    next_start = clock()
+                    continue
+                attempt.finished = clock()
+                sock = attempt.sock
+                sock.setblocking(1)
+                for other in running:
+                    other.cancelled = True
+                    _fail(other, None, clock)
+                self.result = RaceResult(sock, attempt, attempts, clock() - start)
+                log.debug(M("Connected to {0} in {1:.3f}s: {2}",
+                    attempt.address, self.result.elapsed, self.result.summary()))
+                return
+        for attempt in running:
+            _fail(attempt, socket.error(errno.ETIMEDOUT, 'Timed out'), clock)
+        raise RaceError('Could not connect to any of {0} addresses'.format(
+            len(attempts)), attempts)
+
+def race(attempts, attempt_delay=ATTEMPT_DELAY, concurrency=CONCURRENCY,
+        timeout=CONNECT_TIMEOUT, socket_maker=socket.socket, clock=time.time):
+    """
+    Race connection attempts and return a RaceResult for the first socket
+    to connect, in blocking mode. The other sockets are closed, whichever
+    way the race ends. Raise RaceError when every attempt failed or timeout
+    seconds passed.
+    """
+    r = Race(attempts, attempt_delay, concurrency, timeout, socket_maker, clock)
+    for connecting in r.steps():
+        connecting.wait()
+    return r.result
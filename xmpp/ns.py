@@ -59,6 +59,7 @@ NS_DISCO_ITEMS =NS_DISCO+'#items' # XEP-0030
 NS_ENCRYPTED ='jabber:x:encrypted' # XEP-0027
 NS_EVENT ='jabber:x:event' # XEP-0022 (deprecated)
 NS_FEATURE ='http://jabber.org/protocol/feature-neg' # XEP-0020
+NS_FEATURE_COMPRESS ='http://jabber.org/features/compress' # XEP-0138
 NS_FILE ='http://jabber.org/protocol/si/profile/file-transfer' # XEP-0096
 NS_GATEWAY ='jabber:iq:gateway' # XEP-0100
 NS_GEOLOC ='http://jabber.org/protocol/geoloc' # XEP-0080
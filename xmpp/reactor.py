@@ -0,0 +1,239 @@
+"""
+A reactor driving the receive side of many transports from one selector.
+
+Each transport's sockets are registered once, a tick waits for readiness
+with epoll (or the best selector available) and steps the rawrecv
+generator of every ready transport. A tick costs the same no matter how
+many idle connections are registered.
+
+An ssl socket can hold decrypted bytes that were read from the kernel but
+not handed out yet, its fd does not turn readable for them. Transports
+left with such bytes after a step are stepped again on the next tick
+without waiting on the selector.
+
+    reactor = Reactor()
+    reactor.register(transport)
+    reactor.register_read_handler(handle_data)
+    while True:
+        reactor.tick(timeout=1)
+"""
+import select
+from collections import namedtuple
+
+from agent.xmpp.transport import TransportError
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    from selectors import DefaultSelector, EVENT_READ
+except ImportError:
+    DefaultSelector = None
+    EVENT_READ = 1
+
+SelectorKey = namedtuple('SelectorKey', ['fileobj', 'fd', 'events', 'data'])
+
+class PollSelector(object):
+    """
+    The part of selectors.DefaultSelector the reactor uses, on top of epoll
+    or poll, for Pythons without the selectors module.
+    """
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._read = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self._timeout = 1
+        else:
+            self._poll = select.poll()
+            self._read = select.POLLIN | select.POLLHUP | select.POLLERR
+            self._timeout = 1000
+        self._keys = {}
+
+    def register(self, fileobj, events, data=None):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        if fd in self._keys:
+            raise KeyError('{0} is already registered'.format(fd))
+        key = self._keys[fd] = SelectorKey(fileobj, fd, events, data)
+        self._poll.register(fd, self._read)
+        return key
+
+    def unregister(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        key = self._keys.pop(fd)
+        self._poll.unregister(fd)
+        return key
+
+    def select(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        elif timeout < 0:
+            timeout = 0
+        else:
+            timeout *= self._timeout
+        keys = self._keys
+        return [
+            (keys[fd], EVENT_READ)
+            for fd, event in self._poll.poll(timeout) if fd in keys
+        ]
+
+    def get_map(self):
+        return self._keys
+
+    def close(self):
+        if hasattr(self._poll, 'close'):
+            self._poll.close()
+        self._keys.clear()
+
+if DefaultSelector is None:
+    DefaultSelector = PollSelector
+
+class Reactor(object):
+    """
+    Dispatch socket readiness to transports. Tcp has one socket, Bosh a
+    socket per HTTP connection; call update after a transport opened or
+    dropped connections. Transports that pause reading are taken out of
+    the selector until they resume.
+    """
+
+    def __init__(self, selector=None):
+        self.selector = selector or DefaultSelector()
+        self.transports = {}
+        self.reads = {}
+        # fd: (transport, multi) for sockets with bytes in the ssl layer
+        self.buffered = {}
+        self.paused = set()
+        self.running = False
+        self.handlers = {'read': [], 'close': []}
+
+    def __len__(self):
+        return len(self.transports)
+
+    def register(self, transport):
+        """
+        Watch all of transport's sockets.
+        """
+        self.transports[transport] = set()
+        self.update(transport)
+
+    def unregister(self, transport):
+        for fd in self.transports.pop(transport, ()):
+            self._unwatch(fd)
+        self.paused.discard(transport)
+
+    def update(self, transport):
+        """
+        Bring the watched sockets of transport in line with its fileno.
+        """
+        watched = self.transports[transport]
+        filenos = transport.fileno()
+        multi = isinstance(filenos, list)
+        if not multi:
+            filenos = [filenos]
+        filenos = set(filenos)
+        if transport in self.paused:
+            watched.clear()
+            watched.update(filenos)
+            return
+        for fd in watched - filenos:
+            self._unwatch(fd)
+        for fd in filenos - watched:
+            self.selector.register(fd, EVENT_READ, (transport, multi))
+        watched.clear()
+        watched.update(filenos)
+
+    def _unwatch(self, fd):
+        self.reads.pop(fd, None)
+        self.buffered.pop(fd, None)
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def register_read_handler(self, handler):
+        self.handlers['read'].append(handler)
+
+    def unregister_read_handler(self, handler):
+        self.handlers['read'].remove(handler)
+
+    def register_close_handler(self, handler):
+        self.handlers['close'].append(handler)
+
+    def unregister_close_handler(self, handler):
+        self.handlers['close'].remove(handler)
+
+    def tick(self, timeout=0):
+        """
+        Wait up to timeout seconds for ready sockets and step the rawrecv
+        generator of each ready transport once, starting a new one when
+        none is in progress. Return the number of sockets handled.
+        """
+        if self.paused:
+            self._resume()
+        buffered, self.buffered = self.buffered, {}
+        if buffered:
+            timeout = 0
+        events = self.selector.select(timeout)
+        ready = [(key.fd, key.data) for key, mask in events]
+        for key, mask in events:
+            buffered.pop(key.fd, None)
+        ready.extend(buffered.items())
+        for fd, (transport, multi) in ready:
+            if transport in self.paused or transport not in self.transports:
+                continue
+            if not transport.reading:
+                self._pause(transport)
+                continue
+            self._step(transport, fd, multi)
+        return len(ready)
+
+    def run(self, timeout=1):
+        self.running = True
+        while self.running and self.transports:
+            self.tick(timeout)
+
+    def stop(self):
+        self.running = False
+
+    def _step(self, transport, fd, multi):
+        gen = self.reads.get(fd)
+        if gen is None:
+            if multi:
+                gen = transport.rawrecv(sock=fd)
+            else:
+                gen = transport.rawrecv()
+        try:
+            next(gen)
+        except StopIteration:
+            self.reads.pop(fd, None)
+        except (TransportError, EnvironmentError) as e:
+            log.debug(M("Transport {0} closed: {1}", transport, e))
+            self.unregister(transport)
+            for handler in self.handlers['close']:
+                handler(transport, e)
+            return
+        else:
+            self.reads[fd] = gen
+        if getattr(transport, 'ssl_pending', 0):
+            self.buffered[fd] = (transport, multi)
+        if multi:
+            self.update(transport)
+        for handler in self.handlers['read']:
+            handler(transport)
+
+    def _pause(self, transport):
+        for fd in self.transports[transport]:
+            self._unwatch(fd)
+        self.paused.add(transport)
+
+    def _resume(self):
+        for transport in [i for i in self.paused if i.reading]:
+            self.paused.discard(transport)
+            self.transports[transport] = set()
+            self.update(transport)
+
+    def close(self):
+        for transport in list(self.transports):
+            self.unregister(transport)
+        self.selector.close()
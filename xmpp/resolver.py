@@ -0,0 +1,209 @@
+"""
+Non-blocking name resolution on a bounded pool of threads.
+
+Blocking lookups, getaddrinfo, resolve_host and SRV queries, are handed
+to a few worker threads and return a Lookup right away. A single
+threaded loop checks Lookup.done on each pass, or watches the resolver's
+fileno, which turns readable whenever a lookup completes.
+
+    lookup = resolver.getaddrinfo('orvant.com', 5222)
+    while not lookup.done:
+        yield lookup
+    infos = lookup.result()
+"""
+import os
+import fcntl
+import socket
+import threading
+import time
+from Queue import Queue
+
+from agent.xmpp.srv import srv_cache
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+WORKERS = 4
+
+class ResolveError(Exception):
+    """
+    Raise when a lookup did not produce a result
+    """
+
+class ResolveTimeout(ResolveError):
+    """
+    Raise when a lookup did not finish in time
+    """
+
+class ResolveCancelled(ResolveError):
+    """
+    Raise for the result of a cancelled lookup
+    """
+
+class Lookup(object):
+    """
+    The pending result of a function run on the resolver's threads.
+    """
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = False
+        self.cancelled = False
+        self.started = None
+        self.finished = None
+        self._result = None
+        self._error = None
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return '<Lookup {0}{1} {2}>'.format(
+            getattr(self.func, '__name__', self.func), self.args,
+            'done' if self.done else 'pending')
+
+    def run(self):
+        if self.cancelled:
+            return
+        self.started = time.time()
+        try:
+            result = self.func(*self.args)
+        except Exception as e:
+            log.debug(M("Lookup {0} failed: {1}", self, e))
+            self._finish(None, e)
+        else:
+            self._finish(result, None)
+
+    def _finish(self, result, error):
+        if self.done:
+            return
+        self._result = result
+        self._error = error
+        self.finished = time.time()
+        self.done = True
+        self._event.set()
+
+    def cancel(self):
+        """
+        Give up on the lookup. One that has not started is skipped, the
+        result of a running one is thrown away.
+        """
+        if self.done:
+            return False
+        self.cancelled = True
+        self._finish(None, ResolveCancelled(repr(self)))
+        return True
+
+    def wait(self, timeout=None):
+        """
+        Block until the lookup is done, raise ResolveTimeout when it is not
+        done within timeout seconds.
+        """
+        if not self._event.wait(timeout) and not self.done:
+            raise ResolveTimeout(repr(self))
+
+    def result(self, timeout=None):
+        """
+        Return the result, waiting up to timeout seconds for it. Raise the
+        error of a lookup that failed.
+        """
+        self.wait(timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class Resolver(object):
+    """
+    Run lookups on at most workers daemon threads, started as needed.
+    """
+
+    def __init__(self, workers=WORKERS, getaddrinfo=socket.getaddrinfo,
+            srv=srv_cache):
+        self.workers = workers
+        self._getaddrinfo = getaddrinfo
+        self._srv = srv
+        self.queue = Queue()
+        self.threads = []
+        self.busy = 0
+        self.lock = threading.Lock()
+        self._wakeup = None
+
+    def submit(self, func, *args):
+        """
+        Run func(*args) on a worker and return its Lookup.
+        """
+        lookup = Lookup(func, args)
+        self.queue.put(lookup)
+        with self.lock:
+            self.threads = [i for i in self.threads if i.is_alive()]
+            idle = len(self.threads) - self.busy
+            if len(self.threads) < self.workers and self.queue.qsize() > idle:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                self.threads.append(thread)
+                thread.start()
+        return lookup
+
+    def _work(self):
+        while True:
+            lookup = self.queue.get()
+            if lookup is None:
+                break
+            with self.lock:
+                self.busy += 1
+            try:
+                lookup.run()
+            finally:
+                with self.lock:
+                    self.busy -= 1
+            self._wake()
+
+    def getaddrinfo(self, host, port, family=0, type=socket.SOCK_STREAM):
+        return self.submit(self._getaddrinfo, host, port, family, type)
+
+    def srv_targets(self, name):
+        return self.submit(self._srv.targets, name)
+
+    def fileno(self):
+        """
+        A file descriptor that turns readable when a lookup completes, call
+        drain once it did.
+        """
+        if self._wakeup is None:
+            self._wakeup = os.pipe()
+            for fd in self._wakeup:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        return self._wakeup[0]
+
+    def drain(self):
+        if self._wakeup is not None:
+            try:
+                os.read(self._wakeup[0], 4096)
+            except OSError:
+                pass
+
+    def _wake(self):
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], b'.')
+            except OSError:
+                # The pipe is full, the reader is awake already
+                pass
+
+    def shutdown(self):
+        """
+        Stop the workers once the queued lookups are done.
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        if self._wakeup is not None:
+            for fd in self._wakeup:
+                os.close(fd)
+            self._wakeup = None
+
+resolver = Resolver()
@@ -0,0 +1,206 @@
+"""
+DNS SRV lookups with a process wide cache.
+
+Answers are cached for their TTL so reconnecting accounts share a single
+query per name, and only one query per name is in flight at a time. The
+targets of a name are ordered as RFC 2782 describes: by priority, and
+randomly by weight within a priority. Callers should try them in that
+order.
+
+    for host, port in srv_cache.targets('_xmpp-client._tcp.orvant.com'):
+        ...
+
+A resolver is a callable taking the query name and returning a list of
+SrvRecord and the TTL of the answer. It raises NameNotFound when the name
+does not exist and SrvError for other failures. One is picked from the
+DNS libraries installed, dnspython or pydns.
+"""
+import random
+import threading
+import time
+from collections import namedtuple
+
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+try:
+    import dns.resolver
+    import dns.exception
+    HAVE_DNSPYTHON = True
+except ImportError:
+    HAVE_DNSPYTHON = False
+
+try:
+    import DNS
+    HAVE_PYDNS = True
+except ImportError:
+    HAVE_PYDNS = False
+
+# Bounds for how long answers are cached, in seconds, and how long a
+# failed or empty lookup is remembered.
+MIN_TTL = 30
+MAX_TTL = 86400
+NEGATIVE_TTL = 60
+
+SrvRecord = namedtuple('SrvRecord', ['priority', 'weight', 'port', 'target'])
+
+class SrvError(Exception):
+    """
+    Raise when a SRV lookup fails
+    """
+
+class NameNotFound(SrvError):
+    """
+    Raise when the queried name does not exist
+    """
+
+def dnspython_resolver(name):
+    # dnspython 2 renamed query to resolve
+    query = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+    try:
+        answer = query(name, 'SRV')
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+        raise NameNotFound(name)
+    except dns.exception.DNSException as e:
+        raise SrvError('{0}: {1}'.format(name, e))
+    records = [
+        SrvRecord(i.priority, i.weight, i.port, str(i.target).rstrip('.'))
+        for i in answer
+    ]
+    return records, answer.rrset.ttl
+
+_pydns_discovered = False
+
+def pydns_resolver(name):
+    global _pydns_discovered
+    # Discovering the name servers reads resolv.conf, do it once.
+    if not _pydns_discovered:
+        DNS.DiscoverNameServers()
+        _pydns_discovered = True
+    try:
+        response = DNS.Request().req(name, qtype='SRV')
+    except DNS.DNSError as e:
+        raise SrvError('{0}: {1}'.format(name, e))
+    if response.header['status'] == 'NXDOMAIN':
+        raise NameNotFound(name)
+    records = []
+    ttl = MAX_TTL
+    for answer in response.answers:
+        priority, weight, port, target = answer['data']
+        records.append(SrvRecord(priority, weight, int(port), target))
+        ttl = min(ttl, answer['ttl'])
+    return records, ttl
+
+def default_resolver():
+    if HAVE_DNSPYTHON:
+        return dnspython_resolver
+    if HAVE_PYDNS:
+        return pydns_resolver
+    return None
+
+def order(records, rng=random):
+    """
+    Return the records in the order RFC 2782 says to try them: ascending
+    priority and, within a priority, a weighted random order in which
+    records with weight 0 have a small chance to come first.
+    """
+    if len(records) == 1 and records[0].target in ('', '.'):
+        # The service is decidedly not available at this domain
+        return []
+    ordered = []
+    priorities = {}
+    for record in records:
+        priorities.setdefault(record.priority, []).append(record)
+    for priority in sorted(priorities):
+        group = priorities[priority]
+        rng.shuffle(group)
+        group.sort(key=lambda i: i.weight != 0)
+        while group:
+            total = sum(i.weight for i in group)
+            pick = rng.randint(0, total)
+            running = 0
+            for i, record in enumerate(group):
+                running += record.weight
+                if running >= pick:
+                    break
+            ordered.append(group.pop(i))
+    return ordered
+
+class SrvCache(object):
+    """
+    A cache of SRV answers that respects their TTLs.
+    """
+
+    def __init__(self, resolver=None, clock=time.time, min_ttl=MIN_TTL,
+            max_ttl=MAX_TTL, negative_ttl=NEGATIVE_TTL):
+        self.resolver = resolver
+        self.clock = clock
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def lookup(self, name):
+        """
+        Return the SRV records of name, from the cache while they are
+        fresh. A name that does not exist or fails to resolve gives an
+        empty list, which is cached for negative_ttl seconds.
+        """
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] > self.clock():
+            return entry[1]
+        with self.lock:
+            lock = self.pending.setdefault(name, threading.Lock())
+        with lock:
+            # Another thread may have resolved name while this one waited
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] > self.clock():
+                return entry[1]
+            records, ttl = self._resolve(name)
+            self.entries[name] = (self.clock() + ttl, records)
+        with self.lock:
+            self.pending.pop(name, None)
+        return records
+
+    def _resolve(self, name):
+        resolver = self.resolver or default_resolver()
+        if resolver is None:
+            log.debug(
+                "Could not load one of the supported DNS libraries "
+                "(dnspython or pydns). SRV records will not be queried "
+                "and you may need to set custom hostname/port for some "
+                "servers to be accessible",
+            )
+            return [], self.max_ttl
+        try:
+            records, ttl = resolver(name)
+        except NameNotFound:
+            log.debug(M("No SRV records for {0}", name))
+            return [], self.negative_ttl
+        except SrvError as e:
+            log.debug(M("An error occurred while looking up {0}: {1}", name, e))
+            return [], self.negative_ttl
+        if not records:
+            return [], self.negative_ttl
+        return records, max(self.min_ttl, min(ttl, self.max_ttl))
+
+    def targets(self, name, rng=random):
+        """
+        Return the (host, port) pairs of name in the order to try them.
+        """
+        return [(i.target, i.port) for i in order(self.lookup(name), rng)]
+
+    def invalidate(self, name=None):
+        """
+        Drop name from the cache, or everything when name is None.
+        """
+        if name is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(name, None)
+
+srv_cache = SrvCache()
@@ -1,9 +1,10 @@
-from agent.xmpp.xmlutil import Node, DOCHEAD, XmlParser
+from agent.xmpp.xmlutil import Node, DOCHEAD, XmlParser, SKIP, RAW
 from ns import NS_STREAMS, NS_SASL, NS_TLS, NS_BIND, NS_CLIENT
 import random
 import bisect
 import base64
 import time
+from collections import deque
 from agent.util import M, routine, IdGen
 
 
@@ -11,11 +12,80 @@ from Queue import Queue
 import logging
 log = logging.getLogger(__name__)
 
+# Default (high, low) watermarks of the stanza queues.
+WATERMARKS = (1000, 250)
 
 
 class StreamError(Exception): pass
 
 
+class StanzaQueue(deque):
+    """
+    A deque of stanzas with high and low watermarks. The queue turns full
+    once it holds high items and stays full until it is drained down to
+    low items, the handlers registered for each transition are called with
+    the queue. A high watermark of 0 never fills the queue.
+    """
+
+    def __init__(self, high=0, low=0):
+        deque.__init__(self)
+        self.high = high
+        self.low = low
+        self.full = False
+        self.handlers = {'full': [], 'drain': []}
+
+    def append(self, item):
+        deque.append(self, item)
+        if self.high and not self.full and len(self) >= self.high:
+            self.full = True
+            for handler in self.handlers['full']:
+                handler(self)
+
+    def popleft(self):
+        item = deque.popleft(self)
+        self._drained()
+        return item
+
+    def pop(self):
+        item = deque.pop(self)
+        self._drained()
+        return item
+
+    def popmany(self, n=None):
+        """
+        Remove and return a list of up to n items from the left, all of
+        them when n is None.
+        """
+        if n is None or n > len(self):
+            n = len(self)
+        popleft = deque.popleft
+        items = [popleft(self) for i in range(n)]
+        self._drained()
+        return items
+
+    def clear(self):
+        deque.clear(self)
+        self._drained()
+
+    def _drained(self):
+        if self.full and len(self) <= self.low:
+            self.full = False
+            for handler in self.handlers['drain']:
+                handler(self)
+
+    def register_full_handler(self, handler):
+        self.handlers['full'].append(handler)
+
+    def unregister_full_handler(self, handler):
+        self.handlers['full'].remove(handler)
+
+    def register_drain_handler(self, handler):
+        self.handlers['drain'].append(handler)
+
+    def unregister_drain_handler(self, handler):
+        self.handlers['drain'].remove(handler)
+
+
 def node_builder(parser, tag, attrs, level):
     return Node(tag, attrs)
 
@@ -28,16 +98,29 @@ class Stream(object):
 
     def __init__(
             self, to=None, frm=None, session_id=None, xml_lang='en', attrs={},
-            xmlns=NS_CLIENT, parser_cls=XmlParser, started=False):
+            xmlns=NS_CLIENT, parser_cls=XmlParser, started=False, lazy=False,
+            parse_filters=(), transport=None, input_watermarks=WATERMARKS,
+            output_watermarks=WATERMARKS):
         self.to = to
         self.frm = frm
         self.session_id = session_id
         self.xml_lang = xml_lang
         self.attrs = attrs or {}
+        # Build received stanzas as LazyNodes, only parsed beyond their
+        # top level attributes when the payload is used.
+        self.lazy = lazy
+        # (tag, namespace, action) filters for the input parser, see
+        # XmlParser.register_filter.
+        self.parse_filters = list(parse_filters)
 
         self.parser_cls = parser_cls
-        self.input_buffer = []
-        self.output_buffer = []
+        self.transport = transport
+        # Reading from the transport is paused while the input buffer is
+        # full, producers can check output_buffer.full before sending.
+        self.input_buffer = StanzaQueue(*input_watermarks)
+        self.input_buffer.register_full_handler(self.pause_input)
+        self.input_buffer.register_drain_handler(self.resume_input)
+        self.output_buffer = StanzaQueue(*output_watermarks)
         self.configure_new_parsers()
         self.started = False # False, to, or frm
         self.xmlns = xmlns
@@ -49,14 +132,28 @@ class Stream(object):
 
         """
         self.input_parser = self.parser_cls()
+        self._input_root = None
         self.input_parser.register_start_handler(self.input_node_start)
         self.input_parser.register_end_handler(self.input_node_end)
         self.input_parser.set_node_builder(node_builder)
-
-        self.output_parser = self.parser_cls()
-        self.output_parser.register_start_handler(self.output_node_start)
-        self.output_parser.register_end_handler(self.output_node_end)
-        self.output_parser.set_node_builder(node_builder)
+        if self.lazy:
+            self.input_parser.set_lazy_level(2)
+        for tag, namespace, action in self.parse_filters:
+            self.input_parser.register_filter(tag, namespace, action)
+
+        # Outbound nodes are already built, there is no need to parse them
+        # back. sendnode hands them straight to output_node_start and
+        # output_node_end.
+        self.output_parser = None
+        self._output_open = False
+
+    def register_parse_filter(self, tag=None, namespace=None, action=SKIP):
+        """
+        Filter subtrees out of received stanzas, the filter is kept across
+        stream restarts.
+        """
+        self.parse_filters.append((tag, namespace, action))
+        self.input_parser.register_filter(tag, namespace, action)
 
     def header(self):
         """
@@ -88,10 +185,18 @@ class Stream(object):
 
     def recvnode(self):
         if self.input_buffer:
-            data = self.input_buffer.pop(0)
-            log.debug(M("Receive Node: {}", data.to_string()))
+            data = self.input_buffer.popleft()
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(M("Receive Node: {}", data.to_string()))
             return data
 
+    def recvnodes(self, max_n=None):
+        """
+        Return a list of up to max_n received nodes, all of them when max_n
+        is None.
+        """
+        return self.input_buffer.popmany(max_n)
+
     def sendnode(self, node):
         msgid = None
         if node.tag in ('message', 'presence', 'iq',) \
@@ -99,16 +204,33 @@ class Stream(object):
             node.attrs['id'] = self.message_id()
         if 'id' in node.attrs:
             msgid = node.attrs['id']
-        data = node.to_string()
-        log.debug(M("Send Node: {}", data))
-        if node.tag == 'stream':
-            data = data.replace('/>', '>')
-        self.output_parser.parse(data)
+        if not self._output_open:
+            self.output_node_start('output', 1, node)
+        elif node.tag == 'stream':
+            log.debug(M("Stream already open, not sending: {}", node))
+        else:
+            self.output_node_end('output', 2, node)
         return msgid
 
     def getoutput(self):
         if self.output_buffer:
-            return self.output_buffer.pop(0)
+            return self.output_buffer.popleft()
+
+    def getoutput_all(self):
+        """
+        Return a list of all pending output.
+        """
+        return self.output_buffer.popmany()
+
+    def pause_input(self, queue=None):
+        log.debug(M("Input buffer full, pausing reads: {0}", len(self.input_buffer)))
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume_input(self, queue=None):
+        log.debug(M("Input buffer drained, resuming reads: {0}", len(self.input_buffer)))
+        if self.transport is not None:
+            self.transport.resume_reading()
 
     def start(self):
         assert self.to
@@ -168,6 +290,7 @@ class Stream(object):
             if 'to' in node.attrs and node.attrs['to'] != self.frm:
                 log.warn(M("Stream header to does not match, expected {0}, got {1}",
                 self.frm, node.attrs['to']))
+        self._input_root = node
         self.input_parser.unregister_start_handler(self.input_node_start)
 
     def output_node_start(self, name, level, node):
@@ -196,17 +319,24 @@ class Stream(object):
             #if self.to != node.attrs['to']:
             #    log.warn(M("Stream header to does not match, expected {0}, got {1}",
             #        self.to, node.attrs['to']))
-        self.output_parser.unregister_start_handler(self.output_node_start)
+        self._output_open = True
 
     def input_node_end(self, name, level, node):
         if level != 2:
             return
+        # The stream root would otherwise hold on to every stanza and
+        # whitespace keepalive received over the life of the stream.
+        root = self._input_root
+        if root is not None and root._payload:
+            del root._payload[:]
         self.input_buffer.append(node)
 
     def output_node_end(self, name, level, node):
         if level != 2:
             return
-        self.output_buffer.append(node.to_string())
+        data = node.to_string()
+        log.debug(M("Send Node: {}", data))
+        self.output_buffer.append(data)
 
     def bound(self):
         return self._features_handler not in list(self.handlers)
@@ -0,0 +1,179 @@
+from agent.xmpp.aio import *
+from agent.xmpp.stream import Stream
+from agent.xmpp.xmlutil import Node
+from agent.xmpp.testutil import (
+    serve_stream, make_cert, SERVER_HEADER, FEATURES, STARTTLS, PROCEED,
+)
+from distutils.spawn import find_executable
+import unittest
+import tempfile
+import threading
+import shutil
+import socket
+import ssl
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+HEADER_IN = (
+    "<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+    "xmlns:stream='http://etherx.jabber.org/streams' from='orvant.com' "
+    "id='s1' version='1.0'>"
+)
+
+def tls_server(sock, certfile, keyfile):
+    """
+    A blocking stand-in server for one client: offer STARTTLS, wrap the
+    connection after proceed and echo the first stanza of the new stream.
+    """
+    conn, addr = sock.accept()
+    data = b''
+    while b'<starttls' not in data:
+        data += conn.recv(4096)
+        if data.count(b'<stream:stream') == 1 and b'features' not in data:
+            conn.sendall(SERVER_HEADER.format(1) + FEATURES.format(STARTTLS))
+            data += b'features'
+    conn.sendall(PROCEED)
+    conn = ssl.wrap_socket(
+        conn, server_side=True, certfile=certfile, keyfile=keyfile)
+    data = b''
+    while b'<stream:stream' not in data:
+        data += conn.recv(4096)
+    conn.sendall(SERVER_HEADER.format(2) + FEATURES.format(''))
+    data = b''
+    while b'</message>' not in data:
+        data += conn.recv(4096)
+    conn.sendall(data[data.index(b'<message'):])
+    conn.recv(4096)
+    conn.close()
+
+class TestStreamProtocol(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stream = Stream(
+            to='orvant.com', frm='agent@orvant.com', input_watermarks=(2, 0))
+        self.protocol = StreamProtocol(self.stream, self.loop)
+        self.transport = Mock()
+        self.protocol.connection_made(self.transport)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_protocol_recv_stanza(self):
+        assert self.stream.transport is self.protocol
+        assert self.protocol.connected.result() is self.protocol
+        first = self.protocol.recv_stanza()
+        assert not first.done()
+        self.protocol.data_received(HEADER_IN + "<presence/><iq type='get'")
+        assert first.result().tag == 'presence'
+        self.protocol.data_received("/><message/>")
+        assert self.protocol.recv_stanza().result().tag == 'iq'
+        assert self.protocol.recv_stanza().result().tag == 'message'
+
+    def test_protocol_pause_reading(self):
+        self.protocol.data_received(HEADER_IN + "<presence/><presence/>")
+        self.transport.pause_reading.assert_called_once_with()
+        self.protocol.recv_stanza()
+        assert not self.transport.resume_reading.called
+        self.protocol.recv_stanza()
+        self.transport.resume_reading.assert_called_once_with()
+
+    def test_protocol_send_stanza(self):
+        self.protocol.start()
+        header = self.transport.writelines.call_args[0][0]
+        assert header[0].startswith(b"<?xml version='1.0'?><stream:stream")
+        self.protocol.pause_writing()
+        node = Node('presence')
+        sent = self.protocol.send_stanza(node)
+        data = self.transport.writelines.call_args[0][0]
+        assert data[0].startswith(b'<presence')
+        assert not sent.done()
+        self.protocol.resume_writing()
+        assert self.loop.run_until_complete(sent) == node.get_attr('id')
+
+    def test_protocol_starttls_start_tls(self):
+        tls_transport = Mock()
+        upgraded = asyncio.Future(loop=self.loop)
+        upgraded.set_result(tls_transport)
+        self.loop.start_tls = Mock(return_value=upgraded)
+        context = Mock()
+        self.protocol.start()
+        done = self.protocol.starttls(context)
+        data = self.transport.writelines.call_args[0][0]
+        assert data[0].startswith(b'<starttls')
+        self.protocol.data_received(HEADER_IN + PROCEED)
+        assert self.loop.run_until_complete(done) is self.protocol
+        self.loop.start_tls.assert_called_once_with(
+            self.transport, self.protocol, context,
+            server_hostname='orvant.com')
+        assert not self.transport.abort.called
+        # The restarted stream goes over the TLS transport
+        assert self.protocol.transport is tls_transport
+        header = tls_transport.writelines.call_args[0][0]
+        assert header[0].startswith(b"<?xml version='1.0'?><stream:stream")
+
+    def test_protocol_connection_lost(self):
+        waiter = self.protocol.recv_stanza()
+        self.protocol.connection_lost(None)
+        assert isinstance(waiter.exception(), TransportError)
+        assert self.protocol.closed.done()
+        assert isinstance(
+            self.protocol.recv_stanza().exception(), TransportError)
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_connect_echo(self):
+        server, port = serve_stream(self.loop)
+        stream = Stream(to='orvant.com', frm='agent@orvant.com')
+        protocol = self.loop.run_until_complete(
+            connect(stream, '127.0.0.1', port, loop=self.loop))
+        features = self.loop.run_until_complete(protocol.recv_stanza())
+        assert features.tag == 'features'
+        assert stream.session_id == '1'
+        msgid = self.loop.run_until_complete(
+            protocol.send_stanza(Node('message', payload=['hi'])))
+        echo = self.loop.run_until_complete(protocol.recv_stanza())
+        assert echo.get_attr('id') == str(msgid)
+        assert echo.payload == ['hi']
+        self.loop.run_until_complete(protocol.close())
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+
+    @unittest.skipUnless(find_executable('openssl'), 'needs openssl')
+    def test_connect_starttls(self):
+        tmp = tempfile.mkdtemp()
+        certfile, keyfile = make_cert(tmp)
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        server = threading.Thread(
+            target=tls_server, args=(sock, certfile, keyfile))
+        server.start()
+        try:
+            stream = Stream(to='orvant.com', frm='agent@orvant.com')
+            protocol = self.loop.run_until_complete(connect(
+                stream, '127.0.0.1', sock.getsockname()[1], loop=self.loop))
+            features = self.loop.run_until_complete(protocol.recv_stanza())
+            assert features.get_tags('starttls')
+            context = ssl.create_default_context(cafile=certfile)
+            self.loop.run_until_complete(protocol.starttls(context))
+            assert protocol.transport.get_extra_info('sslcontext') is context
+            features = self.loop.run_until_complete(protocol.recv_stanza())
+            assert not features.get_tags('starttls')
+            msgid = self.loop.run_until_complete(
+                protocol.send_stanza(Node('message', payload=['hi'])))
+            echo = self.loop.run_until_complete(protocol.recv_stanza())
+            assert echo.get_attr('id') == str(msgid)
+            self.loop.run_until_complete(protocol.close())
+        finally:
+            server.join()
+            sock.close()
+            shutil.rmtree(tmp)
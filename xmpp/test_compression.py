@@ -0,0 +1,168 @@
+from agent.xmpp.compression import *
+from agent.xmpp.transport import Tcp
+from agent.xmpp.stream import Stream
+from agent.xmpp.xmlutil import Node
+import unittest
+import socket
+import threading
+import zlib
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+HEADER_IN = (
+    "<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+    "xmlns:stream='http://etherx.jabber.org/streams' from='orvant.com' "
+    "id='s1' version='1.0'>"
+)
+FEATURES = (
+    "<stream:features><compression xmlns='http://jabber.org/features/compress'>"
+    "<method>zlib</method></compression></stream:features>"
+)
+COMPRESSED = "<compressed xmlns='http://jabber.org/protocol/compress'/>"
+ITEM = (
+    "<item jid='bot{0}@orvant.com' name='Bot {0}' subscription='both'>"
+    "<group>Bots</group></item>"
+)
+ROSTER = (
+    "<iq type='result' id='r1'><query xmlns='jabber:iq:roster'>" +
+    ''.join(ITEM.format(i) for i in range(200)) + "</query></iq>"
+)
+MESSAGE = (
+    "<message to='bob@orvant.com' type='chat'><body>"
+    "status report: all systems nominal</body></message>"
+)
+
+class StandInServer(threading.Thread):
+    """
+    Negotiates zlib compression on one end of a socket pair, answers the
+    compressed stream with a roster and keeps what the client sent.
+    """
+
+    def __init__(self, sock, messages):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = sock
+        self.messages = messages
+        self.received = ''
+        self.wire = 0
+
+    def read_until(self, marker, decompress=None):
+        data = ''
+        while marker not in data:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise EOFError(marker)
+            self.wire += len(chunk)
+            if decompress is not None:
+                chunk = decompress.decompress(chunk)
+            data += chunk
+        return data
+
+    def run(self):
+        self.read_until('<stream:stream')
+        self.sock.sendall(HEADER_IN + FEATURES)
+        self.read_until('</compress>')
+        self.sock.sendall(COMPRESSED)
+        self.wire = 0
+        inflate = zlib.decompressobj()
+        deflate = zlib.compressobj()
+        self.read_until('<stream:stream', inflate)
+        out = deflate.compress(HEADER_IN + '<stream:features/>' + ROSTER)
+        self.sock.sendall(out + deflate.flush(zlib.Z_SYNC_FLUSH))
+        data = ''
+        while data.count('</message>') < self.messages:
+            data += self.read_until('</message>', inflate)
+        self.received = data
+
+def pump(transport, stream, count):
+    nodes = []
+    while len(nodes) < count:
+        assert transport.pending_data(timeout=2)
+        for i in transport.rawrecv():
+            pass
+        nodes.extend(stream.recvnodes())
+    return nodes
+
+class TestCompression(unittest.TestCase):
+
+    def test_compression_methods(self):
+        features = Node.from_string(FEATURES)
+        assert methods(features) == ['zlib']
+        assert methods(Node.from_string('<stream:features/>')) == []
+
+    def test_compression_request(self):
+        request = compress_request()
+        assert request.namespace == NS_COMPRESS
+        assert request.find('method').payload == ['zlib']
+
+    def test_compression_failure(self):
+        assert compressed(Node.from_string(COMPRESSED))
+        failure = Node.from_string(
+            "<failure xmlns='http://jabber.org/protocol/compress'>"
+            "<unsupported-method/></failure>")
+        self.assertRaises(CompressionError, compressed, failure)
+
+    def test_compressor_roundtrip(self):
+        compressor = Compressor(level=9)
+        inflate = zlib.decompressobj()
+        out = compressor.compress(ROSTER) + compressor.flush()
+        assert inflate.decompress(out) == ROSTER
+        assert compressor.flush() == ''
+        assert compressor.sent == len(ROSTER)
+        assert compressor.sent_wire == len(out)
+        assert compressor.saved > len(ROSTER) // 2
+
+    def test_compressor_corrupt(self):
+        compressor = Compressor()
+        self.assertRaises(CompressionError, compressor.decompress, 'not zlib')
+
+    def test_tcp_compress_batch(self):
+        t = Tcp('orvant.com')
+        t._sock = Mock()
+        t._sock.send.side_effect = len
+        del t._sock.sendmsg
+        t.compress()
+        for i in range(10):
+            t.write(MESSAGE)
+        assert not t._sock.send.called
+        t.flush()
+        assert t._sock.send.call_count == 1
+        data = t._sock.send.call_args[0][0]
+        assert zlib.decompressobj().decompress(data) == MESSAGE * 10
+        assert data.endswith('\x00\x00\xff\xff')
+        assert t.flush() == 0
+
+    def test_tcp_compress_stand_in(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        server = StandInServer(a, messages=50)
+        server.start()
+        t = Tcp('orvant.com')
+        t._sock = b
+        stream = Stream(to='orvant.com', frm='agent@orvant.com')
+        t.bind(stream)
+        stream.start()
+        t.send_output(stream)
+        features = pump(t, stream, 1)[0]
+        assert methods(features) == ['zlib']
+        stream.sendnode(compress_request())
+        t.send_output(stream)
+        assert compressed(pump(t, stream, 1)[0])
+        compressor = t.compress(level=9)
+        stream.restart()
+        t.send_output(stream)
+        features, roster = pump(t, stream, 2)
+        assert len(roster.find('query').findall('item')) == 200
+        for i in range(50):
+            stream.sendnode(Node.from_string(MESSAGE))
+        t.send_output(stream)
+        server.join(2)
+        assert server.received.count('<body>') == 50
+        stats = compressor.stats()
+        assert stats['sent_wire'] == server.wire
+        assert stats['received'] > len(ROSTER)
+        assert stats['received_wire'] < stats['received'] // 4
+        assert stats['saved'] > 0
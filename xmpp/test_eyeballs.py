@@ -0,0 +1,188 @@
+from agent.xmpp.eyeballs import *
+from agent.xmpp.transport import Tcp
+import unittest
+import errno
+import socket
+import time
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+def listener():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    return sock
+
+def blackhole():
+    """
+    A listener whose accept queue is full, connections to it hang.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(0)
+    fill = []
+    for i in range(3):
+        s = socket.socket()
+        s.setblocking(0)
+        s.connect_ex(sock.getsockname())
+        fill.append(s)
+    time.sleep(.05)
+    return sock, fill
+
+def refused():
+    """
+    An address nothing listens on, connections to it are refused.
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+def attempt(address):
+    return Attempt('orvant.com', address[1], socket.AF_INET, address)
+
+class TestEyeballs(unittest.TestCase):
+
+    def setUp(self):
+        self.sockets = []
+
+    def tearDown(self):
+        for i in self.sockets:
+            i.close()
+
+    def test_race_blackhole(self):
+        hole, fill = blackhole()
+        good = listener()
+        self.sockets.extend([hole, good] + fill)
+        attempts = [attempt(hole.getsockname()), attempt(good.getsockname())]
+        result = race(attempts, attempt_delay=.1, timeout=5)
+        assert result.winner is attempts[1]
+        assert result.sock.getpeername() == good.getsockname()
+        assert attempts[0].state == 'cancelled'
+        assert attempts[1].state == 'connected'
+        assert .1 <= result.elapsed < 1, result.elapsed
+        assert result.sock.gettimeout() is None
+        result.sock.close()
+
+    def test_race_refused(self):
+        good = listener()
+        self.sockets.append(good)
+        attempts = [attempt(refused()), attempt(good.getsockname())]
+        result = race(attempts, attempt_delay=2, timeout=5)
+        assert result.winner is attempts[1]
+        assert attempts[0].state == 'failed'
+        assert result.elapsed < 1, result.elapsed
+        assert 'failed' in result.summary()
+        result.sock.close()
+
+    def test_race_no_ipv6(self):
+        good = listener()
+        self.sockets.append(good)
+        def socket_maker(family, type):
+            if family == socket.AF_INET6:
+                raise socket.error(errno.EAFNOSUPPORT, 'not supported')
+            return socket.socket(family, type)
+        attempts = [
+            Attempt('orvant.com', 5222, socket.AF_INET6, ('fd00::1', 5222, 0, 0)),
+            attempt(good.getsockname()),
+        ]
+        result = race(attempts, attempt_delay=2, timeout=5,
+            socket_maker=socket_maker)
+        assert result.winner is attempts[1]
+        assert attempts[0].state == 'failed'
+        assert attempts[0].error.args[0] == errno.EAFNOSUPPORT
+        assert result.elapsed < 1, result.elapsed
+        result.sock.close()
+
+    def test_race_steps(self):
+        hole, fill = blackhole()
+        good = listener()
+        self.sockets.extend([hole, good] + fill)
+        attempts = [attempt(hole.getsockname()), attempt(good.getsockname())]
+        r = Race(attempts, attempt_delay=.1, timeout=5)
+        steps = r.steps()
+        connecting = next(steps)
+        assert isinstance(connecting, Connecting)
+        assert connecting.attempts == attempts[:1]
+        assert 0 < connecting.timeout <= .1
+        assert connecting.filenos() == [attempts[0].sock.fileno()]
+        assert r.result is None
+        for connecting in steps:
+            connecting.wait()
+        assert r.result.winner is attempts[1]
+        assert attempts[0].state == 'cancelled'
+        r.result.sock.close()
+        # Closing the steps gives up on the attempts in flight
+        attempts = [attempt(hole.getsockname())]
+        steps = Race(attempts, timeout=5).steps()
+        next(steps)
+        steps.close()
+        assert attempts[0].state == 'cancelled'
+        assert attempts[0].sock is None
+
+    def test_race_error_closes_sockets(self):
+        hole, fill = blackhole()
+        self.sockets.extend([hole] + fill)
+        made = []
+        def socket_maker(family, type):
+            if made:
+                raise ValueError('bad factory')
+            made.append(socket.socket(family, type))
+            return made[-1]
+        attempts = [attempt(hole.getsockname()), attempt(hole.getsockname())]
+        self.assertRaises(ValueError, race, attempts, attempt_delay=0,
+            timeout=5, socket_maker=socket_maker)
+        assert [i.sock for i in attempts] == [None, None]
+        assert attempts[0].state == 'cancelled'
+        self.assertRaises(socket.error, made[0].getpeername)
+
+    def test_race_concurrency(self):
+        holes = [blackhole() for i in range(3)]
+        for hole, fill in holes:
+            self.sockets.extend([hole] + fill)
+        attempts = [attempt(hole.getsockname()) for hole, fill in holes]
+        try:
+            race(attempts, attempt_delay=0, concurrency=2, timeout=.3)
+        except RaceError as e:
+            assert e.attempts == attempts
+        else:
+            assert False, 'Expected RaceError'
+        assert [i.state for i in attempts] == ['failed', 'failed', 'pending']
+
+    def test_candidates(self):
+        getaddrinfo = Mock(side_effect=lambda host, port, family, type: {
+            'a.orvant.com': [
+                (socket.AF_INET, 1, 6, '', ('10.0.0.1', port)),
+                (socket.AF_INET, 1, 6, '', ('10.0.0.2', port)),
+                (socket.AF_INET6, 1, 6, '', ('fd00::1', port, 0, 0)),
+            ],
+            'b.orvant.com': [(socket.AF_INET, 1, 6, '', ('10.0.0.3', port))],
+        }[host])
+        attempts = candidates(
+            [('a.orvant.com', 5222), ('b.orvant.com', 5223)], getaddrinfo)
+        assert [i.address[0] for i in attempts] == [
+            '10.0.0.1', 'fd00::1', '10.0.0.2', '10.0.0.3']
+        assert attempts[-1].port == 5223
+
+    def test_tcp_connect_race(self):
+        hole, fill = blackhole()
+        good = listener()
+        self.sockets.extend([hole, good] + fill)
+        getaddrinfo = Mock(return_value=[
+            (socket.AF_INET, 1, 6, '', hole.getsockname()),
+            (socket.AF_INET, 1, 6, '', good.getsockname()),
+        ])
+        t = Tcp('orvant.com', use_srv=False)
+        result = t.connect_race(attempt_delay=.05, getaddrinfo=getaddrinfo)
+        getaddrinfo.assert_called_with('orvant.com', 5222, 0, socket.SOCK_STREAM)
+        assert t.race_result is result
+        assert t._ip == '127.0.0.1'
+        conn, address = good.accept()
+        self.sockets.append(conn)
+        conn.sendall('<presence/>')
+        assert t.pending_data(timeout=1)
+        assert t.readywrite
+        t.disconnect()
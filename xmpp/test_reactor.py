@@ -0,0 +1,132 @@
+from agent.xmpp.reactor import *
+from agent.xmpp.transport import Tcp
+from agent.xmpp.stream import Stream
+import unittest
+import socket
+import ssl
+import time
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+HEADER_IN = (
+    "<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+    "xmlns:stream='http://etherx.jabber.org/streams' from='orvant.com' "
+    "id='s1' version='1.0'>"
+)
+
+def tcp_pair():
+    a, b = socket.socketpair()
+    t = Tcp('orvant.com')
+    t._sock = b
+    return a, t
+
+class TestReactor(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = Reactor()
+        self.sockets = []
+
+    def tearDown(self):
+        self.reactor.close()
+        for i in self.sockets:
+            i.close()
+
+    def pair(self):
+        a, t = tcp_pair()
+        self.sockets.extend([a, t._sock])
+        self.reactor.register(t)
+        return a, t
+
+    def test_reactor_dispatch(self):
+        pairs = [self.pair() for i in range(5)]
+        read = Mock()
+        self.reactor.register_read_handler(read)
+        assert self.reactor.tick() == 0
+        pairs[3][0].sendall('<presence/>')
+        assert self.reactor.tick(timeout=1) == 1
+        read.assert_called_once_with(pairs[3][1])
+        assert pairs[3][1].recv() == '<presence/>'
+        assert self.reactor.tick() == 0
+
+    def test_reactor_bound_stream(self):
+        a, t = self.pair()
+        stream = Stream(to='orvant.com', frm='agent@orvant.com')
+        t.bind(stream)
+        a.sendall(HEADER_IN + '<presence/><message/>')
+        self.reactor.tick(timeout=1)
+        assert [i.tag for i in stream.recvnodes()] == ['presence', 'message']
+
+    def test_reactor_close(self):
+        a, t = self.pair()
+        closed = Mock()
+        self.reactor.register_close_handler(closed)
+        a.close()
+        self.reactor.tick(timeout=1)
+        assert closed.call_args[0][0] is t
+        assert len(self.reactor) == 0
+
+    def test_reactor_pause(self):
+        a, t = self.pair()
+        t.pause_reading()
+        a.sendall('<presence/>')
+        self.reactor.tick(timeout=1)
+        assert t in self.reactor.paused
+        assert not t.readyread
+        assert self.reactor.tick() == 0
+        t.resume_reading()
+        assert self.reactor.tick(timeout=1) == 1
+        assert t.recv() == '<presence/>'
+
+    def test_reactor_update(self):
+        a, b = socket.socketpair()
+        c, d = socket.socketpair()
+        self.sockets.extend([a, b, c, d])
+        transport = Mock()
+        transport.reading = True
+        transport.fileno.return_value = [b.fileno()]
+        self.reactor.register(transport)
+        transport.fileno.return_value = [b.fileno(), d.fileno()]
+        self.reactor.update(transport)
+        assert self.reactor.transports[transport] == set([b.fileno(), d.fileno()])
+        transport.rawrecv.return_value = iter([None])
+        c.sendall('x')
+        self.reactor.tick(timeout=1)
+        transport.rawrecv.assert_called_once_with(sock=d.fileno())
+        transport.fileno.return_value = [d.fileno()]
+        self.reactor.update(transport)
+        assert set(self.reactor.selector.get_map()) == set([d.fileno()])
+
+    def test_reactor_ssl_pending(self):
+        a, b = socket.socketpair()
+        self.sockets.extend([a, b])
+        transport = Mock()
+        transport.reading = True
+        transport.fileno.return_value = b.fileno()
+        transport.ssl_pending = 0
+        def rawrecv():
+            b.recv(1)
+            # The rest is in the ssl layer, the fd is no longer readable
+            transport.ssl_pending = 10
+            return iter([None])
+        transport.rawrecv.side_effect = rawrecv
+        self.reactor.register(transport)
+        a.sendall('x')
+        assert self.reactor.tick(timeout=1) == 1
+        assert self.reactor.buffered
+        transport.rawrecv.side_effect = None
+        transport.ssl_pending = 0
+        start = time.time()
+        assert self.reactor.tick(timeout=5) == 1
+        assert time.time() - start < 1
+        assert transport.rawrecv.call_count == 1
+        assert not self.reactor.buffered
+        assert self.reactor.tick() == 0
+
+    def test_tcp_ssl_pending(self):
+        a, t = self.pair()
+        assert t.ssl_pending == 0
+        t._sock = Mock(spec=ssl.SSLSocket)
+        t._sock.pending.return_value = 7
+        assert t.ssl_pending == 7
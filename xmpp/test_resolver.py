@@ -0,0 +1,188 @@
+from agent.xmpp.resolver import *
+from agent.xmpp.transport import Tcp, TransportError
+import unittest
+import select
+import socket
+import threading
+import time
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+class SlowResolve(object):
+    """
+    Stands in for resolve_host, answering after latency seconds or when
+    released.
+    """
+
+    def __init__(self, latency=0, ip='10.0.0.1'):
+        self.latency = latency
+        self.ip = ip
+        self.release = threading.Event()
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        self.release.wait(self.latency)
+        with self.lock:
+            self.running -= 1
+        return self.ip
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = Resolver(workers=2)
+
+    def tearDown(self):
+        self.resolver.shutdown()
+
+    def test_resolver_result(self):
+        lookup = self.resolver.submit(SlowResolve(0.01), 'orvant.com')
+        assert lookup.result(timeout=1) == '10.0.0.1'
+        assert lookup.done
+
+    def test_resolver_error(self):
+        lookup = self.resolver.submit(Mock(side_effect=IOError('nx')), 'x')
+        self.assertRaises(IOError, lookup.result, 1)
+
+    def test_resolver_timeout(self):
+        slow = SlowResolve(1)
+        lookup = self.resolver.submit(slow, 'orvant.com')
+        self.assertRaises(ResolveTimeout, lookup.result, 0.01)
+        slow.release.set()
+
+    def test_resolver_bounded(self):
+        slow = SlowResolve(1)
+        lookups = [self.resolver.submit(slow, 'orvant.com') for i in range(6)]
+        time.sleep(0.05)
+        assert len(self.resolver.threads) == 2
+        slow.release.set()
+        assert [i.result(1) for i in lookups] == ['10.0.0.1'] * 6
+        assert slow.most == 2
+
+    def test_resolver_cancel(self):
+        slow = SlowResolve(1)
+        running = [self.resolver.submit(slow, 'orvant.com') for i in range(2)]
+        queued = self.resolver.submit(slow, 'orvant.com')
+        assert queued.cancel()
+        self.assertRaises(ResolveCancelled, queued.result, 0)
+        slow.release.set()
+        [i.result(1) for i in running]
+        assert queued.started is None
+
+    def test_resolver_fileno(self):
+        fd = self.resolver.fileno()
+        assert not select.select([fd], [], [], 0)[0]
+        lookup = self.resolver.submit(SlowResolve(0), 'orvant.com')
+        assert select.select([fd], [], [], 1)[0]
+        assert lookup.done
+        self.resolver.drain()
+        assert not select.select([fd], [], [], 0)[0]
+
+class TestTcpConnectSteps(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = Resolver(workers=2)
+        self.socket_maker = Mock()
+
+    def tearDown(self):
+        self.resolver.shutdown()
+
+    def test_connect_steps_yield(self):
+        slow = SlowResolve(1)
+        t = Tcp('orvant.com')
+        steps = t.connect_steps(resolvehost=slow, socket_maker=self.socket_maker,
+            resolver=self.resolver)
+        lookup = next(steps)
+        assert not lookup.done
+        assert next(steps) is lookup
+        assert not self.socket_maker.called
+        slow.release.set()
+        lookup.wait(1)
+        self.assertRaises(StopIteration, next, steps)
+        assert t._ip == '10.0.0.1'
+        self.socket_maker.return_value.connect.assert_called_once_with(
+            '10.0.0.1', 5222)
+
+    def test_connect_steps_timeout(self):
+        slow = SlowResolve(1)
+        t = Tcp('orvant.com')
+        steps = t.connect_steps(resolvehost=slow, socket_maker=self.socket_maker,
+            resolver=self.resolver, timeout=0.05)
+        lookup = next(steps)
+        time.sleep(0.06)
+        self.assertRaises(TransportError, next, steps)
+        assert lookup.cancelled
+        assert not self.socket_maker.called
+        slow.release.set()
+
+    def test_connect_steps_close(self):
+        slow = SlowResolve(1)
+        t = Tcp('orvant.com')
+        steps = t.connect_steps(resolvehost=slow, socket_maker=self.socket_maker,
+            resolver=self.resolver)
+        lookup = next(steps)
+        steps.close()
+        assert lookup.cancelled
+        slow.release.set()
+        assert t._ip is None
+
+    def test_connect_steps_sync(self):
+        t = Tcp('orvant.com')
+        steps = t.connect_steps(resolvehost=Mock(return_value='10.0.0.2'),
+            socket_maker=self.socket_maker)
+        self.assertRaises(StopIteration, next, steps)
+        assert t._ip == '10.0.0.2'
+
+    def test_connect_resolver(self):
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=SlowResolve(0.02), socket_maker=self.socket_maker,
+            resolver=self.resolver)
+        assert t._ip == '10.0.0.1'
+        self.assertRaises(TransportError, Tcp('orvant.com').connect,
+            resolvehost=SlowResolve(1), socket_maker=self.socket_maker,
+            resolver=self.resolver, timeout=0.05)
+
+    def test_connect_steps_gaierror(self):
+        t = Tcp('orvant.com')
+        resolvehost = Mock(side_effect=socket.gaierror(-2, 'Name not known'))
+        self.assertRaises(TransportError, t.connect, resolvehost=resolvehost,
+            socket_maker=self.socket_maker, resolver=self.resolver)
+
+    def test_connect_race_steps(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        threads = []
+        def getaddrinfo(host, port, family, type):
+            threads.append(threading.current_thread())
+            time.sleep(0.02)
+            return [(socket.AF_INET, 1, 6, '', server.getsockname())]
+        srv = Mock()
+        srv.targets.return_value = [('xmpp.orvant.com', 5223)]
+        resolver = Resolver(workers=2, getaddrinfo=getaddrinfo, srv=srv)
+        self.addCleanup(resolver.shutdown)
+        t = Tcp('orvant.com')
+        steps = t.connect_race_steps(resolver=resolver)
+        pending = list(steps)
+        assert isinstance(pending[0], Lookup)
+        srv.targets.assert_called_once_with('_xmpp-client._tcp.orvant.com')
+        assert threads and threading.current_thread() not in threads
+        assert t.race_result.winner.host == 'xmpp.orvant.com'
+        assert t._sock.getpeername() == server.getsockname()
+        t.disconnect()
+
+    def test_connect_race_gaierror(self):
+        getaddrinfo = Mock(side_effect=socket.gaierror(-2, 'Name not known'))
+        resolver = Resolver(workers=2, getaddrinfo=getaddrinfo)
+        self.addCleanup(resolver.shutdown)
+        t = Tcp('orvant.com', use_srv=False)
+        self.assertRaises(TransportError, t.connect_race, resolver=resolver)
+        getaddrinfo.assert_called_once_with(
+            'orvant.com', 5222, 0, socket.SOCK_STREAM)
@@ -0,0 +1,92 @@
+from agent.xmpp.srv import *
+from agent.xmpp.transport import Tcp
+import unittest
+import random
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+NAME = '_xmpp-client._tcp.orvant.com'
+
+RECORDS = [
+    SrvRecord(10, 60, 5222, 'a.orvant.com'),
+    SrvRecord(10, 20, 5222, 'b.orvant.com'),
+    SrvRecord(10, 0, 5222, 'c.orvant.com'),
+    SrvRecord(20, 0, 5223, 'backup.orvant.com'),
+]
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestSrvCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.resolver = Mock(return_value=(RECORDS, 300))
+        self.cache = SrvCache(resolver=self.resolver, clock=self.clock)
+
+    def test_srv_cache_ttl(self):
+        assert self.cache.lookup(NAME) == RECORDS
+        self.clock.now += 299
+        assert self.cache.lookup(NAME) == RECORDS
+        assert self.resolver.call_count == 1
+        self.clock.now += 1
+        self.cache.lookup(NAME)
+        assert self.resolver.call_count == 2
+        self.resolver.assert_called_with(NAME)
+
+    def test_srv_cache_ttl_bounds(self):
+        self.resolver.return_value = (RECORDS, 0)
+        self.cache.lookup(NAME)
+        self.clock.now += MIN_TTL - 1
+        self.cache.lookup(NAME)
+        assert self.resolver.call_count == 1
+
+    def test_srv_cache_negative(self):
+        self.resolver.side_effect = NameNotFound(NAME)
+        assert self.cache.targets(NAME) == []
+        assert self.cache.targets(NAME) == []
+        assert self.resolver.call_count == 1
+        self.clock.now += NEGATIVE_TTL
+        self.resolver.side_effect = None
+        assert len(self.cache.targets(NAME)) == 4
+
+    def test_srv_cache_error(self):
+        self.resolver.side_effect = SrvError('timeout')
+        assert self.cache.lookup(NAME) == []
+        self.cache.invalidate(NAME)
+        self.resolver.side_effect = None
+        assert self.cache.lookup(NAME) == RECORDS
+
+    def test_srv_order(self):
+        rng = random.Random(1)
+        counts = {}
+        for i in range(2000):
+            ordered = order(RECORDS, rng)
+            assert len(ordered) == 4
+            assert ordered[-1].target == 'backup.orvant.com'
+            first = ordered[0].target
+            counts[first] = counts.get(first, 0) + 1
+        # Weights 60, 20 and 0 out of 80, zero weights come first 1 in 81
+        assert 1350 < counts['a.orvant.com'] < 1600, counts
+        assert 400 < counts['b.orvant.com'] < 600, counts
+        assert counts.get('c.orvant.com', 0) < 80, counts
+
+    def test_srv_order_unavailable(self):
+        assert order([SrvRecord(0, 0, 0, '.')]) == []
+
+    def test_tcp_srv_targets(self):
+        t = Tcp('orvant.com')
+        targets = t.srv_targets(('orvant.com', 5222), cache=self.cache)
+        assert sorted(targets) == [
+            ('a.orvant.com', 5222), ('b.orvant.com', 5222),
+            ('backup.orvant.com', 5223), ('c.orvant.com', 5222),
+        ]
+        assert targets[-1] == ('backup.orvant.com', 5223)
+        self.resolver.assert_called_with(NAME)
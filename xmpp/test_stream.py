@@ -26,7 +26,7 @@ class TestStream(unittest.TestCase):
             to='orvant.com', frm='agent@orvant.com'
         )
         stream.start()
-        assert stream.output_buffer == [self.HEADER_OUT]
+        assert list(stream.output_buffer) == [self.HEADER_OUT]
 
     def test_stream_start_response(self):
         "Stream receives start response"
@@ -133,3 +133,94 @@ class TestStream(unittest.TestCase):
             to='orvant.com', frm='agent@orvant.com', parser_cls=parser,
         )
         assert stream1.message_id() == stream2.message_id() -1
+
+    def test_stream_sendnode(self):
+        "Stream sendnode serializes stanzas into the output buffer"
+        stream = Stream(
+            to='orvant.com', frm='agent@orvant.com',
+        )
+        self.assertRaises(StreamError, stream.sendnode, Node('message'))
+        stream.start()
+        stream.getoutput()
+        node = Node('message', attrs={'id': 'a1'},
+            payload=[Node('body', payload=['hi'])])
+        assert stream.sendnode(node) == 'a1'
+        assert stream.getoutput() == \
+            '<message id="a1"><body>hi</body></message>'
+        stream.sendnode(Node('presence'))
+        assert stream.getoutput().startswith('<presence id=')
+
+    def test_stream_lazy(self):
+        "Stream lazy mode keeps stanza bytes until the payload is used"
+        stream = Stream(
+            to='orvant.com', frm='agent@orvant.com', lazy=True,
+        )
+        stanza = (
+            "<message from='bob@orvant.com' to='agent@orvant.com' id='a1'>"
+            "<body>hi &amp; bye</body></message>"
+        )
+        data = self.HEADER_IN + stanza + "<presence from='bob@orvant.com'/>"
+        for i in range(0, len(data), 7):
+            stream.parse(data[i:i + 7])
+        features = stream.recvnode()
+        message = stream.recvnode()
+        presence = stream.recvnode()
+        assert features.get_children()[0].tag == 'starttls'
+        assert features.get_children()[0].namespace == \
+            'urn:ietf:params:xml:ns:xmpp-tls'
+        assert message.get_attr('from') == 'bob@orvant.com'
+        assert message.raw == stanza
+        assert message.to_string() == stanza
+        assert presence.raw == "<presence from='bob@orvant.com'/>"
+        assert message.get_children()[0].payload == ['hi & bye']
+        assert message.get_children()[0].namespace == 'jabber:client'
+        assert message.raw is None
+        assert len(stream.input_parser._data) < len(stanza)
+
+    def test_stream_parse_filters(self):
+        "Stream parse filters survive restarts"
+        stream = Stream(
+            to='orvant.com', frm='agent@orvant.com',
+            parse_filters=[('starttls', None, SKIP)],
+        )
+        stream.register_parse_filter('mechanisms', action=RAW)
+        stream.restart()
+        assert stream.input_parser.filters == {
+            ('starttls', None): SKIP, ('mechanisms', None): RAW,
+        }
+        stream.parse(self.HEADER_IN)
+        assert stream.recvnode().get_children() == []
+
+    def test_stream_backpressure(self):
+        "Stream pauses the transport while the input buffer is full"
+        transport = Mock()
+        stream = Stream(
+            to='orvant.com', frm='agent@orvant.com', transport=transport,
+            input_watermarks=(3, 1),
+        )
+        stream.parse(self.HEADER_IN)
+        assert stream.recvnode().tag == 'features'
+        stream.parse('<presence/><presence/>')
+        assert not transport.pause_reading.called
+        stream.parse('<presence/><presence/>')
+        assert transport.pause_reading.call_count == 1
+        assert stream.input_buffer.full
+        assert len(stream.recvnodes(2)) == 2
+        assert not transport.resume_reading.called
+        assert stream.recvnode().tag == 'presence'
+        assert transport.resume_reading.call_count == 1
+        assert not stream.input_buffer.full
+        assert len(stream.recvnodes()) == 1
+        assert stream.recvnodes() == []
+        assert stream._input_root.payload == []
+
+    def test_stream_getoutput_all(self):
+        "Stream getoutput_all drains the output buffer"
+        stream = Stream(to='orvant.com', frm='agent@orvant.com')
+        stream.start()
+        for i in range(3):
+            stream.sendnode(Node('presence'))
+        output = stream.getoutput_all()
+        assert len(output) == 4
+        assert output[1].startswith('<presence')
+        assert stream.getoutput_all() == []
@@ -0,0 +1,94 @@
+from agent.xmpp.tls import *
+from agent.xmpp.transport import Tcp
+from agent.xmpp.testutil import make_cert, TlsServer, HOST
+from distutils.spawn import find_executable
+import unittest
+import tempfile
+import shutil
+import socket
+import ssl
+from mock import Mock
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+@unittest.skipUnless(find_executable('openssl'), 'needs openssl')
+class TestTls(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.certfile, cls.keyfile = make_cert(cls.tmp)
+        cls.server = TlsServer(cls.certfile, cls.keyfile)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        shutil.rmtree(cls.tmp)
+
+    def setUp(self):
+        self.factory = Mock(side_effect=lambda host, port:
+            ssl.create_default_context(cafile=self.certfile))
+        self.cache = TlsCache(self.factory)
+
+    def tcp(self):
+        t = Tcp(HOST, self.server.port)
+        t._sock = socket.create_connection(('127.0.0.1', self.server.port))
+        t.starttls(self.cache)
+        for i in t.rawrecv():
+            pass
+        assert t.recv() == 'hello'
+        return t
+
+    def test_tls_context_shared(self):
+        a = self.tcp()
+        b = self.tcp()
+        assert self.factory.call_count == 1
+        assert a._sock.context is b._sock.context
+        a.disconnect()
+        b.disconnect()
+        assert self.cache.handshakes == 2
+
+    def test_tls_resumed(self):
+        t = self.tcp()
+        assert t.tls_resumed is False
+        t.disconnect()
+        t = self.tcp()
+        assert t.tls_resumed is HAVE_SESSIONS
+        assert self.cache.resumed == int(HAVE_SESSIONS)
+        t.disconnect()
+
+    def test_tls_session_by_port(self):
+        t = self.tcp()
+        t.disconnect()
+        assert list(self.cache.sessions) == [(HOST, self.server.port)] * HAVE_SESSIONS
+
+    @unittest.skipUnless(HAVE_SESSIONS, 'needs ssl sessions')
+    def test_tls_session_other_context(self):
+        self.tcp().disconnect()
+        key = (HOST, self.server.port)
+        session = self.cache.sessions[key]
+        # The session belongs to the context it replaces
+        self.cache.contexts[key] = ssl.create_default_context(
+            cafile=self.certfile)
+        t = self.tcp()
+        assert t.tls_resumed is False
+        assert self.cache.sessions.get(key) is not session
+        t.disconnect()
+
+    def test_tls_invalidate(self):
+        self.tcp().disconnect()
+        self.cache.invalidate(HOST)
+        assert not self.cache.contexts
+        assert not self.cache.sessions
+        t = self.tcp()
+        assert t.tls_resumed is False
+        assert self.factory.call_count == 2
+        t.disconnect()
+
+    def test_tls_bad_certificate(self):
+        cache = TlsCache()
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        self.addCleanup(sock.close)
+        self.assertRaises(ssl.SSLError, cache.wrap, sock, HOST, self.server.port)
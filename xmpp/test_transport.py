@@ -1,6 +1,16 @@
 from agent.xmpp.transport import *
+from agent.xmpp.stream import Stream
+from agent.xmpp.testutil import (
+    serve, serve_pushes, gzipped, body, roster, history, send_batched,
+)
+import select
+import ssl
+import threading
 import unittest
-from mock import Mock
+import errno
+import time
+import zlib
+from mock import Mock, patch
 
 import agent.logger
 agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
@@ -9,7 +19,7 @@ def mock_socket():
     class MockSocket(object):
         connect = Mock()
         close = Mock()
-        send = Mock()
+        send = Mock(side_effect=len)
         recv = Mock()
     return MockSocket
 
@@ -119,6 +129,88 @@ class TestTcp(unittest.TestCase):
         else:
             assert False, 'Expected socket.error to be raised'
 
+    def test_tcp_receive_into(self):
+        chunks = ['a' * 1024, 'b' * 1024, 'c' * 10]
+        def recv_into(view, size):
+            data = chunks.pop(0)
+            view[:len(data)] = data
+            return len(data)
+        sock = mock_socket()
+        sock.recv_into = Mock(side_effect=recv_into)
+        tsocket = Mock()
+        tsocket.return_value = sock
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=mock_resolvehost, socket_maker=tsocket)
+        for i in t.rawrecv():
+            pass
+        assert sock.recv_into.call_count == 3
+        assert not sock.recv.called
+        assert t.readyread
+        assert t.recv(1030) == 'a' * 1024 + 'b' * 6
+        assert t.recv(2000) == 'b' * 1018 + 'c' * 10
+        assert not t.readyread
+        assert t.read_size == 4096
+
+    def test_tcp_bind(self):
+        HEADER = (
+            "<stream:stream xmlns='jabber:client' "
+            "xmlns:stream='http://etherx.jabber.org/streams' from='orvant.com'>"
+        )
+        chunks = [HEADER + "<presence/><message><bo", "dy>hi</body></message>"]
+        def recv_into(view, size):
+            data = chunks.pop(0)
+            view[:len(data)] = data
+            return len(data)
+        sock = mock_socket()
+        sock.recv_into = Mock(side_effect=recv_into)
+        tsocket = Mock()
+        tsocket.return_value = sock
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=mock_resolvehost, socket_maker=tsocket)
+        stream = Stream(to='orvant.com', frm='agent@orvant.com')
+        t.bind(stream)
+        assert stream.transport is t
+        for i in t.rawrecv():
+            pass
+        assert not t.readyread
+        assert [i.tag for i in stream.recvnodes()] == ['presence']
+        for i in t.rawrecv():
+            pass
+        node = stream.recvnode()
+        assert node.tag == 'message'
+        assert node.get_tags('body')[0].payload == ['hi']
+        assert t.buffer._start == t.buffer._end == 0
+        t.unbind()
+        assert stream.transport is None
+
+    def test_tcp_bind_watermark(self):
+        HEADER = (
+            "<stream:stream xmlns='jabber:client' "
+            "xmlns:stream='http://etherx.jabber.org/streams' from='orvant.com'>"
+        )
+        chunks = [HEADER] + ['<presence/>'.ljust(64) for i in range(5)]
+        def recv_into(view, size):
+            data = chunks.pop(0)
+            view[:len(data)] = data
+            return len(data)
+        sock = mock_socket()
+        sock.recv_into = Mock(side_effect=recv_into)
+        tsocket = Mock()
+        tsocket.return_value = sock
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=mock_resolvehost, socket_maker=tsocket)
+        stream = Stream(to='orvant.com', frm='agent@orvant.com',
+            input_watermarks=(2, 1))
+        t.bind(stream)
+        for i in t.rawrecv(size=len(HEADER)):
+            pass
+        for i in t.rawrecv(size=64):
+            pass
+        assert not t.reading
+        assert len(stream.recvnodes()) == 2
+        assert len(chunks) == 3
+        assert t.reading
+
     def test_tcp_send(self):
         VAL = '<?xml version="1.0"?><stream:stream>'
         getaddrinfo = mock_getaddrinfo()
@@ -149,6 +241,73 @@ class TestTcp(unittest.TestCase):
         else:
             assert False, "Expected socket.error to be raised"
 
+    def test_tcp_send_partial(self):
+        sock = mock_socket()
+        sock.send.side_effect = [3, socket.error(errno.EAGAIN, 'again')]
+        tsocket = Mock()
+        tsocket.return_value = sock
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=mock_resolvehost, socket_maker=tsocket)
+        assert t.send('<presence/>') == 3
+        assert t.writing
+        assert t.write_size == 8
+        sock.send.side_effect = len
+        t.write('<iq/>')
+        assert t.flush() == 13
+        sock.send.assert_called_with('esence/><iq/>')
+        assert not t.writing
+        assert t.write_size == 0
+
+    def test_tcp_send_ssl_want_write(self):
+        sock = Mock(spec=ssl.SSLSocket)
+        # Python 3 ssl sockets have a sendmsg that raises
+        sock.sendmsg = Mock(side_effect=NotImplementedError)
+        sock.send.side_effect = [
+            5, ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE, 'want write')]
+        t = Tcp('orvant.com')
+        t._sock = sock
+        t.write('<presence/>')
+        t.write('<iq/>')
+        assert t.flush() == 5
+        assert t.writing
+        assert t.write_size == 11
+        assert not sock.sendmsg.called
+        sock.send.side_effect = ssl.SSLError(ssl.SSL_ERROR_WANT_READ, 'want read')
+        assert t.flush() == 0
+        sock.send.side_effect = len
+        assert t.flush() == 11
+        sock.send.assert_called_with('ence/><iq/>')
+        sock.send.side_effect = ssl.SSLError(ssl.SSL_ERROR_SSL, 'bad record')
+        t.write('<a/>')
+        self.assertRaises(ssl.SSLError, t.flush)
+
+    def test_tcp_send_sendmsg(self):
+        sock = mock_socket()
+        sock.sendmsg = Mock(return_value=16)
+        tsocket = Mock()
+        tsocket.return_value = sock
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=mock_resolvehost, socket_maker=tsocket)
+        stream = Mock()
+        stream.getoutput_all.return_value = ['<presence/>', u'<iq/>', '<a/>']
+        assert t.send_output(stream) == 20
+        buffers = sock.sendmsg.call_args[0][0]
+        assert [bytes(i) for i in buffers] == ['<presence/>', '<iq/>', '<a/>']
+        sock.send.assert_called_with('<a/>')
+        assert not t.writing
+
+    def test_tcp_starttls_default(self):
+        t = Tcp('orvant.com')
+        sock = t._sock = Mock()
+        with patch('agent.util.ssl_wrapper') as ssl_wrapper:
+            t.starttls()
+        ssl_wrapper.assert_called_once_with(sock)
+        assert t._sock is ssl_wrapper.return_value
+        assert t.tls_cache is None
+        assert t.tls_resumed is None
+        t.disconnect()
+        t._sock.close.assert_called_once_with()
+
     def test_tcp_close(self):
         VAL = '<?xml version="1.0"?><stream:stream>'
         sock = mock_socket()
@@ -184,15 +343,20 @@ class TestBosh(unittest.TestCase):
 
     def test_bosh_rid(self):
         t = Bosh('http://www.orvant.com/http-bind')
-        a = t.rid
+        assert t.rid is None
+        a = t.next_rid()
+        assert t.rid == a
         t = Bosh('http://www.orvant.com/http-bind')
-        b = t.rid
+        b = t.next_rid()
         assert b != a
         assert int(b) != int(a) + 1
-        c = t.rid
+        c = t.next_rid()
         assert int(c) == int(b) + 1
-        t.rid = 15
-        assert int(t.rid) == 15
+        assert t.rid == t.rid == c
+        t.reset_rid(15)
+        assert t.next_rid() == '15'
+        t.rid = 20
+        assert t.next_rid() == '20'
 
     def test_bosh_connect_http(self):
         class http:
@@ -258,6 +422,254 @@ class TestBosh(unittest.TestCase):
         assert 'rid' in body.attrs
         assert 'xmpp:restart' in body.attrs and body.attrs['xmpp:restart']
 
+    def test_bosh_xmlstream_to_bosh_stanza(self):
+        t = Bosh('https://www.orvant.com/http-bind')
+        t._sid = 'a<b'
+        t.reset_rid(100)
+        bosh = t.xmlstream_to_bosh("<presence><show>away</show></presence>")
+        body = Node.from_string(bosh)
+        assert body.tag == 'body'
+        assert body.namespace == NS_HTTP_BIND
+        assert body.attrs['rid'] == '100'
+        assert body.attrs['sid'] == 'a<b'
+        assert body.attrs['xml:lang'] == t.xml_lang
+        assert body.find('presence').find('show').payload == ['away']
+        body = Node.from_string(t.xmlstream_to_bosh(''))
+        assert body.attrs['rid'] == '101'
+        assert not body.get_children()
+
+    def test_bosh_bosh_to_xmlstream_raw(self):
+        t = Bosh('https://www.orvant.com/http-bind')
+        decoder = BodyDecoder()
+        decoder.feed(
+            "<body xmlns='http://jabber.org/protocol/httpbind'>"
+            "<message xmlns='jabber:client' to='a@orvant.com'><body>hi</body>"
+            "</message><presence xmlns='jabber:client'/></body>")
+        body = decoder.close()
+        assert body.find('message').raw.startswith("<message xmlns='jabber:client'")
+        assert t.bosh_to_xmlstream(body) == (
+            "<message xmlns='jabber:client' to='a@orvant.com'><body>hi</body>"
+            "</message><presence xmlns='jabber:client'/>")
+
+    def test_bosh_receive_utf8(self):
+        message = (u"<message xmlns='jabber:client'><body>caf\xe9 \u263a"
+            u"</body></message>")
+        server = serve(body(message.encode('utf-8')), None)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        t = Bosh('http://127.0.0.1:{0}/http-bind'.format(server.server_port))
+        t.connection_cls = {'http': HTTPConnection}
+        t._sid = 's1'
+        send_batched(t, ["<presence/>"])
+        send_batched(t, ["<presence/>"])
+        assert isinstance(t.buffer, unicode)
+        assert t.buffer == message * 2
+        stream = Stream(to='orvant.com', frm='agent@orvant.com')
+        stream.parse(u"<stream:stream xmlns='jabber:client' "
+            u"xmlns:stream='http://etherx.jabber.org/streams'>" + t.buffer)
+        bodies = [i.find('body').payload for i in stream.recvnodes()]
+        assert bodies == [[u'caf\xe9 \u263a']] * 2
+
+    def bosh_batching(self, **kwargs):
+        t = Bosh('http://www.orvant.com/http-bind', **kwargs)
+        t._sid = 's1'
+        # Each body posted stays in flight
+        t._request = Mock()
+        t._request.return_value.socket.fileno.return_value = 3
+        return t
+
+    def posted(self, t):
+        return Node.from_string(t._request.call_args[0][0])
+
+    def test_bosh_batch(self):
+        t = self.bosh_batching(requests=2, flush_delay=0)
+        for i in range(50):
+            t.write("<message id='{0}'/>".format(i))
+        assert t.flush() == 1
+        body = self.posted(t)
+        assert len(body.findall('message')) == 50
+        assert body.attrs['sid'] == 's1'
+        assert not t.outgoing and t.outgoing_size == 0
+
+    def test_bosh_batch_max_body(self):
+        t = self.bosh_batching(requests=2, flush_delay=0, max_body=100)
+        t.post(t.envelope(), empty=True)
+        stanzas = ["<message id='{0:02}'/>".format(i) for i in range(20)]
+        for i in stanzas:
+            t.write(i)
+        # One request is in flight, the other takes the first 100 bytes
+        assert t.flush() == 1
+        body = self.posted(t)
+        assert len(body.findall('message')) == 5
+        assert t.in_flight == 2
+        assert list(t.outgoing) == stanzas[5:]
+
+    def test_bosh_batch_delay(self):
+        t = self.bosh_batching(flush_delay=10, max_body=100)
+        t.write("<presence/>")
+        assert t.flush() == 0
+        assert 9 < t.flush_timeout() <= 10
+        assert t.flush(force=True) == 1
+        assert t.flush_timeout() is None
+        t.write("<message>{0}</message>".format('x' * 100))
+        assert t.flush() == 1
+
+    def test_bosh_batch_header(self):
+        t = self.bosh_batching(flush_delay=10)
+        t.send = Mock()
+        t.write("<presence/>")
+        t.write("<?xml version='1.0'?><stream:stream to='orvant.com'>")
+        t.write("<message/>")
+        assert t._request.call_count == 1
+        assert t.send.call_count == 1
+        assert t.send.call_args[0][0].startswith("<?xml")
+        assert list(t.outgoing) == ["<message/>"]
+
+    def test_bosh_batch_stand_in(self):
+        server = serve(body("<presence xmlns='jabber:client'/>"), None)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        t = Bosh('http://127.0.0.1:{0}/http-bind'.format(server.server_port),
+            requests=2)
+        t.connection_cls = {'http': HTTPConnection}
+        t._sid = 's1'
+        send_batched(t, ["<message id='{0}'/>".format(i) for i in range(50)])
+        assert len(server.bodies) == 1
+        assert server.bodies[0].count('<message ') == 50
+        assert t.buffer == "<presence xmlns='jabber:client'/>"
+
+    def test_bosh_schedule_hold(self):
+        t = self.bosh_batching(hold=1, requests=2, flush_delay=0)
+        assert t.schedule() == 0
+        t.bound = True
+        assert t.schedule() == 1
+        assert t.idle == 1
+        assert not self.posted(t).get_children()
+        assert t.inflight[t.rid].empty
+        assert t.schedule() == 0
+        t.write('<presence/>')
+        assert t.schedule() == 1
+        assert t.in_flight == 2
+        assert t.idle == 1
+
+    def test_bosh_rawrecv_unknown_connection(self):
+        t = self.bosh_batching()
+        t.post(t.envelope())
+        t.reconnect = Mock()
+        # A keep-alive connection that never got a request is closed
+        assert list(t.rawrecv(sock=4)) == []
+        t.reconnect.assert_called_with(4)
+        assert t.in_flight == 1
+        assert list(t._respobjs) == [3]
+
+    def test_bosh_schedule_free_request(self):
+        t = self.bosh_batching(hold=2, requests=2, flush_delay=0)
+        t.bound = True
+        assert t.schedule() == 1
+        assert t.idle == 1
+        # The other request takes the stanzas queued meanwhile
+        t.write('<presence/>')
+        assert t.flush() == 1
+        assert t.in_flight == 2
+        t = self.bosh_batching(hold=1, requests=1)
+        t.bound = True
+        assert t.schedule() == 1
+        assert t.idle == 1
+
+    def test_bosh_schedule_unbound(self):
+        t = self.bosh_batching(requests=1, flush_delay=0)
+        response = t._request.return_value
+        response.status = OK
+        response.getheader.return_value = None
+        response.read.side_effect = [
+            "<body xmlns='http://jabber.org/protocol/httpbind'>"
+            "<message xmlns='jabber:client'/></body>", '']
+        t.write('<presence/>')
+        assert t.flush() == 1
+        t.write('<response/>')
+        assert t.flush() == 0
+        assert not t.accepts_more_requests()
+        # The answer frees the only request, the queued stanza takes it
+        for i in t.rawrecv(sock=3):
+            pass
+        assert t.buffer == "<message xmlns='jabber:client'/>"
+        assert not t.outgoing
+        assert self.posted(t).find('response') is not None
+        assert t.in_flight == 1
+
+    def test_bosh_schedule_polling(self):
+        t = self.bosh_batching(hold=0, polling=10)
+        t.bound = True
+        t.t = time.time()
+        assert t.schedule() == 0
+        assert 9 < t.schedule_timeout() <= 10
+        t.t -= 11
+        assert t.schedule() == 1
+        assert t.schedule_timeout() is None
+        assert t.schedule() == 0
+
+    def test_bosh_schedule_expire(self):
+        t = self.bosh_batching(hold=1, wait=5)
+        t.bound = True
+        t.reconnect = Mock()
+        assert t.schedule() == 1
+        rid = t.rid
+        t.inflight[rid].sent -= 5 + WAIT_MARGIN + 1
+        assert t.schedule() == 0
+        assert t.stats.expired == 1
+        t.reconnect.assert_called_once_with(3)
+        # Sent again with the same rid
+        assert t._request.call_count == 2
+        assert t._request.call_args_list[0] == t._request.call_args_list[1]
+        assert list(t.inflight) == [rid]
+        assert t.in_flight == t.idle == 1
+        assert t.rid == rid
+
+    def test_bosh_schedule_push(self):
+        server = serve_pushes(hold=1, wait=5)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        t = Bosh('http://127.0.0.1:{0}/http-bind'.format(server.server_port),
+            hold=1, requests=2)
+        t.connection_cls = {'http': HTTPConnection}
+        t._sid = 's1'
+        t.bound = True
+        assert t.schedule() == 1
+        assert not t.pending_data(timeout=0.05)
+        assert t.idle == 1
+        pusher = threading.Timer(0.05, server.push, ("<message id='m1'/>",))
+        pusher.start()
+        fds = [fd for fd in t._respobjs if t._respobjs[fd]]
+        fd = select.select(fds, [], [], 2)[0][0]
+        for i in t.rawrecv(sock=fd):
+            pass
+        assert t.buffer == "<message id='m1'/>"
+        # Re-armed right away
+        assert t.idle == 1
+        assert t.stats.requests == 2
+        assert t.stats.empty_rate == 0
+        # A request was parked when the stanza came in
+        assert t.stats.pushes == 1
+        assert t.stats.push_wait_max == 0
+        t.reconnect(t._respobjs.keys()[0])
+
+    def test_bosh_poll_stats(self):
+        stats = PollStats()
+        assert stats.posted(True, 10.0) == 0
+        stats.received(True, 11.0, 0)
+        # Uncovered for half a second, a stanza may have waited that long
+        gap = stats.posted(True, 11.5)
+        assert gap == 0.5
+        stats.received(False, 12.0, 0, gap)
+        assert stats.posted(False, 12.25) == 0.25
+        summary = stats.summary()
+        assert summary['requests'] == 3
+        assert summary['empty_rate'] == 0.5
+        assert summary['uncovered'] == 0.75
+        assert summary['uncovered_max'] == 0.5
+        assert summary['pushes'] == 1
+        assert summary['push_wait_mean'] == summary['push_wait_max'] == 0.5
+
     def test_bosh_bosh_to_xmlstream_start(self):
         t = Bosh('https://www.orvant.com/http-bind')
         t.connect()
@@ -283,5 +695,84 @@ class TestBosh(unittest.TestCase):
         assert t.wait == 120
         assert t.requests == 4
         assert t.hold == 5
+        assert t.polling == 2
         assert t._sid == '0209ce4ea1047184a8d1fe83e000e02d22f3f40c'
 
+    def test_bosh_bosh_to_xmlstream_start_defaults(self):
+        t = Bosh('https://www.orvant.com/http-bind', polling=7)
+        body = Node.from_string(
+            "<body xmlns='http://jabber.org/protocol/httpbind' sid='s1' "
+            "wait='60' hold='0' requests='1'/>")
+        t.bosh_to_xmlstream(body)
+        assert t.hold == 0
+        assert t.polling == 7
+        assert t.wait == 60
+        assert t.requests == 1
+
+    def test_bosh_body_decoder(self):
+        data = history(50)
+        for encoding, encoded in (
+                (None, data), ('gzip', gzipped(data)),
+                ('deflate', zlib.compress(data))):
+            decoder = BodyDecoder(encoding)
+            for i in range(0, len(encoded), 100):
+                decoder.feed(encoded[i:i + 100])
+            body = decoder.close()
+            assert len(body.findall('message')) == 50
+            assert decoder.size == len(data)
+            assert decoder.wire == len(encoded)
+
+    def test_bosh_rawrecv_gzip(self):
+        server = serve(gzipped(roster(2000)))
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        t = Bosh('http://127.0.0.1:{0}/http-bind'.format(server.server_port))
+        t.connection_cls = {'http': HTTPConnection}
+        t.send('<presence/>')
+        chunks = 0
+        for i in t.rawrecv(sock=t.fileno()[0]):
+            chunks += 1
+        assert chunks > 1
+        assert t.buffer.startswith("<iq")
+        assert t.buffer.count('<item ') == 2000
+
+
+class TestRecvBuffer(unittest.TestCase):
+
+    def test_recv_buffer_consume(self):
+        b = RecvBuffer(8)
+        b.write('abcdef')
+        assert b.read(4) == 'abcd'
+        assert len(b) == 2
+        b.write('ghijkl')
+        assert len(b._data) == 8
+        assert b._start == 0
+        assert b.view().tobytes() == 'efghijkl'
+        assert b.read() == 'efghijkl'
+        assert not b
+        assert b._start == b._end == 0
+
+    def test_recv_buffer_grow(self):
+        b = RecvBuffer(8)
+        b.write('abcdef')
+        b.consume(2)
+        view = b.reserve(10)
+        view[:] = '0123456789'
+        b.commit(10)
+        assert len(b._data) == 16
+        assert b.read() == 'cdef0123456789'
+
+class TestTcpReading(unittest.TestCase):
+
+    def test_tcp_pause_reading(self):
+        sock = mock_socket()
+        sock.pending_data = Mock(return_value=True)
+        tsocket = Mock()
+        tsocket.return_value = sock
+        t = Tcp('orvant.com')
+        t.connect(resolvehost=mock_resolvehost, socket_maker=tsocket)
+        assert t.pending_data()
+        t.pause_reading()
+        assert not t.pending_data()
+        t.resume_reading()
+        assert t.pending_data()
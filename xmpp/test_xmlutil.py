@@ -94,6 +94,25 @@ class TestXmlUtil(unittest.TestCase):
         assert len(n.payload) == 5
         assert len(n.get_children()) == 2, len(n.get_children())
 
+    def test_serialize_sinks(self):
+        n = Node('message', attrs={'to': 'bob@orvant.com'},
+            payload=[Node('body', payload=['hi']), 'there'])
+        s = '<message to="bob@orvant.com"><body>hi</body>there</message>'
+        assert ''.join(n.serialize([])) == s
+        assert str(n.serialize(bytearray())) == s
+        chunks = []
+        serialize(n, chunks.append)
+        assert ''.join(chunks) == s
+
+    def test_iter_string(self):
+        parser = XmlParser()
+        parser.parse(self.stream)
+        n = parser.getroot()
+        chunks = list(n.iter_string())
+        assert len(chunks) == 7, chunks
+        assert ''.join(chunks) == n.to_string()
+        assert ''.join(n.iter_string(pretty=True)) == n.to_pretty_string()
+
     def test_escape(self):
         n = Node('message', attrs={'to': 'ol&ver@example.com'})
         assert to_string(n) == '<message to="ol&amp;ver@example.com"/>'
@@ -101,6 +120,29 @@ class TestXmlUtil(unittest.TestCase):
         assert to_string(n) == \
             '<message>speak &lt;b&gt;out&lt;/b&gt;</message>', to_string(n)
 
+    def test_escape_quotes(self):
+        n = Node('message', attrs={'to': 'say "hi"'})
+        assert to_string(n) == '<message to="say &quot;hi&quot;"/>', \
+            to_string(n)
+
+    def test_escape_escaped(self):
+        # Text is escaped exactly once, even when it looks escaped already.
+        assert xmlescape('a &lt; b') == 'a &amp;lt; b'
+        assert xmlescape('plain@orvant.com') == 'plain@orvant.com'
+        n = Node.from_string('<body>a &amp;lt; b</body>')
+        assert n.payload == ['a &lt; b']
+        assert n.to_string() == '<body>a &amp;lt; b</body>', n.to_string()
+
+    def test_escape_cache(self):
+        escape = EscapeCache(maxsize=2, maxlen=5)
+        assert escape('a&b') == 'a&amp;b'
+        assert escape.cache == {'a&b': 'a&amp;b'}
+        assert escape('a<b>c') == 'a&lt;b&gt;c'
+        assert escape('too long') == 'too long'
+        assert len(escape.cache) == 2
+        assert escape('<') == '&lt;'
+        assert escape.cache == {'<': '&lt;'}
+
     def test_namespace(self):
         n = Node('stream', namespace='http://foo.com')
         assert n.to_string() == '<stream xmlns="http://foo.com"/>', \
@@ -140,6 +182,20 @@ class TestXmlUtil(unittest.TestCase):
         assert not isescaped('&fakuIw0nt)oWh4Ut331m3')
         assert isescaped('ok, its &lt; ok')
 
+    def test_node_lazy_containers(self):
+        n = Node('body')
+        assert (n._attrs, n._nsmap, n._payload) == (None, None, None)
+        assert n.to_string() == '<body/>'
+        assert n.get_attr('foo') is None
+        assert n.get_children() == []
+        assert n._payload is None
+        n.add_child('hi')
+        assert n._payload == ['hi']
+        n = Node('query', attrs={'xmlns': 'jabber:iq:roster'})
+        assert n._nsmap == {None: 'jabber:iq:roster'}
+        assert n._attrs == {}
+        self.assertRaises(AttributeError, setattr, n, 'foo', 'bar')
+
     def test_node_set_attr(self):
         n = Node()
         n.set_attr('foo', 'bar')
@@ -213,3 +269,184 @@ class TestXmlUtil(unittest.TestCase):
             'stream':"http://etherx.jabber.org/streams",
         }, 'band nsmap'
 
+
+    def test_node_namespace_scope_shared(self):
+        n = Node.from_string(
+            "<iq xmlns='jabber:client'><query xmlns='jabber:iq:roster'>"
+            "<item/><item/></query></iq>"
+        )
+        query = n.get_children()[0]
+        a, b = query.get_children()
+        assert a.namespace == 'jabber:iq:roster'
+        assert b.namespace == 'jabber:iq:roster'
+        assert a._scope is b._scope is query._scope
+        assert n.namespace == 'jabber:client'
+
+    def test_node_namespace_scope_reparent(self):
+        item = Node('item')
+        query = Node('query', namespace='jabber:iq:roster', payload=[item])
+        assert item.namespace == 'jabber:iq:roster'
+        other = Node('query', namespace='jabber:iq:private')
+        other.add_child(item)
+        assert item.namespace == 'jabber:iq:private'
+        other.namespace = 'jabber:iq:last'
+        assert item.namespace == 'jabber:iq:last'
+        assert item.nsmap == {None: 'jabber:iq:last'}
+        item.set_ns('xmlns:x', 'jabber:x:data')
+        assert item.nsmap == {None: 'jabber:iq:last', 'x': 'jabber:x:data'}
+        assert other.nsmap == {None: 'jabber:iq:last'}
+
+    def test_node_get_tags_attrs(self):
+        chlda = Node('item', attrs={'jid': 'a@orvant.com'})
+        chldb = Node('item', attrs={'jid': 'b@orvant.com'})
+        n = Node('query', payload=[chlda, chldb])
+        assert n.get_tags('item', attrs={'jid': 'b@orvant.com'}) == [chldb]
+        assert n.get_tags('item', attrs={'jid': 'b@orvant.com'}, one=1) == chldb
+        assert n.get_tags('item', attrs={'jid': 'c@orvant.com'}, one=1) is None
+
+    def test_node_find(self):
+        items = [Node('item', attrs={'jid': str(i)}) for i in range(20)]
+        x = Node('x', namespace='jabber:x:data')
+        n = Node('query', namespace='jabber:iq:roster', payload=items + [x])
+        assert n.find('x') is x
+        assert n.find('x', 'jabber:x:data') is x
+        assert n.find('x', 'jabber:iq:roster') is None
+        assert n.findall('item', 'jabber:iq:roster') == items
+        assert n._index is not None
+        extra = Node('item')
+        n.add_child(extra)
+        assert n.findall('item') == items + [extra]
+        x.namespace = 'jabber:x:oob'
+        assert n.find('x', 'jabber:x:data') is None
+        assert n.find('x', 'jabber:x:oob') is x
+        n.payload.remove(extra)
+        assert n.findall('item') == items
+        assert n.get_tags('item', namespace='jabber:iq:roster') == items
+
+    def test_node_find_payload_changed(self):
+        items = [Node('item', attrs={'jid': str(i)}) for i in range(20)]
+        n = Node('query', payload=items + [Node()])
+        assert n.findall('item') == items
+        other = Node('other')
+        n.payload[0] = other
+        assert n.find('other') is other
+        assert n.findall('item') == items[1:]
+        n.payload.reverse()
+        assert n.find('item') is items[-1]
+        n.payload = list(items)
+        assert n.find('other') is None
+        assert n.findall(None) == []
+        payload = n.payload
+        assert n.findall('item') == items
+        payload.append(other)
+        assert n.find('other') is other
+
+    def test_node_find_same_length_changes(self):
+        items = [Node('item', attrs={'jid': str(i)}) for i in range(20)]
+        n = Node('query', payload=items)
+        payload = n.payload
+        assert n.findall('item') == items
+        index = n._index
+        assert n.find('item') is items[0]
+        assert n._index is index
+        other = Node('other')
+        payload[0] = other
+        assert n.find('other') is other
+        assert n.find('item') is items[1]
+        del payload[0]
+        payload.append(items[0])
+        assert n.find('other') is None
+        assert n.findall('item') == items[1:] + items[:1]
+        items[1].tag = 'renamed'
+        assert n.find('renamed') is items[1]
+        assert n.find('item') is items[2]
+        items[2].prefix = 'x'
+        items[2].set_ns('xmlns:x', 'urn:x')
+        assert n.find('item', 'urn:x') is items[2]
+        payload[:] = items
+        assert n.find('item') is items[0]
+
+    def test_parser_lazy(self):
+        stanzas = [
+            '<a x="/>" y=\'>\'/>',
+            '<a><a/></a>',
+            '<b:c xmlns:b="urn:b"><d>text</d>\n<e/></b:c>',
+        ]
+        data = '<stream>' + ' '.join(stanzas) + '</stream>'
+        for step in (1, 3, len(data)):
+            parser = XmlParser()
+            parser.set_lazy_level(2)
+            for i in range(0, len(data), step):
+                parser.parse(data[i:i + step])
+            root = parser.getroot()
+            nodes = root.get_children()
+            assert [i.raw for i in nodes] == stanzas, [i.raw for i in nodes]
+            assert nodes[0].get_attr('x') == '/>'
+            assert nodes[2].namespace == 'urn:b'
+            assert nodes[2].get_children()[0].payload == ['text']
+            assert nodes[2].to_string() == \
+                '<b:c xmlns:b="urn:b"><d>text</d><e/></b:c>'
+            assert parser._data == bytearray('</stream>')
+
+    def test_lazy_node_raw(self):
+        parser = XmlParser()
+        parser.set_lazy_level(1)
+        raw = "<message to='bob@orvant.com'><body>hi</body></message>"
+        node = parser.parse(raw).getroot()
+        assert isinstance(node, LazyNode)
+        assert node.to_string() == raw
+        node.set_attr('to', 'alice@orvant.com')
+        assert node.raw is None
+        assert node.to_string() == \
+            '<message to="alice@orvant.com"><body>hi</body></message>'
+
+    def test_parser_filters(self):
+        data = (
+            "<message xmlns='jabber:client'><body>hi</body>"
+            "<html xmlns='http://jabber.org/protocol/xhtml-im'>"
+            "<body xmlns='http://www.w3.org/1999/xhtml'><p>hi <b>there</b></p>"
+            "</body></html><x xmlns='jabber:x:oob'><url>http://a</url></x>"
+            "<data xmlns='http://jabber.org/protocol/ibb' seq='0'>AAAA</data>"
+            "<data xmlns='urn:xmpp:other'/></message>"
+        )
+        for step in (1, len(data)):
+            parser = XmlParser()
+            parser.register_filter(namespace='http://jabber.org/protocol/xhtml-im')
+            parser.register_filter('data', 'http://jabber.org/protocol/ibb', RAW)
+            parser.register_filter('x', action=RAW)
+            for i in range(0, len(data), step):
+                parser.parse(data[i:i + step])
+            n = parser.getroot()
+            assert [i.tag for i in n.get_children()] == \
+                ['body', 'x', 'data', 'data']
+            x, ibb = n.get_children()[1:3]
+            assert x.payload == ['<url>http://a</url>']
+            assert isinstance(x.payload[0], RawXml)
+            assert ibb.payload == ['AAAA']
+            assert ibb.get_attr('seq') == '0'
+            assert n.to_string() == (
+                '<message xmlns="jabber:client"><body>hi</body>'
+                '<x xmlns="jabber:x:oob"><url>http://a</url></x>'
+                '<data xmlns="http://jabber.org/protocol/ibb" seq="0">AAAA</data>'
+                '<data xmlns="urn:xmpp:other"/></message>'
+            ), n.to_string()
+        self.assertRaises(ValueError, parser.register_filter)
+        self.assertRaises(ValueError, parser.register_filter, 'x', None, 'drop')
+
+    def test_parser_filters_lazy(self):
+        data = (
+            "<stream xmlns='jabber:client'><message><body>hi</body>"
+            "<x xmlns='jabber:x:oob'><url>http://a</url></x></message>"
+        )
+        parser = XmlParser()
+        parser.set_lazy_level(2)
+        parser.register_filter('body', 'jabber:client')
+        parser.register_filter('url', 'jabber:x:oob', RAW)
+        parser.parse(data)
+        message = parser.current_element.get_children()[0]
+        assert isinstance(message, LazyNode)
+        assert [i.tag for i in message.get_children()] == ['x']
+        x = message.find('x')
+        assert x.namespace == 'jabber:x:oob'
+        assert x.find('url').payload == ['http://a']
+        assert isinstance(x.find('url').payload[0], RawXml)
@@ -0,0 +1,72 @@
+from agent.xmpp.xpath import *
+from agent.xmpp import xpath
+from agent.xmpp.xmlutil import Node
+import unittest
+
+import agent.logger
+agent.logger.logger_agent.setLevel(agent.logger.CRITICAL)
+
+class TestXPath(unittest.TestCase):
+
+    ROSTER = """
+    <iq type='result' id='roster_1' to='juliet@example.com/balcony'>
+      <query xmlns='jabber:iq:roster' ver='ver11'>
+        <item jid='romeo@example.net' name='Romeo' subscription='both'>
+          <group>Friends</group>
+        </item>
+        <item jid='mercutio@example.com' name='Mercutio' subscription='from'/>
+        <item jid='benvolio@example.net' name='Benvolio' subscription='both'/>
+      </query>
+    </iq>
+    """
+
+    def setUp(self):
+        self.iq = Node.from_string(self.ROSTER)
+
+    def test_select_attr(self):
+        assert select(self.iq, 'iq/query[@xmlns=jabber:iq:roster]/item/@jid') == [
+            'romeo@example.net', 'mercutio@example.com', 'benvolio@example.net',
+        ]
+
+    def test_select_nodes(self):
+        items = select(self.iq, "iq/query/item[@subscription='both']")
+        assert [i.get_attr('name') for i in items] == ['Romeo', 'Benvolio']
+        assert select(self.iq, 'iq/*/item[@name]/group') == \
+            self.iq.get_tags('query')[0].get_tags('item')[0].get_tags('group')
+
+    def test_select_one(self):
+        assert select_one(self.iq, 'iq[@type=result]/@id') == 'roster_1'
+        assert select_one(self.iq, 'iq[@type=get]/@id') is None
+        assert select_one(self.iq, 'message/@id', 'none') == 'none'
+        assert select_one(self.iq, 'iq/query/item/group/text()') == 'Friends'
+
+    def test_namespace_mismatch(self):
+        assert select(self.iq, 'iq/query[@xmlns=jabber:iq:private]/item') == []
+        assert select(self.iq, 'iq[@xmlns=jabber:client]') == []
+
+    def test_prefix(self):
+        n = Node.from_string(
+            "<stream:features xmlns:stream='http://etherx.jabber.org/streams'>"
+            "<starttls xmlns='urn:ietf:params:xml:ns:xmpp-tls'/>"
+            "</stream:features>"
+        )
+        assert select_one(n, 'stream:features/starttls') is n.get_children()[0]
+        assert select_one(n, 'db:features/starttls') is None
+
+    def test_compile_cache(self):
+        path = compile_path('iq/query/item/@jid')
+        assert compile_path('iq/query/item/@jid') is path
+        assert path.attr == 'jid'
+        assert [i.tag for i in path.steps] == ['iq', 'query', 'item']
+
+    def test_compile_cache_bounded(self):
+        for i in range(CACHE_SIZE * 2):
+            compile_path("iq[@id='{0}']/query".format(i))
+            assert len(xpath._cache) <= CACHE_SIZE
+        assert not hasattr(xpath, 'compile')
+
+    def test_compile_errors(self):
+        self.assertRaises(PathError, compile_path, 'iq/query[@xmlns=jabber:iq:roster')
+        self.assertRaises(PathError, compile_path, 'iq/que ry')
+        self.assertRaises(PathError, compile_path, 'iq/query[xmlns]')
+        self.assertRaises(PathError, compile_path, '@jid')
@@ -0,0 +1,292 @@
+"""
+Stand-in servers and fixtures shared by the tests and the benchmarks: an
+HTTP connection manager for Bosh, a TLS server, an asyncio XMPP server and
+the payloads they serve.
+"""
+import os
+import select
+import socket
+import ssl
+import subprocess
+import threading
+import time
+import zlib
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from agent.xmpp.aio import asyncio, encode
+from agent.xmpp.ns import NS_HTTP_BIND, NS_TLS
+from agent.xmpp.stream import Stream
+
+HOST = 'orvant.com'
+
+ITEM = (
+    "<item jid='contact{0}@orvant.com' name='Contact {0}' "
+    "subscription='both'><group>Friends</group></item>"
+)
+MESSAGE = (
+    "<message from='room@conference.orvant.com/user{0}' type='groupchat'>"
+    "<body>message number {0} in the room history</body>"
+    "<delay xmlns='urn:xmpp:delay' from='room@conference.orvant.com' "
+    "stamp='2016-01-01T00:00:00Z'/></message>"
+)
+
+SERVER_HEADER = (
+    "<?xml version='1.0'?><stream:stream xmlns='jabber:client' "
+    "xmlns:stream='http://etherx.jabber.org/streams' from='orvant.com' "
+    "id='{0}' version='1.0' xml:lang='en'>"
+)
+FEATURES = "<stream:features>{0}</stream:features>"
+STARTTLS = "<starttls xmlns='{0}'/>".format(NS_TLS)
+PROCEED = "<proceed xmlns='{0}'/>".format(NS_TLS)
+
+
+def body(payload):
+    return "<body xmlns='{0}'>{1}</body>".format(NS_HTTP_BIND, payload)
+
+
+def roster(count):
+    return body(
+        "<iq type='result' id='roster1'><query xmlns='jabber:iq:roster'>" +
+        ''.join(ITEM.format(i) for i in range(count)) + "</query></iq>"
+    )
+
+
+def history(count):
+    return body(''.join(MESSAGE.format(i) for i in range(count)))
+
+
+def gzipped(data):
+    deflate = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return deflate.compress(data) + deflate.flush()
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one piece, without waiting on Nagle
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.server.bodies.append(
+            self.rfile.read(int(self.headers.getheader('content-length'))))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        data = self.server.response
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        if self.server.encoding:
+            self.send_header('Content-Encoding', self.server.encoding)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+def serve(response, encoding='gzip', latency=0):
+    """
+    Start a stand-in connection manager answering every request with
+    response after latency seconds, return the server. The bodies it
+    received are in server.bodies.
+    """
+    server = Server(('127.0.0.1', 0), Handler)
+    server.response = response
+    server.encoding = encoding
+    server.latency = latency
+    server.bodies = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class PushHandler(Handler):
+    """
+    Answers with the stanzas pushed so far, holding an empty request up to
+    wait seconds until there are some when the session has a hold.
+    """
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.getheader('content-length')))
+        server = self.server
+        deadline = time.time() + server.wait
+        with server.pushed:
+            while (server.hold and not server.pending and '/>' in data[-2:]
+                    and time.time() < deadline):
+                server.pushed.wait(deadline - time.time())
+            pending, server.pending = server.pending, []
+        data = body(''.join(pending))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_pushes(hold, wait=60):
+    """
+    Start a stand-in connection manager that queues the stanzas given to
+    server.push for the client.
+    """
+    server = Server(('127.0.0.1', 0), PushHandler)
+    server.hold = hold
+    server.wait = wait
+    server.pending = []
+    server.pushed = threading.Condition()
+
+    def push(stanza):
+        with server.pushed:
+            server.pending.append(stanza)
+            server.pushed.notify_all()
+    server.push = push
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def receive(t):
+    """
+    Wait for one of the requests in flight to be answered and read it.
+    """
+    fds = [fd for fd in t._respobjs if t._respobjs[fd]]
+    fd = select.select(fds, [], [], 5)[0][0]
+    for i in t.rawrecv(sock=fd):
+        pass
+
+
+def send_batched(t, messages):
+    for data in messages:
+        t.write(data)
+    while t.outgoing or t.in_flight:
+        if t.in_flight:
+            receive(t)
+        else:
+            time.sleep(t.flush_timeout())
+            t.flush()
+
+
+def make_cert(tmp, host=HOST):
+    certfile = os.path.join(tmp, 'cert.pem')
+    keyfile = os.path.join(tmp, 'key.pem')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-days', '1', '-subj', '/CN={0}'.format(host),
+        '-addext', 'subjectAltName=DNS:{0}'.format(host),
+        '-keyout', keyfile, '-out', certfile,
+    ], stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    return certfile, keyfile
+
+
+class TlsServer(threading.Thread):
+    """
+    Greets each connection with hello after the handshake and waits for
+    the client to close it. All connections share one server context,
+    so sessions can be resumed.
+    """
+
+    def __init__(self, certfile, keyfile):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.context = ssl.SSLContext(
+            getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        self.context.load_cert_chain(certfile, keyfile)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+            handler = threading.Thread(target=self.handle, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            conn = self.context.wrap_socket(conn, server_side=True)
+            conn.sendall(b'hello')
+            while conn.recv(4096):
+                pass
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+
+
+class StandInServer(asyncio.Protocol):
+    """
+    A minimal XMPP server. It answers every stream header with its own
+    header and features and echoes every other stanza back. STARTTLS is
+    offered when it has an ssl context and its loop has start_tls.
+    """
+
+    count = 0
+
+    def __init__(self, ssl_context=None, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.ssl_context = ssl_context
+        self.tls = False
+        self.reset()
+
+    def reset(self):
+        self.stream = Stream(frm='orvant.com')
+        self.answered = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.stream.parse(data)
+        if not self.answered and self.stream._input_root is not None:
+            self.answered = True
+            StandInServer.count += 1
+            features = ''
+            if self.ssl_context and not self.tls:
+                features = STARTTLS
+            self.transport.write(encode(
+                SERVER_HEADER.format(StandInServer.count) +
+                FEATURES.format(features)
+            ))
+        for node in self.stream.recvnodes():
+            if node.tag == 'starttls':
+                self.transport.write(encode(PROCEED))
+                self.starttls()
+                return
+            self.transport.write(encode(node.to_string()))
+
+    def starttls(self):
+        self.transport.pause_reading()
+        def upgraded(future):
+            self.transport = future.result()
+            self.tls = True
+            self.reset()
+        asyncio.ensure_future(self.loop.start_tls(
+            self.transport, self, self.ssl_context, server_side=True,
+        ), loop=self.loop).add_done_callback(upgraded)
+
+
+def serve_stream(loop, host='127.0.0.1', port=0, ssl_context=None):
+    """
+    Start a stand-in XMPP server on loop, return it and the port it listens on.
+    """
+    server = loop.run_until_complete(loop.create_server(
+        lambda: StandInServer(ssl_context, loop), host, port,
+    ))
+    return server, server.sockets[0].getsockname()[1]
@@ -0,0 +1,134 @@
+"""
+Shared TLS contexts and session resumption.
+
+Building an SSLContext loads the trust store, so one context is kept per
+server endpoint and shared by every connection to it. The session of the
+last connection to an endpoint is kept as well, a reconnect offers it and
+the server can resume it with an abbreviated handshake, using a session
+ID or a session ticket. A session only works with the context it was made
+by, so both are kept by (host, port).
+
+    sock, resumed = tls_cache.wrap(sock, 'orvant.com', 5222)
+    ...
+    tls_cache.store('orvant.com', 5222, sock)
+    sock.close()
+
+Resuming needs the session API of the ssl module (Python 3.6 and later),
+without it only the contexts are shared. With TLS 1.3 the server sends
+its tickets after the handshake, so store the session once data has been
+read, when the connection closes for instance.
+"""
+import ssl
+import threading
+import time
+
+from agent.util import M
+
+import logging
+log = logging.getLogger(__name__)
+
+HAVE_SESSIONS = hasattr(ssl, 'SSLSession')
+
+def default_context(host, port):
+    return ssl.create_default_context()
+
+class TlsCache(object):
+    """
+    SSL contexts and the last session by (host, port). The maps and the
+    counters are changed under lock, handshakes run outside of it.
+    """
+
+    def __init__(self, context_factory=default_context):
+        self.context_factory = context_factory
+        self.contexts = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    def context(self, host, port):
+        key = (host, port)
+        context = self.contexts.get(key)
+        if context is None:
+            with self.lock:
+                context = self.contexts.get(key)
+                if context is None:
+                    context = self.contexts[key] = self.context_factory(host, port)
+        return context
+
+    def wrap(self, sock, host, port):
+        """
+        Do the TLS handshake on sock for host, offering the session kept
+        for it. Return the ssl socket and whether the session was resumed.
+        """
+        key = (host, port)
+        context = self.context(host, port)
+        with self.lock:
+            session = self.sessions.get(key)
+        start = time.time()
+        sslsock = None
+        if session is not None:
+            # wrap_socket takes sock over and closes it when it refuses the
+            # session, the copy is for the full handshake
+            spare = sock.dup()
+            try:
+                sslsock = context.wrap_socket(
+                    sock, server_hostname=host, session=session)
+            except ValueError as e:
+                log.debug(M("Not resuming the session for {0}:{1}: {2}",
+                    host, port, e))
+                self._drop(key, session)
+                session = None
+                sock = spare
+            else:
+                spare.close()
+        if sslsock is None:
+            sslsock = context.wrap_socket(sock, server_hostname=host)
+        resumed = bool(getattr(sslsock, 'session_reused', False))
+        with self.lock:
+            self.handshakes += 1
+            if resumed:
+                self.resumed += 1
+        if not resumed and session is not None:
+            # The server would not resume it, do not offer it again
+            self._drop(key, session)
+        log.debug(M("TLS handshake with {0}:{1} in {2:.3f}s, resumed: {3}",
+            host, port, time.time() - start, resumed))
+        self.store(host, port, sslsock)
+        return sslsock, resumed
+
+    def store(self, host, port, sslsock):
+        """
+        Keep the session of sslsock for the next connection to host:port.
+        """
+        session = getattr(sslsock, 'session', None)
+        if session is None:
+            return
+        if getattr(session, 'has_ticket', False) or session.id:
+            with self.lock:
+                self.sessions[(host, port)] = session
+
+    def _drop(self, key, session):
+        """
+        Forget session unless another connection stored a newer one.
+        """
+        with self.lock:
+            if self.sessions.get(key) is session:
+                del self.sessions[key]
+
+    def invalidate(self, host=None):
+        """
+        Drop the context and session of host, or everything when host is
+        None, after a certificate change for instance.
+        """
+        with self.lock:
+            if host is None:
+                self.contexts.clear()
+                self.sessions.clear()
+                return
+            for key in [i for i in self.contexts if i[0] == host]:
+                del self.contexts[key]
+            for key in [i for i in self.sessions if i[0] == host]:
+                del self.sessions[key]
+
+tls_cache = TlsCache()
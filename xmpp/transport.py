@@ -7,18 +7,28 @@ import time
 import sys
 import httplib
 import select
-import gzip
+import zlib
 import random
+import errno
+
+from collections import deque
 
 # This is only for exceptions
 import socket
+import ssl
 
 from urlparse import urlparse
 
 from agent.xmpp.ns import NS_STREAMS, NS_HTTP_BIND
-from agent.xmpp.xmlutil import Node
+from agent.xmpp.xmlutil import Node, XmlParser, xmlescape, DOCHEAD
+from agent.xmpp.srv import srv_cache
+from agent.xmpp.resolver import ResolveError, ResolveTimeout
+from agent.xmpp.compression import Compressor, LEVEL
+from agent.xmpp.eyeballs import (
+    Race, Connecting, candidates, ATTEMPT_DELAY, CONCURRENCY, CONNECT_TIMEOUT,
+)
 from agent.util import (
-    M, tcp_socket, resolve_host, HTTPConnection, HTTPSConnection, StringIO
+    M, tcp_socket, resolve_host, HTTPConnection, HTTPSConnection,
 )
 
 _CS_IDLE = httplib._CS_IDLE
@@ -29,7 +39,30 @@ BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 BUFLEN = 1024
+# Most buffers handed to one sendmsg call and most bytes joined into one
+# send call when the socket has no sendmsg.
+IOV_MAX = 64
+COALESCE = 65536
+# Bounds for the adaptive read size of Tcp.rawrecv.
+READ_MIN = 1024
+READ_MAX = 262144
+WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+SSL_WOULDBLOCK = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+# Seconds Tcp.connect waits for the server name to resolve.
+DNS_TIMEOUT = 30
 BadStatusLine = httplib.BadStatusLine
+# Largest payload, in bytes, Bosh gathers into one body and how long, in
+# seconds, queued stanzas wait for others to join them.
+MAX_BODY = 65536
+FLUSH_DELAY = 0.01
+# Seconds past wait after which a request is given up on.
+WAIT_MARGIN = 10
+# Start tag of the body wrapping stanzas mid stream, without the closing
+# bracket.
+BODY_START = (
+    '<body xmlns="' + NS_HTTP_BIND + '" content="text/xml; charset=utf-8" '
+    'xml:lang="{0}" rid="{1}"'
+)
 
 import logging
 log = logging.getLogger(__name__)
@@ -39,6 +72,136 @@ class TransportError(Exception):
     Raise for errors while transporting xml streams
     """
 
+def lookup_result(lookup, name):
+    """
+    Return the result of a done Lookup, raise TransportError when name did
+    not resolve.
+    """
+    try:
+        return lookup.result()
+    except (ResolveError, socket.gaierror, socket.herror) as e:
+        raise TransportError('Could not resolve {0}: {1}'.format(name, e))
+
+def session_int(node, name, default):
+    """
+    Return the integer attribute name of a session creation response,
+    default when it is missing.
+    """
+    value = node.get_attr(name)
+    if value is None:
+        return default
+    return int(value)
+
+def would_block(e):
+    """
+    True for a socket error that only means a non-blocking socket is not
+    ready, an ssl socket says so with want read or want write.
+    """
+    if not e.args:
+        return False
+    if isinstance(e, ssl.SSLError):
+        return e.args[0] in SSL_WOULDBLOCK
+    return e.args[0] in WOULDBLOCK
+
+def poll_socket(sock, write=False, timeout=0):
+    """
+    Return True when sock is ready to read, or write, within timeout
+    seconds. Plain sockets do not have the pending_data and readywrite of
+    the sockets tcp_socket makes.
+    """
+    if not write and isinstance(sock, ssl.SSLSocket) and sock.pending():
+        # An ssl socket holding decrypted bytes the kernel no longer has
+        return True
+    if hasattr(select, 'poll'):
+        poll = select.poll()
+        poll.register(sock, select.POLLOUT if write else select.POLLIN)
+        return bool(poll.poll(timeout * 1000))
+    if write:
+        return bool(select.select([], [sock], [], timeout)[1])
+    return bool(select.select([sock], [], [], timeout)[0])
+
+class RecvBuffer(object):
+    """
+    A growable bytearray holding received data between a start and an end
+    offset. Reads fill the free space after the end in place, consuming
+    moves the start forward. Unread bytes are moved back to the front only
+    when the free space runs out and the bytearray is only replaced when it
+    is too small to hold them, so buffered data is not copied on every
+    read or write.
+    """
+
+    def __init__(self, size=READ_MIN * 4):
+        self._data = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __nonzero__(self):
+        return self._end != self._start
+
+    __bool__ = __nonzero__
+
+    def reserve(self, size):
+        """
+        Return a writable memoryview of size bytes following the buffered
+        data, call commit with the number of bytes written to it.
+        """
+        data = self._data
+        if len(data) - self._end < size:
+            count = self._end - self._start
+            if count + size > len(data):
+                capacity = len(data)
+                while capacity < count + size:
+                    capacity *= 2
+                grown = bytearray(capacity)
+                grown[:count] = memoryview(data)[self._start:self._end]
+                self._data = data = grown
+            elif count:
+                data[:count] = data[self._start:self._end]
+            self._start = 0
+            self._end = count
+        return memoryview(data)[self._end:self._end + size]
+
+    def commit(self, size):
+        self._end += size
+
+    def write(self, data):
+        size = len(data)
+        self.reserve(size)[:] = data
+        self.commit(size)
+
+    def view(self, size=None):
+        """
+        Return a memoryview of up to size unread bytes without consuming
+        them, it is only valid until the next reserve or write.
+        """
+        if size is None or size > len(self):
+            size = len(self)
+        return memoryview(self._data)[self._start:self._start + size]
+
+    def consume(self, size):
+        self._start = min(self._start + size, self._end)
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def read(self, size=None):
+        """
+        Remove and return up to size unread bytes, all of them when size is
+        None.
+        """
+        data = self.view(size).tobytes()
+        self.consume(len(data))
+        return data
+
+    def readable(self):
+        """
+        Return the unread bytes as a read-only buffer, expat parses it and
+        bytearray.extend takes it without a copy.
+        """
+        return buffer(self._data, self._start, len(self))
+
 class Tcp(object):
     """
     TCP connection transport.
@@ -55,108 +218,592 @@ class Tcp(object):
         self._port = port
         self._ip = None
         self.use_srv = use_srv
-        self.buffer = ''
+        self.buffer = RecvBuffer()
+        self.read_size = READ_MIN
+        self.reading = True
+        self.stream = None
+        self.race_result = None
+        self.write_buffer = deque()
+        self.write_size = 0
+        self.compressor = None
+        self.tls_cache = None
+        self.tls_resumed = None
 
     def srv_lookup(self, server):
         """
         SRV resolver. Takes server=(host, port) as argument. Returns new (host, port) pair
         """
-        if HAVE_DNSPYTHON or HAVE_PYDNS:
-            host, port = server
-            possible_queries = ['_xmpp-client._tcp.' + host]
-
-            for query in possible_queries:
-                try:
-                    if HAVE_DNSPYTHON:
-                        answers = [x for x in dns.resolver.query(query, 'SRV')]
-                        # Sort by priority, according to RFC 2782.
-                        answers.sort(key=lambda a: a.priority)
-                        if answers:
-                            host = str(answers[0].target)
-                            port = int(answers[0].port)
-                            break
-                    elif HAVE_PYDNS:
-                        # ensure we haven't cached an old configuration
-                        DNS.DiscoverNameServers()
-                        response = DNS.Request().req(query, qtype='SRV')
-                        # Sort by priority, according to RFC 2782.
-                        answers = sorted(response.answers, key=lambda a: a['data'][0])
-                        if len(answers) > 0:
-                            # ignore the priority and weight for now
-                            _, _, port, host = answers[0]['data']
-                            del _
-                            port = int(port)
-                            break
-                except:
-                    log.debug(M('An error occurred while looking up {0}', query))
-            server = (host, port)
-        else:
-            log.debug(
-                "Could not load one of the supported DNS libraries "
-                "(dnspython or pydns). SRV records will not be queried "
-                "and you may need to set custom hostname/port for some "
-                "servers to be accessible",
-            )
-        # end of SRV resolver
+        targets = self.srv_targets(server)
+        if targets:
+            return targets[0]
         return server
 
+    def srv_targets(self, server, cache=srv_cache):
+        """
+        Return the (host, port) pairs of the '_xmpp-client._tcp.' SRV
+        records for server=(host, port) in the order to try them, an empty
+        list when there are none.
+        """
+        host, port = server
+        return cache.targets('_xmpp-client._tcp.' + host)
+
     def connect(self, server=None, port=None, resolvehost=resolve_host,
-        socket_maker=tcp_socket):
+        socket_maker=tcp_socket, resolver=None, timeout=DNS_TIMEOUT):
         """
         Try to connect to the given host/port.
         """
+        deadline = time.time() + timeout
+        steps = self.connect_steps(
+            server, port, resolvehost, socket_maker, resolver, timeout)
+        for lookup in steps:
+            try:
+                lookup.wait(max(deadline - time.time(), 0))
+            except ResolveTimeout:
+                # The next step raises the TransportError
+                pass
+
+    def connect_steps(self, server=None, port=None, resolvehost=resolve_host,
+            socket_maker=tcp_socket, resolver=None, timeout=DNS_TIMEOUT):
+        """
+        Connect as a generator that yields the pending Lookup while the
+        server name resolves on resolver's threads, the caller resumes it
+        when the lookup is done or on its next pass. Without a resolver the
+        name resolves in place and nothing is yielded. Raise TransportError
+        when the name did not resolve within timeout seconds, closing the
+        generator cancels the lookup. The connect of socket_maker blocks,
+        connect_race_steps yields while connecting too.
+        """
         if not server:
             server = self._server
         if not port:
             port = self._port
         if not self._ip:
-            self._ip = resolvehost(server)
+            if resolver is None:
+                self._ip = resolvehost(server)
+            else:
+                deadline = time.time() + timeout
+                lookup = resolver.submit(resolvehost, server)
+                try:
+                    for i in self._resolving([lookup], server, deadline):
+                        yield i
+                    self._ip = lookup_result(lookup, server)
+                finally:
+                    lookup.cancel()
         self._sock = socket_maker(self._ip, self._port)
         self._sock.connect(self._ip, self._port)
         log.debug(M("Successfully connected to remote host: {0}", self._server))
 
+    def _resolving(self, lookups, name, deadline):
+        """
+        Yield the first pending one of lookups until all of them are done,
+        raise TransportError when they are not done by deadline.
+        """
+        for lookup in lookups:
+            while not lookup.done:
+                if time.time() >= deadline:
+                    raise TransportError(
+                        'Timed out resolving {0}'.format(name))
+                yield lookup
+
+    def connect_race(self, server=None, port=None, attempt_delay=ATTEMPT_DELAY,
+            concurrency=CONCURRENCY, timeout=CONNECT_TIMEOUT,
+            getaddrinfo=socket.getaddrinfo, socket_maker=socket.socket,
+            resolver=None, dns_timeout=DNS_TIMEOUT):
+        """
+        Connect by racing staggered attempts to every address of every SRV
+        target, or of server when it has none, and keep the first socket to
+        connect. Return the RaceResult with the winner and the timings of
+        all attempts. With a resolver the names resolve on its threads, see
+        connect_race_steps.
+        """
+        deadline = time.time() + dns_timeout
+        steps = self.connect_race_steps(
+            server, port, attempt_delay, concurrency, timeout, getaddrinfo,
+            socket_maker, resolver, dns_timeout)
+        for pending in steps:
+            if isinstance(pending, Connecting):
+                pending.wait()
+                continue
+            try:
+                pending.wait(max(deadline - time.time(), 0))
+            except ResolveTimeout:
+                # The next step raises the TransportError
+                pass
+        return self.race_result
+
+    def connect_race_steps(self, server=None, port=None,
+            attempt_delay=ATTEMPT_DELAY, concurrency=CONCURRENCY,
+            timeout=CONNECT_TIMEOUT, getaddrinfo=socket.getaddrinfo,
+            socket_maker=socket.socket, resolver=None, dns_timeout=DNS_TIMEOUT):
+        """
+        connect_race as a generator, like connect_steps. With a resolver
+        the SRV query and then the address lookups of all targets run on
+        its threads, using its own getaddrinfo, and the pending Lookup is
+        yielded meanwhile. Without one they run in place with getaddrinfo.
+        Raise TransportError when no target resolved, or not within
+        dns_timeout seconds. The race itself yields an eyeballs Connecting
+        while attempts are in flight, with or without a resolver.
+        """
+        if not server:
+            server = self._server
+        if not port:
+            port = self._port
+        if resolver is None:
+            targets = []
+            if self.use_srv:
+                targets = self.srv_targets((server, port))
+            if not targets:
+                targets = [(server, port)]
+            attempts = candidates(targets, getaddrinfo)
+        else:
+            deadline = time.time() + dns_timeout
+            lookups = []
+            try:
+                targets = []
+                if self.use_srv:
+                    lookups.append(
+                        resolver.srv_targets('_xmpp-client._tcp.' + server))
+                    for i in self._resolving(lookups, server, deadline):
+                        yield i
+                    targets = lookup_result(lookups[0], server)
+                if not targets:
+                    targets = [(server, port)]
+                infos = {}
+                for target in targets:
+                    infos[target] = resolver.getaddrinfo(*target)
+                lookups.extend(infos.values())
+                for i in self._resolving(lookups, server, deadline):
+                    yield i
+            finally:
+                for lookup in lookups:
+                    lookup.cancel()
+            attempts = candidates(targets,
+                lambda host, port, family, type: infos[(host, port)].result())
+        if not attempts:
+            raise TransportError('Could not resolve {0}'.format(server))
+        r = Race(
+            attempts, attempt_delay=attempt_delay, concurrency=concurrency,
+            timeout=timeout, socket_maker=socket_maker,
+        )
+        for i in r.steps():
+            yield i
+        result = r.result
+        self._sock = result.sock
+        self._ip = result.winner.address[0]
+        self.race_result = result
+        log.debug(M("Successfully connected to remote host: {0} ({1})",
+            result.winner.host, result.summary()))
+
     def recv(self, size=1024):
-        data, self.buffer = self.buffer[:size], self.buffer[size:]
-        return data
+        return self.buffer.read(size)
+
+    def bind(self, stream):
+        """
+        Feed each chunk rawrecv reads straight into the stream's parser
+        instead of keeping it in the receive buffer, the stanzas it holds
+        are in stream.input_buffer as soon as rawrecv returns. The stream
+        gets this transport for backpressure.
+        """
+        self.stream = stream
+        stream.transport = self
+        if self.buffer:
+            self._feed()
+
+    def unbind(self):
+        if self.stream is not None:
+            self.stream.transport = None
+            self.stream = None
 
-    def rawrecv(self, size=1024):
-        data = []
+    def rawrecv(self, size=None):
+        """
+        Read everything the socket has into the receive buffer, or the
+        bound stream, yielding between reads. Without a size each read asks
+        for read_size bytes, which follows the size of the bursts seen so
+        far. Reading stops early once the bound stream pauses it, the rest
+        is left in the socket.
+        """
+        adapt = size is None
+        if adapt:
+            size = self.read_size
+        received = 0
         while True:
-            a = self._sock.recv(size)
-            if a:
-                data.append(a)
-            if not a or len(a) < size:
+            try:
+                count = self._recv_some(size)
+            except socket.error as e:
+                if not received or not would_block(e):
+                    raise
+                break
+            received += count
+            if count < size or not self.reading:
                 break
             yield
-        if not data:
+        if not received:
             raise TransportError('dead socket')
-        log.debug(M('Adding data to buffer: {}', ''.join(data)))
-        self.buffer += ''.join(data)
+        log.debug(M('Added {0} bytes to buffer', received))
+        if adapt:
+            self._adapt_read_size(received)
+
+    def _recv_some(self, size):
+        recv_into = getattr(self._sock, 'recv_into', None)
+        if recv_into is None or self.compressor is not None:
+            data = self._sock.recv(size)
+            if not data:
+                return 0
+            count = len(data)
+            if self.compressor is not None:
+                data = self.compressor.decompress(data)
+            if self.stream is not None:
+                self.stream.parse(data)
+            else:
+                self.buffer.write(data)
+            return count
+        count = recv_into(self.buffer.reserve(size), size)
+        self.buffer.commit(count)
+        if count and self.stream is not None:
+            self._feed()
+        return count
+
+    def _feed(self):
+        """
+        Parse the receive buffer in place and empty it, the same memory
+        takes the next read.
+        """
+        data = self.buffer.readable()
+        try:
+            self.stream.parse(data)
+        finally:
+            self.buffer.consume(len(data))
+
+    def _adapt_read_size(self, burst):
+        """
+        Grow the read size to cover a burst that needed several reads,
+        shrink it slowly after bursts much smaller than it.
+        """
+        size = self.read_size
+        if burst >= size:
+            while size < burst and size < READ_MAX:
+                size *= 2
+        elif burst < size // 4 and size > READ_MIN:
+            size //= 2
+        self.read_size = size
 
     def send(self, data):
-        return self._sock.send(data)
+        """
+        Queue data and send as much of the write queue as the socket takes,
+        return the number of bytes sent.
+        """
+        self.write(data)
+        return self.flush()
+
+    def send_output(self, stream):
+        """
+        Queue everything waiting in the stream's output buffer and flush it
+        with as few system calls as possible.
+        """
+        for data in stream.getoutput_all():
+            self.write(data)
+        return self.flush()
+
+    def write(self, data):
+        """
+        Add data to the write queue without sending it.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._queue(data)
+
+    def _queue(self, data):
+        if data:
+            self.write_buffer.append(data)
+            self.write_size += len(data)
+
+    def flush(self):
+        """
+        Send queued data until the queue is empty or the socket would block.
+        A partial write leaves the unsent remainder at the head of the
+        queue, call flush again once readywrite signals. With compression
+        on, the data written since the last flush is sync flushed first.
+        """
+        if self.compressor is not None:
+            self._queue(self.compressor.flush())
+        total = 0
+        while self.write_buffer:
+            try:
+                sent = self._write_some()
+            except socket.error as e:
+                if would_block(e):
+                    break
+                raise
+            if not sent:
+                break
+            self._consume(sent)
+            total += sent
+        return total
+
+    def _write_some(self):
+        queue = self.write_buffer
+        if len(queue) == 1:
+            return self._sock.send(queue[0])
+        # ssl sockets refuse sendmsg
+        sendmsg = getattr(self._sock, 'sendmsg', None)
+        if sendmsg is not None and not isinstance(self._sock, ssl.SSLSocket):
+            buffers = []
+            for data in queue:
+                buffers.append(data)
+                if len(buffers) == IOV_MAX:
+                    break
+            return sendmsg(buffers)
+        buffers = []
+        size = 0
+        for data in queue:
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            buffers.append(data)
+            size += len(data)
+            if size >= COALESCE or len(buffers) == IOV_MAX:
+                break
+        return self._sock.send(''.join(buffers))
+
+    def _consume(self, sent):
+        """
+        Drop sent bytes from the front of the write queue.
+        """
+        queue = self.write_buffer
+        self.write_size -= sent
+        while sent:
+            size = len(queue[0])
+            if sent < size:
+                queue[0] = memoryview(queue[0])[sent:]
+                break
+            queue.popleft()
+            sent -= size
+
+    @property
+    def writing(self):
+        """
+        True while the write queue holds data waiting for the socket.
+        """
+        return bool(self.write_buffer)
 
     def pending_data(self, timeout=0):
-        return self._sock.pending_data(timeout=timeout)
+        if not self.reading:
+            return False
+        pending_data = getattr(self._sock, 'pending_data', None)
+        if pending_data is None:
+            return poll_socket(self._sock, timeout=timeout)
+        return pending_data(timeout=timeout)
+
+    def pause_reading(self):
+        """
+        Stop reporting pending data until resume_reading is called, the
+        socket is left unread so the peer gets throttled by TCP.
+        """
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
 
     def disconnect(self):
         """ Closes the socket. """
+        if self.tls_cache is not None:
+            # TLS 1.3 tickets arrive after the handshake, keep the latest
+            self.tls_cache.store(self._server, self._port, self._sock)
         self._sock.close()
 
-    def starttls(self):
-        from agent.util import ssl_wrapper
-        self._sock = ssl_wrapper(self._sock)
+    def starttls(self, cache=None):
+        """
+        Do the TLS handshake on the socket. Without a cache the socket is
+        wrapped with ssl_wrapper.
+
+        With a TlsCache, such as agent.xmpp.tls.tls_cache, the handshake
+        uses the context the cache keeps for this server and offers the
+        session of the last connection to it. tls_resumed tells whether
+        the server resumed that session, disconnect stores the session of
+        this connection in the cache.
+        """
+        if cache is None:
+            from agent.util import ssl_wrapper
+            self._sock = ssl_wrapper(self._sock)
+            return
+        self._sock, self.tls_resumed = cache.wrap(
+            self._sock, self._server, self._port)
+        self.tls_cache = cache
+
+    def compress(self, level=LEVEL):
+        """
+        Compress everything sent and received from here on with zlib at
+        level, once the server answered compressed. Return the Compressor,
+        its stats tell the bytes saved.
+        """
+        self.compressor = Compressor(level)
+        log.debug(M("Stream compression on, level {0}", level))
+        return self.compressor
 
     def fileno(self):
         return self._sock.fileno()
 
+    @property
+    def ssl_pending(self):
+        """
+        The number of decrypted bytes the ssl socket holds, its fd does not
+        show them as readable.
+        """
+        if not isinstance(self._sock, ssl.SSLSocket):
+            return 0
+        return self._sock.pending()
+
     @property
     def readywrite(self):
+        if not hasattr(self._sock, 'readywrite'):
+            return poll_socket(self._sock, write=True)
         return self._sock.readywrite
 
     @property
     def readyread(self):
-        return self.buffer != ''
+        return bool(self.buffer)
+
+class BodyDecoder(object):
+    """
+    Decode an HTTP response body chunk by chunk as it is read, inflating
+    it when it is gzip or deflate encoded, and parse the decoded bytes
+    right away. The body is never held in one piece. The children of the
+    body are LazyNodes, kept as the bytes they were parsed from.
+    """
+
+    def __init__(self, encoding=None, parser_cls=XmlParser):
+        self.parser = parser_cls()
+        self.parser.set_lazy_level(2)
+        if encoding == 'gzip':
+            self._inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._inflate = zlib.decompressobj()
+        else:
+            self._inflate = None
+        # Bytes decoded and bytes read off the wire.
+        self.size = 0
+        self.wire = 0
+
+    def feed(self, data):
+        self.wire += len(data)
+        if self._inflate is not None:
+            data = self._inflate.decompress(data)
+        if data:
+            self.size += len(data)
+            self.parser.parse(data)
+
+    def close(self):
+        """
+        Return the root node of the body.
+        """
+        if self._inflate is not None:
+            data = self._inflate.flush()
+            if data:
+                self.size += len(data)
+                self.parser.parse(data)
+        return self.parser.getroot()
+
+class PollStats(object):
+    """
+    Counters of the requests a Bosh transport makes and the responses it
+    gets. Uncovered time is time spent bound without a request parked at
+    the connection manager, a stanza pushed then waits for the next one.
+
+    Push wait is the most a stanza in a response can have waited at the
+    connection manager for a request to carry it, the uncovered gap that
+    ended when that request was posted. It is none for a request posted
+    while another was parked. Round trips are not part of it.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.polls = 0
+        self.responses = 0
+        self.empty_responses = 0
+        self.expired = 0
+        self.uncovered = 0.0
+        self.uncovered_max = 0.0
+        self.pushes = 0
+        self.push_wait = 0.0
+        self.push_wait_max = 0.0
+        self._uncovered = None
+
+    def posted(self, empty, now):
+        """
+        Count a request, return the uncovered gap its posting ended.
+        """
+        self.requests += 1
+        if empty:
+            self.polls += 1
+        if self._uncovered is None:
+            return 0.0
+        gap = now - self._uncovered
+        self.uncovered += gap
+        self.uncovered_max = max(self.uncovered_max, gap)
+        self._uncovered = None
+        return gap
+
+    def received(self, empty, now, in_flight, gap=0.0):
+        """
+        Count a response to a request whose posting ended gap.
+        """
+        self.responses += 1
+        if empty:
+            self.empty_responses += 1
+        else:
+            self.pushes += 1
+            self.push_wait += gap
+            self.push_wait_max = max(self.push_wait_max, gap)
+        if not in_flight and self._uncovered is None:
+            self._uncovered = now
+
+    @property
+    def empty_rate(self):
+        if not self.responses:
+            return 0.0
+        return float(self.empty_responses) / self.responses
+
+    @property
+    def push_wait_mean(self):
+        if not self.pushes:
+            return 0.0
+        return self.push_wait / self.pushes
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'polls': self.polls,
+            'responses': self.responses,
+            'empty_rate': self.empty_rate,
+            'expired': self.expired,
+            'uncovered': self.uncovered,
+            'uncovered_max': self.uncovered_max,
+            'pushes': self.pushes,
+            'push_wait_mean': self.push_wait_mean,
+            'push_wait_max': self.push_wait_max,
+        }
+
+class BoshRequest(object):
+    """
+    A body posted to the connection manager and waiting for its response.
+    """
+
+    __slots__ = ('rid', 'data', 'empty', 'response', 'fileno', 'sent', 'gap')
+
+    def __init__(self, rid, data, empty=False):
+        self.rid = rid
+        self.data = data
+        self.empty = empty
+        self.response = None
+        self.fileno = None
+        self.sent = None
+        # The uncovered time that ended when it was posted, see PollStats
+        self.gap = 0.0
+
+    def __repr__(self):
+        return '<BoshRequest rid={0} fileno={1}{2}>'.format(
+            self.rid, self.fileno, ' empty' if self.empty else '')
 
 class Bosh(object):
     """
@@ -184,7 +831,7 @@ class Bosh(object):
 
     def __init__(self, endpoint, server=None, port=None, wait=80,
             hold=4, requests=5, polling=10, headers={}, GZIP=True, bound=False,
-            pipeline=False):
+            pipeline=False, max_body=MAX_BODY, flush_delay=FLUSH_DELAY):
         url = urlparse(endpoint)
         self._http_host = url.hostname
         self._http_path = url.path
@@ -203,7 +850,11 @@ class Bosh(object):
         self.requests = requests
         self.polling = polling
         self._connections = [] # Will be http or https connection
+        # The requests in flight by rid, and by connection in the order
+        # their responses come.
+        self.inflight = {}
         self._respobjs = {}
+        self._idle = 0
         self.headers = self.default_headers.copy()
         self.headers.update(headers)
         self.GZIP = GZIP
@@ -212,6 +863,14 @@ class Bosh(object):
         self.buffer = ''
         self.t = None
         self.pipeline = pipeline
+        self.reading = True
+        # Stanzas waiting for a free request, see write and flush.
+        self.outgoing = deque()
+        self.outgoing_size = 0
+        self.max_body = max_body
+        self.flush_delay = flush_delay
+        self._queued = None
+        self.stats = PollStats()
 
     def connect(self):
         connection = self._connection()
@@ -260,18 +919,23 @@ class Bosh(object):
             data, self.buffer = self.buffer[:size], self.buffer[size:]
         return data
 
-    def rawrecv(self, size=1024):
+    def rawrecv(self, size=1024, sock=None):
         resp = ''
-        sock = self.pending_data(queue=False)[0]
+        if sock is None:
+            sock = self.pending_data(queue=False)[0]
         if not self._respobjs:
             raise TransportError("Disconnected from server", 'error')
         try:
-            res, data = self._respobjs[sock].pop(0)
-        except IndexError:
+            request = self._respobjs[sock].popleft()
+        except (IndexError, KeyError):
+            # Nothing was asked on this connection, or nothing is left, a
+            # connection that is readable then was closed by the server.
             log.debug(M("DEAD CONNECTION"))
             self.reconnect(sock)
-            self._respobjs.pop(sock)
+            self._forget(sock)
             raise StopIteration
+        self._done(request)
+        res = request.response
         sock = res.socket
         log.debug(M("PROCESSING {} {}", sock.fileno(), self._respobjs))
         try:
@@ -284,21 +948,10 @@ class Bosh(object):
                 log.debug('Detected dead http connection reconnecting')
                 fno = sock.fileno()
                 self.reconnect(fno)
-                log.debug(
-                    M(
-                        "removing response objects for socket {0} {1}",
-                        fno,
-                        self._respobjs[fno]
-                    )
-                )
-                piped = self._respobjs.pop(fno)
-                node = Node.from_string(data)
-                self.rid = node.get_attr('rid')
-                log.debug(M("resend data: {0}", data))
-                self.send(data)
-                for resp, data in piped:
-                    log.debug(M("resend data: {0}", data))
-                    self.send(data)
+                # Send the same bodies again, with the same rids
+                for request in [request] + self._forget(fno):
+                    log.debug(M("resend data: {0}", request.data))
+                    self.post(request.data, empty=request.empty, rid=request.rid)
                 raise StopIteration
             else:
                 # The server sent some data but it was a legit bad
@@ -309,25 +962,19 @@ class Bosh(object):
             reraise(e)
         if res.status == OK:
             # Response to valid client request.
-            headers = dict(res.getheaders())
-            raw_data = []
-            # Read the raw data off the line, yielding for each chunk received
+            decoder = BodyDecoder(res.getheader('content-encoding'))
+            # Decode and parse the body as it comes off the line, yielding
+            # for each chunk received
             while True:
                 a = res.read(size)
                 if a:
-                    raw_data.append(a)
+                    decoder.feed(a)
                 if not a or len(a) < size:
                     break
                 yield
-            if headers.get('content-encoding', None) == 'gzip':
-                a = StringIO()
-                a.write(''.join(raw_data))
-                a.seek(0)
-                gz = gzip.GzipFile(fileobj=a)
-                data = gz.read()
-            else:
-                data = ''.join(raw_data)
-            log.debug(M('got raw bosh data: {0}', data))
+            node = decoder.close()
+            log.debug(M('got bosh body: {0} bytes, {1} on the wire',
+                decoder.size, decoder.wire))
         elif res.status == BAD_REQUEST:
             # Inform client that the format of an HTTP header or binding
             # element is unacceptable.
@@ -349,7 +996,6 @@ class Bosh(object):
         else:
             log.error(M("Recieved status not defined in XEP-1204: {0}", res.status))
             raise TransportError("Disconnected from server")
-        node = Node.from_string(data)
         if node.tag != 'body':
             raise TransportError("Disconnected from server")
         if node.get_attr('type') == 'terminate':
@@ -358,24 +1004,51 @@ class Bosh(object):
             raise TransportError("Disconnected from server")
         resp = self.bosh_to_xmlstream(node)
         res.conn._HTTPConnection__state = _CS_IDLE
+        if self.bound:
+            self.stats.received(
+                not resp, time.time(), self.in_flight, request.gap)
         if resp:
             #self._owner.Dispatcher.Event('', DATA_RECEIVED, resp)
             log.debug(M('Add Received Data: {0}', resp))
-        else:
+        elif not self.bound:
             log.debug(M('Resend data: {0}', resp))
             self.send(resp)
-
-        #if self.accepts_more_requests():
-        #    log.info(M("SEND EXTRA REQUEST"))
-        #    self.send('')
         self.buffer += resp
+        # Re-arm right away, the response freed a request
+        self.schedule()
         raise StopIteration
 
     def send(self, raw_data, headers={}):
         if type(raw_data) != type('') or type(raw_data) != type(u''):
             raw_data = str(raw_data)
         log.debug(M('send raw data {}', raw_data))
-        bosh_data = self.xmlstream_to_bosh(raw_data)
+        self.post(self.xmlstream_to_bosh(raw_data), headers, empty=not raw_data)
+        return len(raw_data)
+
+    def post(self, bosh_data, headers={}, empty=False, rid=None):
+        """
+        POST a body on an idle connection, the response is read by rawrecv.
+        Empty is True for a body without stanzas. The body carries rid, by
+        default the one allocated last.
+        """
+        if isinstance(bosh_data, unicode):
+            bosh_data = bosh_data.encode('utf-8')
+        request = BoshRequest(rid or self.rid, bosh_data, empty)
+        request.response = self._request(bosh_data, headers)
+        request.fileno = request.response.socket.fileno()
+        self.t = request.sent = time.time()
+        self.inflight[request.rid] = request
+        self._respobjs.setdefault(request.fileno, deque()).append(request)
+        if empty:
+            self._idle += 1
+        if self.bound:
+            request.gap = self.stats.posted(empty, request.sent)
+        log.debug(M("SET {0}", request))
+
+    def _request(self, bosh_data, headers):
+        """
+        Send the HTTP request and return the response object to read.
+        """
         default = dict(self.headers)
         default['Host'] = self._http_host
         default['Content-Length'] = len(bosh_data)
@@ -384,7 +1057,6 @@ class Bosh(object):
         headers = dict(default, **headers)
         conn = self.connection()
         conn.request(POST, self._http_path, bosh_data, headers)
-        self.t = time.time()
         respobj = conn.response_class(
                 conn.sock, strict=conn.strict, method=conn._method,
         )
@@ -392,36 +1064,192 @@ class Bosh(object):
         respobj.socket = conn.sock
         respobj.conn = conn
         log.debug(M('send raw data {0}', bosh_data))
-        log.debug(M("SET {} {}", conn.sock.fileno(), respobj))
-        self._respobjs.setdefault(conn.sock.fileno(), []).append((respobj, bosh_data))
-        return len(raw_data)
+        return respobj
+
+    def _done(self, request):
+        """
+        Take a request that was answered, or given up on, out of flight.
+        """
+        if self.inflight.pop(request.rid, None) is not None and request.empty:
+            self._idle -= 1
+
+    def _forget(self, fno):
+        """
+        Take the requests of a connection out of flight and return them.
+        """
+        requests = list(self._respobjs.pop(fno, ()))
+        for request in requests:
+            self._done(request)
+        return requests
+
+    def write(self, data):
+        """
+        Queue a serialized stanza, or stream header, for the next flush.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if not self.outgoing:
+            self._queued = time.time()
+        self.outgoing.append(data)
+        self.outgoing_size += len(data)
+        if data.startswith(DOCHEAD):
+            # Stream headers do not wait for stanzas to join them
+            self.flush(force=True)
+
+    def send_output(self, stream):
+        """
+        Queue everything waiting in the stream's output buffer and flush.
+        """
+        for data in stream.getoutput_all():
+            self.write(data)
+        return self.flush()
+
+    @property
+    def in_flight(self):
+        return len(self.inflight)
+
+    def accepts_more_requests(self):
+        """
+        True while fewer requests than allowed are in flight.
+        """
+        return len(self.inflight) < self.requests
+
+    def flush_timeout(self):
+        """
+        Seconds until the queued stanzas are due to be flushed, None when
+        nothing is queued.
+        """
+        if not self.outgoing:
+            return None
+        return max(self._queued + self.flush_delay - time.time(), 0)
+
+    def flush(self, force=False):
+        """
+        While a request is free, POST the queued stanzas gathered into
+        bodies of at most max_body bytes. Stanzas wait up to flush_delay
+        seconds for others to join them unless force is given or they fill
+        a body already. A stream header is sent in a body of its own.
+        Return the number of requests made.
+        """
+        posted = 0
+        while self.outgoing and self.in_flight < self.requests:
+            if (not force and self.outgoing_size < self.max_body and
+                    time.time() - self._queued < self.flush_delay):
+                break
+            if self.outgoing[0].startswith(DOCHEAD):
+                data = self.outgoing.popleft()
+                self.outgoing_size -= len(data)
+                self.send(data)
+                posted += 1
+                continue
+            payload = []
+            size = 0
+            while self.outgoing and not self.outgoing[0].startswith(DOCHEAD):
+                if payload and size + len(self.outgoing[0]) > self.max_body:
+                    break
+                data = self.outgoing.popleft()
+                payload.append(data)
+                size += len(data)
+            self.outgoing_size -= size
+            log.debug(M("Flush {0} stanzas, {1} bytes", len(payload), size))
+            self.post(self.envelope(''.join(payload)))
+            posted += 1
+        return posted
 
     def pending_data(self, timeout=.001, queue=True):
-        log.debug('pending data select')
+        if not self.reading:
+            return []
         pending = select.select(self.fileno(), [], [], timeout)[0]
-#        if not pending and self.accepts_more_requests():
-#            self.send('')
+        if not pending:
+            self.schedule()
         return pending
 
-    def accepts_more_requests(self):
-        if self.t and time.time() - self.t < self.polling:
-            return False
-        respobjs = []
-        for i in self._respobjs:
-            respobjs.extend(self._respobjs[i])
-        log.debug(M('ACCEPTS {} {} {}', len(respobjs), self.requests, self.hold))
+    def pause_reading(self):
+        """
+        Stop reporting pending responses until resume_reading is called.
+        """
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    @property
+    def idle(self):
+        """
+        The number of empty requests parked at the connection manager.
+        """
+        return self._idle
+
+    def schedule(self):
+        """
+        Flush the queued stanzas and, once bound, keep hold requests parked
+        at the connection manager, so it can push stanzas as soon as they
+        arrive. One of the requests allowed is left for stanzas to send,
+        unless only one is allowed. Without hold, poll at most every
+        polling seconds. Requests not answered within wait seconds, and a
+        margin, are sent again on a new connection. Return the number of
+        requests made.
+        """
         if not self.bound:
-            # XXX This should depend more on the stream being
-            # 'negotiated' or not.
-            return False
-        if not respobjs:
-            return True
-        return len(respobjs) < self.requests - 1
+            # Stanzas queued while every request was in flight still go
+            # out as soon as a response frees one
+            return self.flush()
+        self._expire()
+        posted = self.flush()
+        if self.hold:
+            parked = min(self.hold, max(self.requests - 1, 1))
+            while self.in_flight < parked:
+                self.post(self.envelope(), empty=True)
+                posted += 1
+        elif not self.in_flight and self.schedule_timeout() == 0:
+            self.post(self.envelope(), empty=True)
+            posted += 1
+        return posted
+
+    def schedule_timeout(self):
+        """
+        Seconds until schedule has a request to make, None when it waits on
+        the responses in flight.
+        """
+        timeout = self.flush_timeout()
+        if not self.hold and not self.in_flight:
+            wait = max((self.t or 0) + self.polling - time.time(), 0)
+            if timeout is None or wait < timeout:
+                timeout = wait
+        return timeout
+
+    def _expire(self):
+        deadline = time.time() - self.wait - WAIT_MARGIN
+        for fno, requests in list(self._respobjs.items()):
+            # The oldest request of a connection is first
+            if not requests or requests[0].sent >= deadline:
+                continue
+            log.debug(M("Requests on {0} expired, sending them again", fno))
+            self.reconnect(fno)
+            for request in self._forget(fno):
+                self.stats.expired += 1
+                self.post(request.data, empty=request.empty, rid=request.rid)
 
     @property
     def rid(self):
         """
-        An auto incrementing response id.
+        The rid allocated last, None before the first.
+        """
+        if not self._rid:
+            return None
+        return str(self._rid)
+
+    @rid.setter
+    def rid(self, rid):
+        """
+        Set the rid's next value, see reset_rid.
+        """
+        self.reset_rid(rid)
+
+    def next_rid(self):
+        """
+        Allocate the rid of the next body, the first is random and each one
+        after it is one more than the last.
         """
         if not self._rid:
             self._rid = random.randint(0, 10000000)
@@ -429,12 +1257,11 @@ class Bosh(object):
             self._rid += 1
         return str(self._rid)
 
-    @rid.setter
-    def rid(self, i):
+    def reset_rid(self, rid):
         """
-        Set the rid's next value
+        Make rid the next one allocated.
         """
-        self._rid = int(i) - 1
+        self._rid = int(rid) - 1
 
     def bind(self, rid, sid, hold, wait, requests, polling):
         self._rid = rid
@@ -447,13 +1274,6 @@ class Bosh(object):
         self.bound = True
 
     def fileno(self):
-        log.debug(
-            M(
-                "The status of the current http requests are {}",
-                [i._HTTPConnection__state for i in self._connections],
-            )
-        )
-        log.debug(M("The respobjs object looks like {}",self._respobjs))
         filenos = [i.sock.fileno() for i in self._connections]
         assert filenos
         return filenos
@@ -462,23 +1282,41 @@ class Bosh(object):
         if 'sid' in node.attrs:
             self._sid = node.get_attr('sid')
             self.AuthId = node.get_attr('authid')
-            self.wait = int(node.get_attr('wait') or self.wait)
-            self.hold = int(node.get_attr('hold') or self.hold)
-            self.polling = int(node.get_attr('polling') or self.hold)
-            self.requests = int(node.get_attr('requests') or self.requests)
+            # hold='0' is a valid answer, only missing ones keep the default
+            self.wait = session_int(node, 'wait', self.wait)
+            self.hold = session_int(node, 'hold', self.hold)
+            self.polling = session_int(node, 'polling', self.polling)
+            self.requests = session_int(node, 'requests', self.requests)
             stream=Node('stream:stream', payload=node.payload)
             stream.namespace = 'jabber:client'
             stream.set_attr('version','1.0')
             stream.set_attr('from', 'dev.az.h4.cx')
             stream.set_attr('id', node.get_attr('sid'))
             data = stream.to_string()[:-len('</stream:stream>')]
-            resp = "<?xml version='1.0'?>{0}".format(data)
+            resp = u"<?xml version='1.0'?>" + data
         elif node.get_children():
-            resp = ''.join(i.to_string() for i in node.get_children())
+            # Stanzas received as raw bytes are passed on as they came, as
+            # text like the ones serialized again
+            resp = u''.join(
+                i.raw.decode('utf-8') if i.raw is not None else i.to_string()
+                for i in node.get_children()
+            )
         else:
-            resp = ''
+            resp = u''
         return resp
 
+    def envelope(self, payload=''):
+        """
+        Wrap the serialized stanzas in payload in a body, built as a string
+        so they are not parsed and serialized again.
+        """
+        start = BODY_START.format(xmlescape(self.xml_lang), self.next_rid())
+        if self._sid:
+            start += ' sid="{0}"'.format(xmlescape(self._sid))
+        if not payload:
+            return start + '/>'
+        return start + '>' + payload + '</body>'
+
     def xmlstream_to_bosh(self, stream):
         if stream.startswith("<?xml version='1.0'?>"):
             # Sanitize stream tag so that it is suitable for parsing.
@@ -509,17 +1347,11 @@ class Bosh(object):
                     body.set_attr('route', route)
         else:
             # Mid stream, wrap the xml stanza in a BOSH body wrapper
-            if stream:
-                if type(stream) == type('') or type(stream) == type(u''):
-                    stream = Node.from_string(stream)
-                stream = [stream]
-            else:
-                stream = []
-            body = Node('body', payload=stream)
+            return self.envelope(stream)
         body.namespace = 'http://jabber.org/protocol/httpbind'
         body.set_attr('content', 'text/xml; charset=utf-8')
         body.set_attr('xml:lang', self.xml_lang)
-        body.set_attr('rid', self.rid)
+        body.set_attr('rid', self.next_rid())
         if self._sid:
             body.set_attr('sid', self._sid)
         return body.to_string()
@@ -9,71 +9,231 @@ log = logging.getLogger(__name__)
 DOCHEAD = """<?xml version='1.0'?>"""
 
 ESCAPECHARS = [
-    ('&', '&amp;'),
+    ('&', '&amp;'), # Must come first
     ('<', '&lt;'),
     ('>', '&gt;'),
-    ('"', '&quote;'),
+    ('"', '&quot;'),
     ("'", '&#39;'), # &apos; not in HTML 4
 ]
 
+ESCAPED = re.compile('(&amp;|&quot;|&#39;|&gt;|&lt;|&#60;|&#62;|&#34;|&#38;|&apos;)')
+
 def xmlescape(s, chars=ESCAPECHARS):
-    if isescaped(s):
-        return s
+    """
+    Escape s for use as text or as an attribute value. Only the characters
+    actually present in s get replaced, so strings without any special
+    characters are returned as they are after a few C level scans.
+    """
     for a, b in chars:
-        s = s.replace(a, b)
+        if a in s:
+            s = s.replace(a, b)
     return s
 
-def isescaped(s):
-    r = re.compile('(&amp;|&quote|&#39;|&gt;|&lt;|&#60;|&#62;|&#34;|&#38;|&apos;)')
-    return r.search(s) is not None
+class EscapeCache(object):
+    """
+    A bounded memo for an escape function, useful for values that are
+    serialized over and over like JIDs and namespaces. Pass an instance as
+    the escape argument of the serializers. The cache is cleared once it
+    holds maxsize entries and values longer than maxlen are never cached.
+    """
+
+    def __init__(self, escape=xmlescape, maxsize=2048, maxlen=256):
+        self.escape = escape
+        self.maxsize = maxsize
+        self.maxlen = maxlen
+        self.cache = {}
+
+    def __call__(self, s):
+        try:
+            return self.cache[s]
+        except KeyError:
+            pass
+        e = self.escape(s)
+        if len(s) <= self.maxlen:
+            if len(self.cache) >= self.maxsize:
+                self.cache.clear()
+            self.cache[s] = e
+        return e
+
+xmlescape_cached = EscapeCache()
 
-def to_string(node, escape=xmlescape, level=0, pretty=False):
-    if pretty:
-        nlifp = '\n'
-    else:
-        nlifp = ''
-    s = '  ' * level
-    if node.prefix:
-        s += '<{0}:{1}'.format(node.prefix, node.tag)
+def isescaped(s):
+    return ESCAPED.search(s) is not None
+
+def _write_start(node, write, escape):
+    """
+    Write the start tag of node, without the closing bracket, and return
+    the qualified tag name.
+    """
+    if node._prefix:
+        name = '{0}:{1}'.format(node._prefix, node._tag)
     else:
-        s += '<{0}'.format(node.tag)
-    for k in node._nsmap:
-        if k:
-            s += ' xmlns:{0}="{1}"'.format(k, node._nsmap[k])
-        else:
-            s += ' xmlns="{0}"'.format(node._nsmap[k])
+        name = node._tag
+    write('<')
+    write(name)
+    nsmap = node._nsmap
+    if nsmap:
+        for k in nsmap:
+            if k:
+                write(' xmlns:')
+                write(k)
+                write('="')
+            else:
+                write(' xmlns="')
+            write(escape(nsmap[k]))
+            write('"')
     #if node.namespace:
     #    if not node.parent or node.parent.namespace != node.namespace:
     #        s = s + ' xmlns="{0}"'.format(node.namespace)
-    for key in node.attrs:
-        s += ' {0}="{1}"'.format(key, escape(str(node.attrs[key])))
-    if node.payload:
-        s += '>{0}'.format(nlifp)
-        for i in node.payload:
-            if isinstance(i, node.__class__):
-                if pretty:
-                    level += 1
-                s += to_string(i, escape, level, pretty)
-                if pretty:
-                    level -= 1
+    attrs = node._attrs or ()
+    for key in attrs:
+        val = attrs[key]
+        if not isinstance(val, basestring):
+            val = str(val)
+        write(' ')
+        write(key)
+        write('="')
+        write(escape(val))
+        write('"')
+    return name
+
+def write_node(node, write, escape=xmlescape, level=0, pretty=False):
+    """
+    Serialize node by calling write once for each chunk of output. Nothing
+    is concatenated along the way so the cost is linear in the size of
+    the tree.
+    """
+    raw = node.raw
+    if raw is not None and not pretty:
+        write(raw.decode('utf-8'))
+        return
+    if pretty:
+        indent = '  ' * level
+        write(indent)
+    name = _write_start(node, write, escape)
+    payload = node._payload
+    if not payload:
+        write('/>')
+    else:
+        write('>')
+        if pretty:
+            write('\n')
+        for i in payload:
+            if isinstance(i, Node):
+                write_node(i, write, escape, level + 1, pretty)
+            elif i.__class__ is RawXml:
+                write(i)
             else:
                 if pretty:
-                    s += '  ' * (level + 1)
-                s += '{0}{1}'.format(escape(i), nlifp)
-        s += '  ' * level
-        if node.prefix:
-            s += '</{0}:{1}>{2}'.format(node.prefix, node.tag, nlifp)
+                    write(indent)
+                    write('  ')
+                write(escape(i))
+                if pretty:
+                    write('\n')
+        if pretty:
+            write(indent)
+        write('</')
+        write(name)
+        write('>')
+    if pretty and level:
+        write('\n')
+
+def iter_string(node, escape=xmlescape, level=0, pretty=False):
+    """
+    Generate the serialized node in chunks. The start and end tags are
+    yielded on their own and each child is yielded as it gets serialized,
+    so only one child is held in memory at a time.
+    """
+    raw = node.raw
+    if raw is not None and not pretty:
+        yield raw.decode('utf-8')
+        return
+    chunks = []
+    write = chunks.append
+    if pretty:
+        write('  ' * level)
+    name = _write_start(node, write, escape)
+    payload = node._payload
+    if not payload:
+        write('/>')
+        if pretty and level:
+            write('\n')
+        yield ''.join(chunks)
+        return
+    write('>')
+    if pretty:
+        write('\n')
+    yield ''.join(chunks)
+    for i in payload:
+        del chunks[:]
+        if isinstance(i, Node):
+            write_node(i, write, escape, level + 1, pretty)
+        elif i.__class__ is RawXml:
+            write(i)
         else:
-            s += '</{0}>{1}'.format(node.tag, nlifp)
-    else:
-        s += '/>{0}'.format(nlifp)
-    if level == 0:
-        return s.strip()
-    return s
+            if pretty:
+                write('  ' * (level + 1))
+            write(escape(i))
+            if pretty:
+                write('\n')
+        yield ''.join(chunks)
+    del chunks[:]
+    if pretty:
+        write('  ' * level)
+    write('</')
+    write(name)
+    write('>')
+    if pretty and level:
+        write('\n')
+    yield ''.join(chunks)
+
+def writer(sink, encoding='utf-8'):
+    """
+    Return a write function for sink. A sink can be a list, a bytearray,
+    anything with a write method or a callable taking each chunk.
+    """
+    if isinstance(sink, bytearray):
+        def write(s):
+            if isinstance(s, unicode):
+                s = s.encode(encoding)
+            sink.extend(s)
+        return write
+    if isinstance(sink, list):
+        return sink.append
+    if hasattr(sink, 'write'):
+        return sink.write
+    return sink
+
+def serialize(node, sink, escape=xmlescape, pretty=False):
+    """
+    Serialize node into sink, see writer for the kinds of sinks supported.
+    """
+    write_node(node, writer(sink), escape, pretty=pretty)
+    return sink
+
+def to_string(node, escape=xmlescape, level=0, pretty=False):
+    chunks = []
+    write_node(node, chunks.append, escape, level, pretty)
+    return ''.join(chunks)
 
 def node_builder(parser, tag, attrs, level):
     return Node(tag, attrs)
 
+# Parse filter actions, see XmlParser.register_filter.
+SKIP = 'skip'
+RAW = 'raw'
+
+class RawXml(unicode):
+    """
+    Serialized XML kept as is in a payload, it is written out without
+    escaping.
+    """
+
+# The start tag at a position, group 1 is the slash of an empty element.
+START_TAG = re.compile(
+    r'<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>'
+)
+
 class XmlParser(object):
 
     def __init__(self, name='', level=0, current_element=None, buffer_text=True,
@@ -85,6 +245,16 @@ class XmlParser(object):
         self._configure_parser(buffer_text)
         self.node_builder = node_builder
         self.handlers = {'start':[], 'end':[]}
+        self.filters = {}
+        self.lazy_level = 0
+        # Input retained while elements are captured as raw bytes, _offset
+        # is the byte index of the first retained byte.
+        self._data = None
+        self._offset = 0
+        self._keep = 0
+        self._skip_start = 0
+        self._skip_depth = 0
+        self._skip_done = None
 
     def _configure_parser(self, buffer_text):
         self.parser = xml.parsers.expat.ParserCreate()
@@ -96,14 +266,32 @@ class XmlParser(object):
 
     def StartElementHandler(self, tag, attrs):
         self.level += 1
-        e = self.node_builder(self, tag, attrs, self.level)
+        if self._data is not None:
+            self._keep = self.parser.CurrentByteIndex
+        if self.level == self.lazy_level:
+            e = LazyNode(tag, attrs)
+            if self.filters:
+                e._filters = self.filters
+        else:
+            e = self.node_builder(self, tag, attrs, self.level)
+        action = None
         if self.level > 1:
             p = self.current_element
+            if self.filters and self.level != self.lazy_level:
+                e.parent = p
+                action = self._match_filter(e)
+                if action == SKIP:
+                    self._skip(self._skip_filtered)
+                    return
             p.add_child(e)
         self.current_element = e
         for handler in self.handlers['start']:
             handler(self.name, self.level, e)
         log.debug(M('StartElementHandler: {0} {1}', tag, self.level))
+        if self.level == self.lazy_level:
+            self._skip(self._lazy_done)
+        elif action == RAW:
+            self._skip(self._raw_filtered)
 
     def EndElementHandler(self, tag):
         log.debug(M('EndElementHandler: {0} {1}', tag, self.level, self.current_element))
@@ -122,10 +310,130 @@ class XmlParser(object):
     def StartNamespaceDeclHandler(self, prefix, url):
         log.debug(M('StartNamespaceDeclHandler: {0} {1}', prefix, url))
 
+    def _skip(self, done):
+        """
+        Stop building nodes for the content of the current element. Expat
+        gets handlers that only track depth until the element closes, then
+        done is called with the byte index just past the element, or None
+        when the input is not retained, and parsing carries on as usual.
+        """
+        self._skip_start = self.parser.CurrentByteIndex
+        self._skip_depth = 0
+        self._skip_done = done
+        self.parser.StartElementHandler = self._SkipStartHandler
+        self.parser.EndElementHandler = self._SkipEndHandler
+        self.parser.CharacterDataHandler = None
+
+    def _SkipStartHandler(self, tag, attrs):
+        self._skip_depth += 1
+
+    def _SkipEndHandler(self, tag):
+        if self._skip_depth:
+            self._skip_depth -= 1
+            return
+        self.parser.StartElementHandler = self.StartElementHandler
+        self.parser.EndElementHandler = self.EndElementHandler
+        self.parser.CharacterDataHandler = self.CharacterDataHandler
+        done, self._skip_done = self._skip_done, None
+        done(tag)
+
+    def _element_span(self, start):
+        """
+        Return the byte indexes where the content of the element starting at
+        start begins and ends, and the index just past the element. To be
+        called from its end handler.
+        """
+        data, offset = self._data, self._offset
+        m = START_TAG.match(data, start - offset)
+        content = m.end() + offset
+        if m.end(1) > m.start(1):
+            return content, content, content
+        index = self.parser.CurrentByteIndex
+        return content, index, data.find(b'>', index - offset) + 1 + offset
+
+    def _raw(self, start, end):
+        return bytes(self._data[start - self._offset:end - self._offset])
+
+    def _lazy_done(self, tag):
+        _, _, end = self._element_span(self._skip_start)
+        self._keep = end
+        self.current_element._set_raw(self._raw(self._skip_start, end))
+        self.EndElementHandler(tag)
+
+    def _raw_filtered(self, tag):
+        start, stop, end = self._element_span(self._skip_start)
+        self._keep = end
+        if stop > start:
+            raw = RawXml(self._raw(start, stop).decode('utf-8'))
+            self.current_element.payload = [raw]
+        self.EndElementHandler(tag)
+
+    def _skip_filtered(self, tag):
+        self.level -= 1
+
+    def _match_filter(self, node):
+        filters = self.filters
+        tag = node._tag
+        action = filters.get((tag, None))
+        if action is None:
+            namespace = node.namespace
+            action = filters.get((tag, namespace)) or \
+                filters.get((None, namespace))
+        return action
+
+    def register_filter(self, tag=None, namespace=None, action=SKIP):
+        """
+        Filter the elements with the given tag and/or namespace out of the
+        parse. With action SKIP their subtrees are left out of the tree
+        entirely, with RAW the element is kept but its content is one
+        RawXml string. No nodes are built and no character data handlers
+        are called inside filtered subtrees.
+        """
+        if tag is None and namespace is None:
+            raise ValueError('A filter needs a tag or a namespace')
+        if action not in (SKIP, RAW):
+            raise ValueError('Unknown filter action: {0}'.format(action))
+        self.filters[(tag, namespace)] = action
+        if action == RAW and self._data is None:
+            self._data = bytearray()
+
+    def unregister_filter(self, tag=None, namespace=None):
+        self.filters.pop((tag, namespace), None)
+
+    def _release(self):
+        """
+        Drop the retained input that no element being captured needs.
+        """
+        if self._skip_done is not None:
+            keep = self._skip_start
+        else:
+            keep = self._keep
+        if keep > self._offset:
+            del self._data[:keep - self._offset]
+            self._offset = keep
+
     def parse(self, s):
+        # Text is fed as utf-8, expat would encode it as ascii
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        if self._data is None:
+            self.parser.Parse(s)
+            return self
+        self._data.extend(s)
         self.parser.Parse(s)
+        self._release()
         return self
 
+    def set_lazy_level(self, level):
+        """
+        Build the elements at level as LazyNodes, their content is kept as
+        raw bytes and only parsed when it is used. Level 2 of a stream are
+        its stanzas. This needs to be set before parsing starts.
+        """
+        self.lazy_level = level
+        if self._data is None:
+            self._data = bytearray()
+
     def getroot(self):
         if len(self.elements) > 1:
             raise Exception("Multiple root elements")
@@ -150,37 +458,129 @@ class XmlParser(object):
 def from_string(data, parser_cls=XmlParser):
     return parser_cls().parse(data).getroot()
 
+EMPTY_SCOPE = {}
+
+# Children are indexed once a node holds this many payload items.
+INDEX_THRESHOLD = 16
+
+class Payload(list):
+    """
+    The children of a node. Changes other than adding to it are counted,
+    the count and the length tell whether the child index of the node is
+    still up to date.
+    """
+
+    __slots__ = ('version',)
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.version = 0
+
+    def _changed(self):
+        self.version += 1
+
+    def __setitem__(self, *args):
+        list.__setitem__(self, *args)
+        self._changed()
+
+    def __delitem__(self, *args):
+        list.__delitem__(self, *args)
+        self._changed()
+
+    if hasattr(list, '__setslice__'):
+        def __setslice__(self, *args):
+            list.__setslice__(self, *args)
+            self._changed()
+
+        def __delslice__(self, *args):
+            list.__delslice__(self, *args)
+            self._changed()
+
+    def __imul__(self, n):
+        self._changed()
+        return list.__imul__(self, n)
+
+    def remove(self, *args):
+        list.remove(self, *args)
+        self._changed()
+
+    def pop(self, *args):
+        self._changed()
+        return list.pop(self, *args)
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
+
+    def clear(self):
+        del self[:]
+
 class Node(object):
+    """
+    An XML element. Nodes are built by the thousands while parsing so they
+    use slots, and the attribute, namespace and payload containers are
+    only allocated once something is put in them.
+
+    The namespaces in scope for a node are resolved once and cached. Nodes
+    that declare no namespaces share the scope of their parent, the cache
+    of a subtree is dropped when it is re-parented or a declaration in it
+    changes.
+
+    Nodes with many children build an index of them by tag and by (tag,
+    namespace) on the first lookup, add_child keeps it up to date. The
+    payload is a Payload list, changing it in place or renaming a child
+    makes the index stale and it is rebuilt on the next lookup.
+    """
+
+    __slots__ = (
+        '_tag', '_prefix', '_parent', '_attrs', '_nsmap', '_payload', '_scope',
+        '_index', '_indexed',
+    )
 
     _to_string = to_string
     _from_string = staticmethod(from_string)
 
-    def __init__(self, tag=None, attrs={}, payload=[], parent=None, prefix=None, namespace=''):
-        self._nsmap = {}
-        self._attrs = {}
-        self.attrs = dict(attrs)
+    # The original bytes of the node when they can be reused, see LazyNode.
+    raw = None
+
+    def __init__(self, tag=None, attrs=None, payload=None, parent=None, prefix=None, namespace=''):
+        self._nsmap = None
+        self._attrs = None
+        self._payload = None
+        self._scope = None
+        self._index = None
+        self._indexed = None
+        self._parent = None
+        if attrs:
+            self.attrs = dict(attrs)
         if tag and ':' in tag:
             prefix, tag = tag.split(':')
-        self.tag = tag
-        self.prefix = prefix # Namespace Prefix
+        self._tag = tag
+        self._prefix = prefix # Namespace Prefix
         self.parent = parent
         if namespace:
             self.namespace = namespace # Namespace
-        self.payload = []
-        for a in payload:
-            self.add_child(a)
+        if payload:
+            for a in payload:
+                self.add_child(a)
 
     def set_attr(self, key, val):
         self.attrs[key] = val
 
     def get_attr(self, key):
-        return self.attrs.get(key, None)
+        if self._attrs:
+            return self._attrs.get(key, None)
 
     def get_children(self):
         children = []
-        for a in self.payload:
-            if isinstance(a, Node):
-                children.append(a)
+        if self._payload:
+            for a in self._payload:
+                if isinstance(a, Node):
+                    children.append(a)
         return children
 
     def add_child(self, a):
@@ -188,7 +588,16 @@ class Node(object):
             a.parent = self
         else:
             a = a.strip()
-        self.payload.append(a)
+        payload = self._payload
+        if payload is None:
+            payload = self._payload = Payload((a,))
+        else:
+            payload.append(a)
+        index = self._index
+        if index is not None and self._indexed == (payload.version, len(payload) - 1):
+            if isinstance(a, Node):
+                self._index_child(index, a)
+            self._indexed = (payload.version, len(payload))
 
     def get_tags(self, name=None, attrs={}, namespace=None, one=0):
         """
@@ -196,27 +605,94 @@ class Node(object):
         Returns the list of nodes found.
         """
         nodes=[]
-        for node in self.get_children():
-            if not node:
-                continue
-            if namespace and namespace != node.namespace:
-                log.debug(M('bad namespace: {0} {1}', namespace, node.namespace))
-                continue
-            if node.tag == name or name is None:
-                if attrs:
-                    for key in attrs.keys():
-                        if key not in node.attrs or node.attrs[key] != attrs[key]:
-                            break
+        if name is None:
+            candidates = self.get_children()
+            if namespace:
+                candidates = [i for i in candidates if i.namespace == namespace]
+        else:
+            candidates = self._find(name, namespace or None)
+        for node in candidates:
+            if attrs:
+                node_attrs = node._attrs or {}
+                for key in attrs:
+                    if key not in node_attrs or node_attrs[key] != attrs[key]:
+                        break
                 else:
                     nodes.append(node)
+            else:
+                nodes.append(node)
             if one and nodes:
                 return nodes[0]
         if not one:
             return nodes
 
+    def find(self, name, namespace=None):
+        """
+        Return the first child with the given tag, and namespace when one
+        is given, or None.
+        """
+        for node in self._find(name, namespace):
+            return node
+
+    def findall(self, name, namespace=None):
+        """
+        Return the list of children with the given tag, and namespace when
+        one is given.
+        """
+        return list(self._find(name, namespace))
+
+    def _find(self, name, namespace):
+        index = self._get_index()
+        if index is not None:
+            if namespace is None:
+                return index.get(name, ())
+            return index.get((name, namespace), ())
+        return self._scan(name, namespace)
+
+    def _scan(self, name, namespace):
+        for node in self._payload or ():
+            if not isinstance(node, Node) or node._tag != name:
+                continue
+            if namespace is None or node.namespace == namespace:
+                yield node
+
+    def _get_index(self):
+        """
+        Return the child index, building it when the payload is large
+        enough to be worth it. The change count and length of the payload it
+        was built for are kept with it, a change to the payload since
+        changes one of them.
+        """
+        payload = self._payload
+        if not payload or len(payload) < INDEX_THRESHOLD:
+            return None
+        index = self._index
+        indexed = (payload.version, len(payload))
+        if index is None or self._indexed != indexed:
+            index = {}
+            for node in payload:
+                if isinstance(node, Node):
+                    self._index_child(index, node)
+            self._index = index
+            self._indexed = indexed
+        return index
+
+    @staticmethod
+    def _index_child(index, node):
+        tag = node._tag
+        if tag in index:
+            index[tag].append(node)
+        else:
+            index[tag] = [node]
+        key = (tag, node.namespace)
+        if key in index:
+            index[key].append(node)
+        else:
+            index[key] = [node]
+
     def __repr__(self):
         return "<Node(tag='{0}', attrs={1}, ...)>".format(
-            self.tag, str(self.attrs)
+            self.tag, str(self._attrs or {})
         )
 
     def to_string(self):
@@ -225,12 +701,23 @@ class Node(object):
     def to_pretty_string(self):
         return self._to_string(pretty=True)
 
+    def serialize(self, sink, pretty=False):
+        return serialize(self, sink, pretty=pretty)
+
+    def iter_string(self, pretty=False):
+        return iter_string(self, pretty=pretty)
+
     def set_ns(self, key, val):
         if ':' in key:
             _, key = key.split(':')
         else:
             key = None
+        if self._nsmap is None:
+            self._nsmap = {}
         self._nsmap[key] = val
+        self._drop_scope()
+        if self._parent is not None:
+            self._parent._index = None
 
     @classmethod
     def from_string(cls, data):
@@ -238,33 +725,118 @@ class Node(object):
 
     @property
     def attrs(self):
+        if self._attrs is None:
+            self._attrs = {}
         return self._attrs
 
     @attrs.setter
     def attrs(self, attrs):
-        for x in attrs.copy():
-            if x.startswith('xmlns'):
-                self.set_ns(x, attrs.pop(x))
+        for x in [x for x in attrs if x.startswith('xmlns')]:
+            self.set_ns(x, attrs.pop(x))
         self._attrs = attrs
 
+    @property
+    def tag(self):
+        return self._tag
+
+    @tag.setter
+    def tag(self, tag):
+        self._tag = tag
+        if self._parent is not None:
+            self._parent._index = None
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @prefix.setter
+    def prefix(self, prefix):
+        self._prefix = prefix
+        if self._parent is not None:
+            self._parent._index = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = Payload()
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        if payload is not None and not isinstance(payload, Payload):
+            payload = Payload(payload)
+        self._payload = payload
+        self._index = None
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        self._drop_scope()
+
     @property
     def namespace(self):
-        if self.prefix in self.nsmap:
-            return self.nsmap[self.prefix]
+        return self._get_scope().get(self._prefix)
 
     @namespace.setter
     def namespace(self, namespace):
-        self._nsmap[self.prefix] = namespace
+        if self._nsmap is None:
+            self._nsmap = {}
+        self._nsmap[self._prefix] = namespace
+        self._drop_scope()
+        if self._parent is not None:
+            self._parent._index = None
 
     @property
     def nsmap(self):
-        nsmap = {}
-        parents = self._get_parents()
-        parents.reverse()
-        for p in parents:
-            nsmap.update(p._nsmap)
-        nsmap.update(self._nsmap)
-        return nsmap
+        return dict(self._get_scope())
+
+    def _get_scope(self):
+        """
+        Return the mapping of prefixes to namespaces in scope for this
+        node. The mapping is shared and must not be modified.
+        """
+        scope = self._scope
+        if scope is not None:
+            return scope
+        # Walk up to the closest ancestor with a resolved scope and resolve
+        # the chain back down from there.
+        chain = []
+        node = self
+        while node is not None and node._scope is None:
+            chain.append(node)
+            node = node._parent
+        scope = EMPTY_SCOPE if node is None else node._scope
+        for node in reversed(chain):
+            if node._nsmap:
+                scope = dict(scope)
+                scope.update(node._nsmap)
+            node._scope = scope
+        return scope
+
+    def _drop_scope(self):
+        """
+        Forget the resolved scopes and child indexes of this node and its
+        descendants. A node only has a resolved scope when its parent has
+        one, and indexing resolves the scope of the indexed node, so the
+        walk stops at the first node without one.
+        """
+        if self._scope is None:
+            return
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node._scope is None:
+                continue
+            node._scope = None
+            node._index = None
+            if node._payload:
+                for i in node._payload:
+                    if isinstance(i, Node):
+                        stack.append(i)
 
     def get_root(self):
         return self._get_parents()[-1]
@@ -276,3 +848,74 @@ class Node(object):
             parents.append(node.parent)
             node = node.parent
         return parents
+
+_payload_slot = Node._payload
+
+class LazyNode(Node):
+    """
+    A node built only as far as its own tag and attributes, the rest of
+    the element is kept as the raw bytes it was parsed from. The children
+    are parsed the first time the payload is used. Until then, and as long
+    as its attributes and namespace declarations are unchanged, the node
+    serializes to its original bytes, which raw returns for forwarding.
+    """
+
+    __slots__ = ('_raw', '_raw_attrs', '_raw_nsmap', '_filters')
+
+    def __init__(self, *args, **kwargs):
+        self._raw = None
+        self._filters = None
+        Node.__init__(self, *args, **kwargs)
+
+    def _set_raw(self, raw):
+        self._raw = raw
+        self._raw_attrs = dict(self._attrs or {})
+        self._raw_nsmap = dict(self._nsmap or {})
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            return None
+        if (self._attrs or {}) != self._raw_attrs:
+            return None
+        if (self._nsmap or {}) != self._raw_nsmap:
+            return None
+        return self._raw
+
+    @property
+    def _payload(self):
+        if self._raw is not None:
+            self._materialize()
+        return _payload_slot.__get__(self, LazyNode)
+
+    @_payload.setter
+    def _payload(self, payload):
+        _payload_slot.__set__(self, payload)
+
+    def _materialize(self):
+        raw, self._raw = self._raw, None
+        parser = XmlParser()
+        if self._filters:
+            for (tag, namespace), action in self._filters.items():
+                parser.register_filter(tag, namespace, action)
+        # The raw bytes only declare the namespaces of the node itself, the
+        # copy parsed from them starts from the scope of the node so the
+        # children resolve the namespaces they inherit, and filters see them.
+        scope = self._get_scope()
+        def inherit(name, level, node):
+            if level == 1:
+                node._scope = scope
+        parser.register_start_handler(inherit)
+        payload = parser.parse(raw).getroot()._payload
+        if payload:
+            for i in payload:
+                if isinstance(i, Node):
+                    i.parent = self
+        _payload_slot.__set__(self, payload)
+
+    def _drop_scope(self):
+        if self._raw is None:
+            Node._drop_scope(self)
+        else:
+            self._scope = None
+            self._index = None
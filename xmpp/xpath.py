@@ -0,0 +1,262 @@
+"""
+A small path language for pulling data out of Node trees.
+
+    iq/query[@xmlns=jabber:iq:roster]/item/@jid
+
+A path is a list of steps separated by '/'. The first step matches the
+node the path is evaluated against, each following step matches its
+children. A step is a tag name, optionally with a prefix, or '*', followed
+by any number of predicates:
+
+    [@attr]         the attribute is present
+    [@attr=value]   the attribute has the value, quotes are optional
+    [@xmlns=uri]    the node is in the namespace uri
+
+A path can end in '@attr' to select attribute values or 'text()' to select
+the text of the matched nodes.
+
+Paths are compiled once and cached into a chain of one function per step,
+so evaluation allocates nothing but the result list and uses the child
+index of Node for tag and namespace lookups on large nodes.
+"""
+import re
+
+from agent.xmpp.xmlutil import Node, INDEX_THRESHOLD
+
+class PathError(Exception):
+    """
+    Raise for paths that can not be compiled
+    """
+
+STEP = re.compile(r'^(\*|[\w.-]+(?::[\w.-]+)?)((?:\[[^\]]*\])*)$')
+PREDICATE = re.compile(r'\[@([\w.:-]+)(?:=(?:"([^"]*)"|\'([^\']*)\'|([^\]]*)))?\]')
+ATTRIBUTE = re.compile(r'^@([\w.:-]+)$')
+
+# Compiled paths are cached, the cache is cleared once it holds this many.
+CACHE_SIZE = 512
+
+_cache = {}
+
+def split_path(path):
+    """
+    Split path on the '/' characters that are outside of predicates.
+    """
+    steps = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(path):
+        if c == '[':
+            depth += 1
+        elif c == ']':
+            depth -= 1
+        elif c == '/' and not depth:
+            steps.append(path[start:i])
+            start = i + 1
+    steps.append(path[start:])
+    if depth:
+        raise PathError('Unbalanced brackets in path: {0}'.format(path))
+    return steps
+
+class Step(object):
+    """
+    A compiled step, a tag test plus the namespace and attribute tests of
+    its predicates.
+    """
+
+    __slots__ = ('prefix', 'tag', 'namespace', 'attrs')
+
+    def __init__(self, text):
+        m = STEP.match(text)
+        if not m:
+            raise PathError('Invalid path step: {0}'.format(text))
+        name, predicates = m.groups()
+        self.prefix = None
+        self.tag = None
+        if name != '*':
+            if ':' in name:
+                self.prefix, self.tag = name.split(':')
+            else:
+                self.tag = name
+        self.namespace = None
+        self.attrs = []
+        consumed = 0
+        for p in PREDICATE.finditer(predicates):
+            if p.start() != consumed:
+                break
+            consumed = p.end()
+            key = p.group(1)
+            value = [i for i in p.groups()[1:] if i is not None]
+            value = value[0] if value else None
+            if key == 'xmlns' and value is not None:
+                self.namespace = value
+            else:
+                self.attrs.append((key, value))
+        if consumed != len(predicates):
+            raise PathError('Invalid predicate in step: {0}'.format(text))
+
+    def match(self, node):
+        if self.tag is not None and node.tag != self.tag:
+            return False
+        if self.prefix is not None and node.prefix != self.prefix:
+            return False
+        if self.namespace is not None and node.namespace != self.namespace:
+            return False
+        return self.match_attrs(node)
+
+    def match_attrs(self, node):
+        if not self.attrs:
+            return True
+        attrs = node._attrs
+        if not attrs:
+            return False
+        for key, value in self.attrs:
+            if key not in attrs:
+                return False
+            if value is not None and attrs[key] != value:
+                return False
+        return True
+
+    def visit(self, following):
+        """
+        Return a function calling following(child, out) for each child of a
+        node matched by this step, it stops and returns True as soon as
+        following does.
+        """
+        tag, prefix, namespace = self.tag, self.prefix, self.namespace
+        attrs, match_attrs = self.attrs, self.match_attrs
+        def visit(node, out):
+            payload = node._payload
+            if not payload:
+                return False
+            if tag is not None and len(payload) >= INDEX_THRESHOLD:
+                for child in node._find(tag, namespace):
+                    if prefix is not None and child.prefix != prefix:
+                        continue
+                    if attrs and not match_attrs(child):
+                        continue
+                    if following(child, out):
+                        return True
+                return False
+            for child in payload:
+                if not isinstance(child, Node):
+                    continue
+                if tag is not None and child.tag != tag:
+                    continue
+                if prefix is not None and child.prefix != prefix:
+                    continue
+                if namespace is not None and child.namespace != namespace:
+                    continue
+                if attrs and not match_attrs(child):
+                    continue
+                if following(child, out):
+                    return True
+            return False
+        return visit
+
+class Path(object):
+    """
+    A compiled path, use compile_path to get one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        steps = split_path(path)
+        self.attr = None
+        self.text = False
+        if steps[-1] == 'text()':
+            self.text = True
+            steps.pop()
+        else:
+            m = ATTRIBUTE.match(steps[-1])
+            if m:
+                self.attr = m.group(1)
+                steps.pop()
+        if not steps:
+            raise PathError('Path has no steps: {0}'.format(path))
+        self.steps = [Step(i) for i in steps]
+        self._all = self._plan(False)
+        self._first = self._plan(True)
+
+    def __repr__(self):
+        return "<Path('{0}')>".format(self.path)
+
+    def _plan(self, stop):
+        """
+        Chain the steps into one function per step, ending with a function
+        that appends each result to out. With stop set the chain unwinds
+        after the first result.
+        """
+        attr = self.attr
+        if attr is not None:
+            def emit(node, out):
+                attrs = node._attrs
+                if attrs and attr in attrs:
+                    out.append(attrs[attr])
+                    return stop
+                return False
+        elif self.text:
+            def emit(node, out):
+                out.append(''.join(
+                    i for i in node._payload or () if not isinstance(i, Node)
+                ))
+                return stop
+        else:
+            def emit(node, out):
+                out.append(node)
+                return stop
+        visit = emit
+        for step in reversed(self.steps[1:]):
+            visit = step.visit(visit)
+        root = self.steps[0].match
+        def plan(node, out):
+            if root(node):
+                visit(node, out)
+            return out
+        return plan
+
+    def all(self, node):
+        """
+        Return the list of results of the path: nodes, attribute values or
+        text.
+        """
+        return self._all(node, [])
+
+    def first(self, node, default=None):
+        """
+        Return the first result of the path or default.
+        """
+        out = self._first(node, [])
+        if out:
+            return out[0]
+        return default
+
+    def iter(self, node):
+        return iter(self.all(node))
+
+def compile_path(path):
+    """
+    Return the compiled Path for path, compiled paths are cached.
+    """
+    try:
+        return _cache[path]
+    except KeyError:
+        pass
+    compiled = Path(path)
+    if len(_cache) >= CACHE_SIZE:
+        # Paths built on the fly, with ids in them for instance, would
+        # otherwise grow it forever
+        _cache.clear()
+    _cache[path] = compiled
+    return compiled
+
+def select(node, path):
+    """
+    Return all results of path evaluated against node.
+    """
+    return compile_path(path).all(node)
+
+def select_one(node, path, default=None):
+    """
+    Return the first result of path evaluated against node.
+    """
+    return compile_path(path).first(node, default)